@@ -1,2 +1,7 @@
+from __future__ import absolute_import
+
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# load the Celery application with Django so that the tasks use it
+from .celery import app as celery_app  # NOQA
@@ -0,0 +1,20 @@
+from __future__ import absolute_import
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# The Celery application running the background tasks (fm.tasks).  Start a
+# worker with:
+#   celery -A ehafm worker -l info
+
+import os
+
+from celery import Celery
+from django.conf import settings
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ehafm.settings')
+
+app = Celery('ehafm')
+# the CELERY_* and BROKER_* Django settings
+app.config_from_object('django.conf:settings')
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
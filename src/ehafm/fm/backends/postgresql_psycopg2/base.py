@@ -0,0 +1,15 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# django.db.backends.postgresql_psycopg2 with the slow statements logged (see
+# fm.slowlog)
+
+from django.db.backends.postgresql_psycopg2.base import *  # NOQA
+from django.db.backends.postgresql_psycopg2.base import \
+    DatabaseWrapper as BaseWrapper
+
+from fm.slowlog import SlowQueryLogMixin
+
+
+class DatabaseWrapper(SlowQueryLogMixin, BaseWrapper):
+    pass
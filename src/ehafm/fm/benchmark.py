@@ -0,0 +1,237 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Times and counts the queries of every URL of fm/urls.py and of the stages of
+# the importer against the current database (e.g. one filled by the
+# generate_fm_data command), so that the results of two releases can be
+# compared.
+#
+# Everything runs in a transaction which is rolled back at the end, so the
+# benchmark leaves no trace in the database (the staff user it logs in as and
+# the records it imports included).  The versions (see fm.versions) bumped
+# by the rolled back changes are bumped again afterwards, so that nothing
+# cached from those changes is ever served.  The metrics of the requests are
+# not added to the totals of the metrics endpoint and neither profiles nor
+# slow queries are logged.  With cold set, every request runs with a new set
+# of versions (see versions.fresh), so that none of the data cached by fm is
+# found; the cache is never cleared (it may be shared with the production
+# workers and other applications).
+
+import json
+import shutil
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from fm import mdg, metrics, synthetic, urls, versions
+from fm.importer import import_records, parse_records
+from fm.models import Area, Contact, Facility, ImportJob, ImportJobPart, \
+    Role
+
+
+class Rollback(Exception):
+    pass
+
+
+class _Registry(metrics.Registry):
+    """Keeps the metrics of the benchmark requests out of the totals."""
+
+    def flush(self):
+        with self.lock:
+            self.deltas.clear()
+            self.views.clear()
+
+
+def _first(queryset):
+    return queryset.order_by('pk').values_list('pk', flat=True).first()
+
+
+def cases():
+    """Return the (label, url name, url args, GET parameters, POST body) of
+    the requests to time, using the first matching rows as samples."""
+    facility = _first(Facility.objects.filter(has_json=True)) or \
+        _first(Facility.objects.all()) or 1
+    contact = _first(Contact.objects.all()) or 1
+    state = _first(Area.objects.filter(area_type='State')) or 1
+    lga = _first(Area.objects.filter(area_type='LGA')) or state
+    job = _first(ImportJob.objects.all()) or 1
+    facility_name = Facility.objects.filter(pk=facility).values_list(
+        'facility_name', flat=True).first() or 'a'
+    records = [{'model': 'facility', 'facility_name': f.facility_name,
+                'facility_type': f.facility_type,
+                'facility_status': f.facility_status,
+                'facility_area': f.facility_area.area_label
+                if f.facility_area_id else None,
+                'json': f.json}
+               for f in Facility.objects.select_related(
+                   'facility_area').order_by('pk')[:100]]
+    return [
+        ('home', 'fm_home', [], {}, None),
+        ('areas', 'fm_areas', [], {}, None),
+        ('areas csv', 'fm_areas', [], {'format': 'csv'}, None),
+        ('new area form', 'fm_add_new_area', [], {}, None),
+        ('facilities', 'fm_facilities', [], {}, None),
+        ('facilities sorted by area', 'fm_facilities', [],
+         {'sort': '-area'}, None),
+        ('facilities filtered', 'fm_facilities', [],
+         {'area': state, 'facility_type': 'Health Facility',
+          'facility_status': 'non-functional', 'has_json': 'yes',
+          'sort': 'name'}, None),
+        ('facilities csv', 'fm_facilities', [], {'format': 'csv'}, None),
+        ('new facility form', 'fm_add_new_facility', [], {}, None),
+        ('facility', 'fm_facility_view', [facility], {}, None),
+        ('facility json', 'fm_facility_json', ['facilities', facility], {},
+         None),
+        ('facilities json by area', 'fm_facilities_json', ['facilities'],
+         {'area': lga}, None),
+        ('facilities ndjson by ids', 'fm_facilities_json', ['facilities'],
+         {'ids': '1-1000', 'format': 'ndjson'}, None),
+        ('contacts', 'fm_contacts', [], {}, None),
+        ('contacts csv', 'fm_contacts', [], {'format': 'csv'}, None),
+        ('new contact form', 'fm_add_new_contact', [], {}, None),
+        ('contact json', 'fm_contact_json', ['contacts', contact], {}, None),
+        ('contacts json by ids', 'fm_contacts_json', ['contacts'],
+         {'ids': '1-1000'}, None),
+        ('roles', 'fm_roles', [], {}, None),
+        ('roles csv', 'fm_roles', [], {'format': 'csv'}, None),
+        ('new role form', 'fm_add_new_role', [], {}, None),
+        ('import 100 facilities', 'fm_import', [], {}, json.dumps(records)),
+        ('area choices', 'fm_choices', ['areas'], {'q': 'ka'}, None),
+        ('facility choices', 'fm_choices', ['facilities'], {'q': 'ka'}, None),
+        ('contact choices', 'fm_choices', ['contacts'], {'q': 'ab'}, None),
+        ('search', 'fm_search', [], {'q': facility_name.split()[0]}, None),
+        ('metrics', 'fm_metrics', [], {}, None),
+        ('imports', 'fm_imports', [], {}, None),
+        ('import job', 'fm_import_job', [job], {}, None),
+        ('import job json', 'fm_import_job_json', [job], {}, None),
+    ]
+
+
+def uncovered(case_list):
+    """The names of the URLs of fm/urls.py without a case."""
+    names = set(pattern.name for pattern in urls.urlpatterns)
+    return sorted(names.difference(name for _, name, _, _, _ in case_list))
+
+
+def _measure(function, repeat):
+    seconds, queries = [], []
+    result = None
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.time()
+            result = function()
+            seconds.append(round(time.time() - start, 6))
+        queries.append(len(captured))
+    return result, {'seconds': seconds, 'queries': queries,
+                    'median_seconds': sorted(seconds)[len(seconds) // 2]}
+
+
+def time_views(client, case_list, repeat, cold=False):
+    results = []
+    for label, name, args, params, body in case_list:
+        url = reverse(name, args=args)
+
+        def send():
+            if body is None:
+                response = client.get(url, params)
+            else:
+                response = client.post(url, body,
+                                       content_type='application/json')
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response.streaming_content)
+            else:
+                size = len(response.content)
+            return response.status_code, size
+
+        def request():
+            if cold:
+                # Streamed responses are consumed in the block as well
+                with versions.fresh():
+                    return send()
+            return send()
+
+        (status, size), measured = _measure(request, repeat)
+        measured.update(label=label, url_name=name, url=url, params=params,
+                        status=status, bytes=size)
+        results.append(measured)
+    return results
+
+
+def time_importer(repeat, seed=0):
+    """Time the stages of an MDG import of one synthetic state: the
+    transformation of the LGA documents, the parsing of the records and the
+    import into an empty and into an up to date database."""
+    data = synthetic.generate(seed, states=['Benchmark'])
+    directory = tempfile.mkdtemp()
+    try:
+        documents = synthetic.write_mdg_documents(data, directory)
+        lines, transform = _measure(lambda: mdg.transform_documents(
+            'Benchmark', documents, processes=1), repeat)
+    finally:
+        shutil.rmtree(directory)
+    content = u'\n'.join(lines).encode('utf-8')
+    records, parse = _measure(lambda: parse_records(content), repeat)
+    stages = [dict(transform, stage='transform', records=len(lines)),
+              dict(parse, stage='parse', records=len(records))]
+    _, imported = _measure(lambda: import_records(records), 1)
+    stages.append(dict(imported, stage='import new', records=len(records)))
+    _, reimported = _measure(lambda: import_records(records), repeat)
+    stages.append(dict(reimported, stage='import existing',
+                       records=len(records)))
+    return stages
+
+
+def run(repeat=5, cold=False, importer=True):
+    """Run the benchmark and return its results as a JSON serialisable
+    dict."""
+    result = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'database': connection.vendor,
+        'cache': settings.CACHES['default']['BACKEND'],
+        'repeat': repeat,
+        'cold': cold,
+        'rows': dict((model._meta.model_name, model.objects.count())
+                     for model in (Area, Facility, Contact, Role)),
+    }
+    registry, metrics.registry = metrics.registry, _Registry()
+    try:
+        with versions.recording() as bumped, override_settings(
+                FM_PROFILE_SAMPLE_RATE=0.0, FM_PROFILE_SLOW_THRESHOLD=None,
+                FM_SLOW_QUERY_THRESHOLD=None):
+            _run(result, repeat, cold, importer)
+    finally:
+        metrics.registry = registry
+    versions.bump(bumped)
+    return result
+
+
+def _run(result, repeat, cold, importer):
+    try:
+        with transaction.atomic():
+            password = uuid.uuid4().hex
+            user = User.objects.create_superuser(
+                'benchmark-%s' % uuid.uuid4().hex[:8], '', password)
+            if not ImportJob.objects.exists():
+                # an import job to show
+                job = ImportJob.objects.create(state_name='Benchmark',
+                                               status=ImportJob.FINISHED)
+                ImportJobPart.objects.create(job=job, lga_name='Benchmark',
+                                             status=ImportJobPart.FINISHED)
+            client = Client()
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                client.login(username=user.username, password=password)
+                case_list = cases()
+                result['uncovered'] = uncovered(case_list)
+                result['views'] = time_views(client, case_list, repeat, cold)
+            if importer:
+                result['importer'] = time_importer(repeat)
+            raise Rollback()
+    except Rollback:
+        pass
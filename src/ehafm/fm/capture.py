@@ -0,0 +1,101 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Capture of the SQL statements run by a thread, for the request metrics
+# (fm.metrics) and profiles (fm.profiling).
+#
+# The cursors of the database backends in fm.backends (see fm.slowlog) hand
+# every statement to the captures running in their thread.  Unlike with the
+# debug cursor of Django (connection.queries), nothing is kept unless a
+# capture is running, and the statements are kept as their SQL with
+# placeholders and their parameters apart, so that the parameters can be
+# redacted before anything is written out.
+
+import threading
+from collections import Counter
+
+_local = threading.local()
+
+
+def redact(params):
+    """The parameters with everything but numbers, booleans and None replaced
+    by the name of its type (names, phone numbers, password hashes and
+    session keys are never written out)."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return dict((key, redact([value])[0]) for key, value in params.items())
+    return [value if value is None or isinstance(value, (bool, int, long,
+                                                         float))
+            else '<%s>' % type(value).__name__ for value in params]
+
+
+class Capture(object):
+    """The statements run by a thread between start() and stop(), as
+    (database alias, sql, params, duration, executemany) tuples."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, _, _, duration, _ in self.queries)
+
+    def repeated(self):
+        """A Counter of the statements (SQL) by the number of times each was
+        run with the same parameters."""
+        runs = Counter((alias, sql, repr(params))
+                       for alias, sql, params, _, _ in self.queries)
+        repeated = Counter()
+        for (_, sql, _), count in runs.items():
+            if count > 1:
+                repeated[sql] = max(repeated[sql], count)
+        return repeated
+
+    def duplicates(self):
+        """The number of statements repeating an earlier one (the same SQL
+        with the same parameters on the same database)."""
+        return len(self.queries) - len(set(
+            (alias, sql, repr(params))
+            for alias, sql, params, _, _ in self.queries))
+
+    def redacted(self, limit=None):
+        """The statements as dicts safe to write out (see redact)."""
+        return [{'database': alias, 'sql': sql,
+                 'params': None if many else redact(params),
+                 'executemany': many, 'time': round(duration, 6)}
+                for alias, sql, params, duration, many in
+                self.queries[:limit]]
+
+
+def _captures():
+    captures = getattr(_local, 'captures', None)
+    if captures is None:
+        captures = _local.captures = []
+    return captures
+
+
+def start():
+    """Start capturing the statements of this thread."""
+    capture = Capture()
+    _captures().append(capture)
+    return capture
+
+
+def stop(capture):
+    captures = _captures()
+    if capture in captures:
+        captures.remove(capture)
+    return capture
+
+
+def capturing():
+    return bool(getattr(_local, 'captures', None))
+
+
+def record(alias, sql, params, duration, many=False):
+    for capture in getattr(_local, 'captures', ()):
+        capture.queries.append((alias, sql, params, duration, many))
@@ -0,0 +1,105 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Choice labels for the dropdowns listing areas, facilities and contacts.  The
+# labels are built from a single values_list() query (no model instances and
+# no __unicode__ calls) and kept in the Django cache under the versions of the
+# models they depend on (see fm.versions), in chunks of
+# FM_CHOICES_CACHE_CHUNK_SIZE labels so that no cached value grows over the
+# size limit of the cache (1MB by default on memcached).
+
+from django.conf import settings
+from django.core.cache import cache
+
+from fm import versions
+from fm.models import Area, Facility, Contact
+
+
+def _area_labels():
+    return list(Area.objects.order_by('pk').values_list('pk', 'area_label'))
+
+
+def _facility_labels():
+    rows = Facility.objects.order_by('pk').values_list(
+        'pk', 'facility_name', 'facility_status', 'facility_area__area_label')
+    return [(pk, Facility.make_label(name, status, area_label))
+            for pk, name, status, area_label in rows]
+
+
+def _contact_labels():
+    rows = Contact.objects.order_by('pk').values_list(
+        'pk', 'contact_name', 'contact_email')
+    return [(pk, Contact.make_label(name, email)) for pk, name, email in rows]
+
+
+LABEL_SOURCES = {
+    'areas': _area_labels,
+    'facilities': _facility_labels,
+    'contacts': _contact_labels,
+}
+
+# the models the labels of each source are built from
+SOURCE_MODELS = {
+    'areas': (Area,),
+    'facilities': (Facility, Area),
+    'contacts': (Contact,),
+}
+
+
+def inline_limit():
+    """Number of options above which a dropdown is searched lazily."""
+    return getattr(settings, 'FM_CHOICES_INLINE_LIMIT', 1000)
+
+
+def search_limit():
+    return getattr(settings, 'FM_CHOICES_SEARCH_LIMIT', 50)
+
+
+def cache_chunk_size():
+    return getattr(settings, 'FM_CHOICES_CACHE_CHUNK_SIZE', 2000)
+
+
+def _cache_key(source):
+    return versions.versioned_key(
+        'fm:choices:%s' % source,
+        [versions.model_scope(m) for m in SOURCE_MODELS[source]])
+
+
+def _chunk_keys(key, count):
+    return ['%s:%d' % (key, index) for index in range(count)]
+
+
+def choice_labels(source):
+    """Return the list of (pk, label) pairs for the given source."""
+    key = _cache_key(source)
+    # the number of chunks the labels are stored in
+    count = cache.get(key)
+    if count is not None:
+        keys = _chunk_keys(key, count)
+        chunks = cache.get_many(keys)
+        if len(chunks) == count:
+            return [label for k in keys for label in chunks[k]]
+    labels = LABEL_SOURCES[source]()
+    size = cache_chunk_size()
+    chunks = [labels[start:start + size]
+              for start in range(0, len(labels), size)]
+    cache.set_many(dict(zip(_chunk_keys(key, len(chunks)), chunks)), None)
+    # stored last: a reader seeing the count finds the chunks
+    cache.set(key, len(chunks), None)
+    return labels
+
+
+def search_choice_labels(source, term, limit=None):
+    """Return at most limit (pk, label) pairs whose labels contain all the
+    words of term (case insensitive)."""
+    if limit is None:
+        limit = search_limit()
+    words = term.lower().split()
+    found = []
+    for pk, label in choice_labels(source):
+        lowered = label.lower()
+        if all(w in lowered for w in words):
+            found.append((pk, label))
+            if len(found) >= limit:
+                break
+    return found
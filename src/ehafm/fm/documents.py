@@ -0,0 +1,130 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Pretty-printed JSON documents of facilities and contacts kept in the Django
+# cache.  A document is cached under its (model, id, version) and the version
+# of the row (see fm.versions) is replaced whenever the row is saved or
+# deleted, so a stale copy is never served and serving a fresh one does not
+# touch the database.
+
+import hashlib
+import re
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+import jsonfield
+
+from fm import versions
+
+# Maximum number of pks per in_bulk query (SQLite does not accept more than 999
+# query parameters).
+LOAD_CHUNK_SIZE = 500
+
+_INDENTATION = re.compile(r'\n *')
+
+
+def _document_key(model, pk, version):
+    return 'fm:json:%s:%s:%s' % (model._meta.model_name, pk, version)
+
+
+class Document(object):
+    """A pretty-printed JSON document with its ETag (there is no
+    Last-Modified: the rows have no modification time and the time a document
+    has been cached at says nothing about when the row changed)."""
+
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+
+    @classmethod
+    def from_json(cls, value):
+        content = jsonfield.JSONField().dumps_for_display(value)
+        return cls(content,
+                   '"%s"' % hashlib.md5(content.encode('utf-8')).hexdigest())
+
+    def single_line(self):
+        """The document without the line breaks and indentation (JSON strings
+        cannot contain line breaks so this is still the same document)."""
+        return _INDENTATION.sub('', self.content)
+
+
+def json_documents(model, pks):
+    """Return an OrderedDict mapping the pks of the existing rows of the model
+    among pks (in the same order) to their Documents.
+
+    The cached documents are taken from the cache with a single get_many
+    (after one for their versions) and the remaining ones are loaded with one
+    in_bulk query per chunk of LOAD_CHUNK_SIZE pks.
+    """
+    pks = list(OrderedDict.fromkeys(pks))
+    scopes = dict((pk, versions.row_scope(model, pk)) for pk in pks)
+    current = versions.versions(scopes.values())
+    document_keys = dict((pk, _document_key(model, pk, current[scopes[pk]]))
+                         for pk in pks)
+    cached = cache.get_many(document_keys.values())
+    missing = [pk for pk in pks if document_keys[pk] not in cached]
+    loaded = {}
+    for start in range(0, len(missing), LOAD_CHUNK_SIZE):
+        chunk = missing[start:start + LOAD_CHUNK_SIZE]
+        for pk, container in model.objects.only('json').in_bulk(
+                chunk).items():
+            loaded[document_keys[pk]] = Document.from_json(container.json)
+    if loaded:
+        cache.set_many(loaded, None)
+        cached.update(loaded)
+    return OrderedDict((pk, cached[document_keys[pk]]) for pk in pks
+                       if document_keys[pk] in cached)
+
+
+def json_document(model, pk):
+    """Return the Document of the row of the model with the given pk, from the
+    cache if possible.  Raises Http404 if there is no such row."""
+    documents = json_documents(model, [pk])
+    if pk not in documents:
+        raise Http404
+    return documents[pk]
+
+
+def batch_limit():
+    """Maximum number of documents returned by one batch request."""
+    return getattr(settings, 'FM_JSON_BATCH_LIMIT', 5000)
+
+
+def parse_ids(value, limit=None):
+    """Parse a comma separated list of ids and ranges of ids (e.g.
+    '3,7,10-20') into a list of ids.  Raises ValueError if the value is not
+    valid or lists more than limit ids."""
+    if limit is None:
+        limit = batch_limit()
+    ids = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError('Invalid range of ids: %s.' % part)
+        if len(ids) + last - first + 1 > limit:
+            raise ValueError('More than %d ids requested.' % limit)
+        ids.extend(range(first, last + 1))
+    return ids
+
+
+def ndjson_lines(documents):
+    """Yield an NDJSON line ({"id": ..., "json": ...}) per document."""
+    for pk, document in documents.iteritems():
+        yield u'{"id": %d, "json": %s}\n' % (pk, document.single_line())
+
+
+def json_object_chunks(documents):
+    """Yield the parts of a JSON object mapping the ids to the documents."""
+    separator = u'{\n'
+    for pk, document in documents.iteritems():
+        yield u'%s"%d": %s' % (separator, pk, document.content)
+        separator = u',\n'
+    yield u'{}\n' if separator == u'{\n' else u'\n}\n'
@@ -0,0 +1,47 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import csv
+
+from django.http import StreamingHttpResponse
+
+from fm.pagination import keyset_chunks
+
+
+class _Echo(object):
+    """File-like object handing back whatever is written to it so that the
+    csv module can be used to format rows one at a time."""
+    def write(self, value):
+        return value
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value.encode('utf-8')
+
+
+def csv_rows(queryset, header, row, chunk_size=None, order_by=None):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([_encode(h) for h in header])
+    for chunk in keyset_chunks(queryset, chunk_size, order_by):
+        for obj in chunk:
+            yield writer.writerow([_encode(v) for v in row(obj)])
+
+
+def stream_csv(queryset, file_name, header, row, chunk_size=None,
+               order_by=None):
+    """Return a response streaming the whole queryset as a CSV document.
+
+    Rows are written as they are fetched, one keyset chunk at a time, so the
+    memory used does not depend on the size of the table.  row is called for
+    each object and returns the list of values for its CSV row.  The rows
+    are sorted on order_by (see keyset_page), by default on the primary key.
+    """
+    response = StreamingHttpResponse(
+        csv_rows(queryset, header, row, chunk_size, order_by),
+        content_type='text/csv;charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % file_name
+    return response
@@ -1,12 +1,102 @@
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
 
+import json
+
 from django import forms
+from django.core.urlresolvers import reverse
+from django.utils.encoding import force_text
+from django.utils.html import format_html
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
 
+from fm import mdg
+from fm.choices import choice_labels, inline_limit
 from fm.models import Area, Facility, Contact, Role
+from fm.tasks import check_source_url, start_import
+
+
+class CachedChoiceIterator(object):
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for choice in choice_labels(self.field.source):
+            yield choice
+
+    def __len__(self):
+        return len(choice_labels(self.field.source)) + (
+            1 if self.field.empty_label is not None else 0)
+
+
+class SearchableSelect(forms.Select):
+    """A select rendered as usual for short option lists.  Long lists are
+    not sent to the browser at all; instead the options matching a search box
+    are fetched from the fm_choices view as the user types."""
+
+    def __init__(self, source, attrs=None, choices=()):
+        super(SearchableSelect, self).__init__(attrs, choices)
+        self.source = source
+
+    def render(self, name, value, attrs=None, choices=()):
+        if len(self.choices) <= inline_limit():
+            return super(SearchableSelect, self).render(name, value, attrs,
+                                                        choices)
+        # render only the blank and the currently selected options
+        value = '' if value is None else force_text(value)
+        short_list = [c for c in self.choices if force_text(c[0]) in ('',
+                                                                     value)]
+        select = forms.Select(self.attrs, short_list).render(name, value,
+                                                             attrs)
+        select_id = self.build_attrs(attrs).get('id', 'id_%s' % name)
+        url = reverse('fm_choices', args=[self.source])
+        search = format_html(
+            '<input type="search" id="{0}_search" placeholder="Type to search"'
+            ' autocomplete="off">', select_id)
+        script = format_html(
+            '<script type="text/javascript">'
+            '(function($) {{'
+            ' var select = $("#{0}");'
+            ' $("#{0}_search").on("input", function() {{'
+            '  $.getJSON({1}, {{q: this.value}}, function(data) {{'
+            '   var current = select.val();'
+            '   select.find("option").not(":selected").not("[value=\'\']")'
+            '.remove();'
+            '   $.each(data, function(i, item) {{'
+            '    if (String(item.id) !== current) {{'
+            '     select.append($("<option>").val(item.id).text(item.label));'
+            '    }}'
+            '   }});'
+            '  }});'
+            ' }});'
+            '}})(django.jQuery);'
+            '</script>', select_id, mark_safe(json.dumps(url)))
+        return mark_safe(search + select + script)
+
+
+class CachedModelChoiceField(forms.ModelChoiceField):
+    """A ModelChoiceField taking its option labels from fm.choices (one cached
+    query) instead of calling __unicode__ on every object."""
+
+    def __init__(self, source, queryset, *args, **kwargs):
+        self.source = source
+        kwargs.setdefault('widget', SearchableSelect(source))
+        super(CachedModelChoiceField, self).__init__(queryset, *args, **kwargs)
+
+    def _get_choices(self):
+        if hasattr(self, '_choices'):
+            return self._choices
+        return CachedChoiceIterator(self)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
 
 
 class AreaForm(forms.ModelForm):
+    area_parent = CachedModelChoiceField('areas', Area.objects.all(),
+                                         required=False)
+
     class Meta:
         model = Area
         fields = ('area_name', 'area_type', 'area_parent',)
@@ -17,6 +107,9 @@ class AreaForm(forms.ModelForm):
 
 
 class FacilityForm(forms.ModelForm):
+    facility_area = CachedModelChoiceField('areas', Area.objects.all(),
+                                           required=False)
+
     class Meta:
         model = Facility
         fields = ('facility_name', 'facility_type', 'facility_status',
@@ -50,6 +143,163 @@ class ContactForm(forms.ModelForm):
 
 
 class RoleForm(forms.ModelForm):
+    role_contact = CachedModelChoiceField('contacts',
+                                          Contact.objects.defer('json'))
+    role_facility = CachedModelChoiceField('facilities',
+                                           Facility.objects.defer('json'))
+
     class Meta:
         model = Role
         fields = ('role_name', 'role_contact', 'role_facility')
+
+
+class FacilityFilterForm(forms.Form):
+    """Filters and sort order of the list of facilities, read from the query
+    string."""
+
+    # column key -> (header, field to sort on).  The area column is sorted on
+    # the label of the joined area, which no index of Facility covers: sorting
+    # on it reads and sorts all the matching facilities for every page.
+    COLUMNS = (
+        ('name', ('Facility', 'facility_name')),
+        ('type', ('Facility Type', 'facility_type')),
+        ('status', ('Status', 'facility_status')),
+        ('area', ('Area', 'facility_area__area_label')),
+        ('json', ('JSON', 'has_json')),
+    )
+    HAS_JSON_CHOICES = (
+        ('', 'with or without JSON'),
+        ('yes', 'with JSON'),
+        ('no', 'without JSON'),
+    )
+
+    facility_type = forms.ChoiceField(
+        choices=(('', 'any type'),) + Facility.FACILITY_TYPES, required=False)
+    facility_status = forms.CharField(
+        required=False,
+        widget=forms.fields.TextInput(attrs={'placeholder': 'any status'}))
+    area = CachedModelChoiceField('areas', Area.objects.all(), required=False,
+                                  empty_label='anywhere')
+    has_json = forms.ChoiceField(choices=HAS_JSON_CHOICES, required=False)
+    sort = forms.ChoiceField(
+        choices=[(key, key) for key, _ in COLUMNS] +
+                [('-' + key, '-' + key) for key, _ in COLUMNS],
+        required=False, widget=forms.HiddenInput)
+
+    def filter(self, queryset):
+        """Return the facilities of queryset matching the filters (none if
+        the filters are invalid)."""
+        if not self.is_bound:
+            return queryset
+        if not self.is_valid():
+            return queryset.none()
+        data = self.cleaned_data
+        if data['facility_type']:
+            queryset = queryset.filter(facility_type=data['facility_type'])
+        if data['facility_status']:
+            queryset = queryset.filter(
+                facility_status=data['facility_status'])
+        if data['area'] is not None:
+            queryset = queryset.within(data['area'])
+        if data['has_json']:
+            queryset = queryset.filter(has_json=data['has_json'] == 'yes')
+        return queryset
+
+    def sort_column(self):
+        """Return the sort column key, prefixed with '-' if descending, or ''
+        for the default (primary key) order."""
+        if self.is_bound and self.is_valid():
+            return self.cleaned_data['sort']
+        return ''
+
+    def order_by(self):
+        """Return the field path to sort on (None for the primary key)."""
+        sort = self.sort_column()
+        if not sort:
+            return None
+        key = sort.lstrip('-')
+        return sort[:len(sort) - len(key)] + dict(self.COLUMNS)[key][1]
+
+    def params(self, sort=None):
+        """Return the (name, value) GET parameters selecting the current
+        filters and, unless given, the current sort order."""
+        params = [(name, self.data[name]) for name in self.fields
+                  if name != 'sort' and self.data.get(name)]
+        sort = self.sort_column() if sort is None else sort
+        if sort:
+            params.append(('sort', sort))
+        return params
+
+    def query(self):
+        return urlencode(self.params())
+
+    def columns(self):
+        """Return the headers of the list with the query strings sorting on
+        them (toggling the order of the current sort column)."""
+        current = self.sort_column()
+        columns = []
+        for key, (header, _) in self.COLUMNS:
+            if current == key:
+                order, sort = 'ascending', '-' + key
+            elif current == '-' + key:
+                order, sort = 'descending', key
+            else:
+                order, sort = None, key
+            columns.append({'key': key, 'header': header, 'order': order,
+                            'query': urlencode(self.params(sort))})
+        return columns
+
+
+class ImportJobForm(forms.Form):
+    """Start a background import of the MDG documents of a state (see
+    fm.tasks)."""
+    state_name = forms.CharField(max_length=64, initial='Kano')
+    lga_names = forms.CharField(
+        label='LGA names', widget=forms.Textarea(attrs={'rows': 10}),
+        initial=u'\n'.join(mdg.KANO_LGA_NAMES), help_text='One per line.')
+    sectors = forms.CharField(max_length=255, initial='health',
+                              help_text='MDG sectors, separated by commas.')
+    source_url = forms.URLField(label='Source URL', max_length=255,
+                                initial=mdg.MDG_URL)
+
+    @staticmethod
+    def check_name(name):
+        # the names make up the names of the downloaded files
+        if '/' in name or '\\' in name or '..' in name:
+            raise forms.ValidationError(
+                u'Names cannot contain "/", "\\" or "..": %s' % name)
+        return name
+
+    def clean_state_name(self):
+        return self.check_name(self.cleaned_data['state_name'])
+
+    def clean_lga_names(self):
+        names = []
+        for line in self.cleaned_data['lga_names'].splitlines():
+            name = self.check_name(line.strip())
+            if name and name not in names:
+                names.append(name)
+        if not names:
+            raise forms.ValidationError('Enter at least one LGA name.')
+        return names
+
+    def clean_sectors(self):
+        sectors = [s.strip() for s in self.cleaned_data['sectors'].split(',')
+                   if s.strip()]
+        if not sectors:
+            raise forms.ValidationError('Enter at least one sector.')
+        return sectors
+
+    def clean_source_url(self):
+        url = self.cleaned_data['source_url']
+        try:
+            check_source_url(url)
+        except ValueError as e:
+            raise forms.ValidationError(unicode(e))
+        return url
+
+    def start(self, user=None):
+        return start_import(self.cleaned_data['state_name'],
+                            self.cleaned_data['lga_names'],
+                            self.cleaned_data['sectors'],
+                            self.cleaned_data['source_url'], user)
@@ -0,0 +1,140 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Trigram similarity of area and facility names, used to flag probable
+# duplicates among imported records ("Dawakin-Kudu" vs "Dawakin Kudu",
+# "Gen. Hosp." vs "General Hospital").
+#
+# Names are lowercased, anything but letters and digits becomes a word break
+# and every word is padded the way pg_trgm does it ('  word ').  The
+# similarity of two names is the number of trigrams they share divided by the
+# number of distinct trigrams of both.  Names are only compared within a
+# block, i.e. among the children of one parent area, and within a block an
+# inverted index maps trigrams to names so that a lookup only touches the
+# names sharing at least one trigram with the one looked up.
+
+import re
+from collections import Counter, defaultdict
+
+from django.conf import settings
+
+from fm.models import Area, Facility
+
+_NON_ALNUM = re.compile(r'[\W_]+', re.UNICODE)
+
+# model -> (name field, block field)
+FIELDS = {
+    Area: ('area_name', 'area_parent'),
+    Facility: ('facility_name', 'facility_area'),
+}
+
+
+def default_threshold():
+    return getattr(settings, 'FM_FUZZY_THRESHOLD', 0.5)
+
+
+def normalise(name):
+    return u' '.join(_NON_ALNUM.sub(u' ', name.lower()).split())
+
+
+def trigrams(name):
+    grams = set()
+    for word in normalise(name).split():
+        padded = u'  %s ' % word
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def similarity(name, other_name):
+    grams, other = trigrams(name), trigrams(other_name)
+    if not grams or not other:
+        return 0.0
+    return len(grams & other) / float(len(grams | other))
+
+
+class TrigramIndex(object):
+    """An inverted trigram index over (key, name) entries."""
+
+    def __init__(self):
+        self.entries = {}
+        self.postings = defaultdict(set)
+
+    def add(self, key, name):
+        grams = trigrams(name)
+        self.entries[key] = (name, grams)
+        for gram in grams:
+            self.postings[gram].add(key)
+
+    def candidates(self, name, threshold, limit=None):
+        """Return the (key, name, similarity) of the entries at least
+        threshold similar to name, most similar first."""
+        grams = trigrams(name)
+        shared = Counter()
+        for gram in grams:
+            for key in self.postings.get(gram, ()):
+                shared[key] += 1
+        found = []
+        for key, common in shared.items():
+            other_name, other = self.entries[key]
+            score = common / float(len(grams) + len(other) - common)
+            if score >= threshold:
+                found.append((-score, key, other_name))
+        found.sort()
+        return [(key, other_name, -score)
+                for score, key, other_name in found[:limit]]
+
+
+class NameMatcher(object):
+    """Candidate matches for names of new areas or facilities among the
+    stored ones with the same parent area.
+
+    The names of a block are loaded (in one query per chunk of blocks) the
+    first time the block is needed.
+    """
+
+    def __init__(self, model, threshold=None, limit=5, chunk_size=400):
+        self.model = model
+        self.name_field, self.block_field = FIELDS[model]
+        self.threshold = default_threshold() if threshold is None \
+            else threshold
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.blocks = {}
+
+    def load(self, block_ids):
+        missing = list(set(block_ids).difference(self.blocks))
+        for block_id in missing:
+            self.blocks[block_id] = TrigramIndex()
+        if None in missing:
+            missing.remove(None)
+            self._load(self.model.objects.filter(
+                **{'%s__isnull' % self.block_field: True}))
+        for start in range(0, len(missing), self.chunk_size):
+            self._load(self.model.objects.filter(**{
+                '%s__in' % self.block_field:
+                missing[start:start + self.chunk_size]}))
+
+    def _load(self, objects):
+        for pk, name, block_id in objects.values_list(
+                'pk', self.name_field, self.block_field):
+            self.blocks[block_id].add(pk, name)
+
+    def add(self, block_id, pk, name):
+        self.load([block_id])
+        self.blocks[block_id].add(pk, name)
+
+    def candidates(self, items):
+        """Return, for each (block id, name) item, the list of (pk, name,
+        similarity) of the stored objects in the block whose names are at
+        least threshold similar."""
+        items = list(items)
+        self.load(block_id for block_id, _ in items)
+        return [self.blocks[block_id].candidates(name, self.threshold,
+                                                 self.limit)
+                for block_id, name in items]
+
+
+def candidate_matches(model, items, threshold=None, limit=5):
+    """Candidate matches among the stored areas or facilities for a batch of
+    (parent area id, name) items (see NameMatcher.candidates)."""
+    return NameMatcher(model, threshold, limit).candidates(items)
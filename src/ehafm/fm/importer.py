@@ -0,0 +1,430 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Server side bulk import of areas and facilities.
+#
+# Records are JSON objects, sent either as one JSON array or as NDJSON (one
+# object per line):
+#
+#   {"model": "area", "area_name": "Dala", "area_type": "LGA",
+#    "area_parent": "Kano (State)"}
+#   {"model": "facility", "facility_name": "Dala Clinic",
+#    "facility_type": "Health Facility", "facility_status": "ok",
+#    "facility_area": "Gwammaja (Ward in Dala in Kano)", "json": {...}}
+#
+# Areas are referred to by their fully qualified names (labels), i.e. the
+# names shown on the areas page.  Existing rows are detected by their natural
+# keys: (area_name, area_type, area_parent) for areas, the MDG facility_id
+# stored in the JSON document or else (facility_name, facility_type,
+# facility_area) for facilities.  Existing areas are left untouched while
+# existing facilities are updated, so an import can be safely re-run.
+# Imports running at the same time are not serialised, though: only the
+# external ids are unique in the database, so two of them can both create a
+# facility without an external id or a root area with the same natural key.
+#
+# The results of created records list the stored areas or facilities with
+# the same parent area and a similar name (see fm.fuzzy) under 'similar', as
+# they are probably duplicates spelled differently.
+
+import json
+from collections import Counter, OrderedDict
+
+from django.db import transaction
+from django.db.models import Q
+
+from fm import fuzzy, search, versions
+from fm.models import Area, AREA_TYPES, Facility, FacilityCount
+
+CREATED = 'created'
+UPDATED = 'updated'
+EXISTING = 'existing'
+INVALID = 'invalid'
+
+# Maximum number of values in the IN clauses of the lookup queries (SQLite
+# does not accept more than 999 query parameters).
+LOOKUP_CHUNK_SIZE = 400
+
+AREA_TYPE_NAMES = frozenset(t[0] for t in AREA_TYPES)
+FACILITY_TYPE_NAMES = frozenset(t[0] for t in Facility.FACILITY_TYPES)
+
+
+class RecordError(ValueError):
+    pass
+
+
+def parse_records(content):
+    """Parse a JSON array or NDJSON document into a list of records."""
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    content = content.strip()
+    try:
+        if content.startswith(u'['):
+            records = json.loads(content)
+        else:
+            records = [json.loads(line) for line in content.splitlines()
+                       if line.strip()]
+    except ValueError as e:
+        raise RecordError('Invalid JSON: %s' % e)
+    return records
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _result(index, record, status, obj=None, error=None, similar=None):
+    result = {'index': index, 'status': status,
+              'model': record.get('model') if isinstance(record, dict)
+              else None}
+    if obj is not None:
+        result['id'] = obj.pk
+    if error is not None:
+        result['error'] = error
+    if similar:
+        result['similar'] = [
+            {'id': pk, 'name': name, 'similarity': round(score, 2)}
+            for pk, name, score in similar]
+    return result
+
+
+def _text(record, field, required=True):
+    value = record.get(field)
+    if value is None or value == u'':
+        if required:
+            raise RecordError('Missing %s.' % field)
+        return u''
+    if not isinstance(value, basestring):
+        raise RecordError('%s has to be a string.' % field)
+    return value
+
+
+def _validate_area(record):
+    name = _text(record, 'area_name')
+    area_type = _text(record, 'area_type')
+    if area_type not in AREA_TYPE_NAMES:
+        raise RecordError('Unknown area_type: %s.' % area_type)
+    return name, area_type, _text(record, 'area_parent', required=False)
+
+
+def _validate_facility(record):
+    name = _text(record, 'facility_name')
+    facility_type = _text(record, 'facility_type')
+    if facility_type not in FACILITY_TYPE_NAMES:
+        raise RecordError('Unknown facility_type: %s.' % facility_type)
+    document = record.get('json')
+    if isinstance(document, basestring):
+        try:
+            document = json.loads(document)
+        except ValueError:
+            raise RecordError('json is not a valid JSON document.')
+    return (name, facility_type,
+            _text(record, 'facility_status', required=False),
+            _text(record, 'facility_area', required=False), document)
+
+
+class BulkImporter(object):
+    """Imports a list of records and collects a result for each of them.
+
+    Lookups and inserts are done in batches of at most batch_size records so
+    importing a batch costs a handful of queries whatever its size.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.results = []
+        # label -> Area for the areas seen so far
+        self.areas = {}
+        # changes to the FacilityCounts by (area id, type, status)
+        self.count_deltas = Counter()
+        # the areas whose facilities have been created, updated or moved
+        self.changed_area_ids = set()
+        # names of the stored areas and facilities, for spotting probable
+        # duplicates of the created ones
+        self.matchers = {Area: fuzzy.NameMatcher(Area),
+                         Facility: fuzzy.NameMatcher(Facility)}
+
+    def run(self, records):
+        self.results = [None] * len(records)
+        areas, facilities = [], []
+        for index, record in enumerate(records):
+            try:
+                if not isinstance(record, dict):
+                    raise RecordError('A record has to be a JSON object.')
+                if record.get('model') == 'area':
+                    areas.append((index, record, _validate_area(record)))
+                elif record.get('model') == 'facility':
+                    facilities.append(
+                        (index, record, _validate_facility(record)))
+                else:
+                    raise RecordError('Unknown model: %s.' %
+                                      record.get('model'))
+            except RecordError as e:
+                self.results[index] = _result(index, record, INVALID,
+                                              error=unicode(e))
+        # bulk_create and update() send no signals
+        if areas:
+            with transaction.atomic():
+                self.import_areas(areas)
+            versions.bump_models(Area)
+            versions.bump_areas(r['id'] for r in self.results
+                                if r is not None and r['status'] == CREATED)
+        for batch in _chunks(facilities, self.batch_size):
+            with transaction.atomic():
+                self.import_facilities(batch)
+        if facilities:
+            versions.bump_models(Facility)
+            versions.bump_rows(Facility, [
+                r['id'] for r in self.results if r['status'] == UPDATED])
+            versions.bump_areas(self.changed_area_ids)
+        return self.results
+
+    def load_areas(self, labels):
+        labels = list(set(labels).difference(self.areas))
+        for chunk in _chunks(labels, LOOKUP_CHUNK_SIZE):
+            for area in Area.objects.filter(area_label__in=chunk):
+                self.areas.setdefault(area.area_label, area)
+
+    def import_areas(self, pending):
+        self.load_areas(parent for _, _, (_, _, parent) in pending if parent)
+        # create the areas top-down, one level of the hierarchy per pass
+        while pending:
+            ready, waiting = [], []
+            for item in pending:
+                parent = item[2][2]
+                if not parent or parent in self.areas:
+                    ready.append(item)
+                else:
+                    waiting.append(item)
+            if not ready:
+                for index, record, _ in waiting:
+                    self.results[index] = _result(
+                        index, record, INVALID,
+                        error='Unknown area_parent: %s.' %
+                              record['area_parent'])
+                return
+            for batch in _chunks(ready, self.batch_size):
+                self.upsert_areas(batch)
+            pending = waiting
+
+    def upsert_areas(self, batch):
+        keyed = []
+        for index, record, (name, area_type, parent_label) in batch:
+            area = Area(area_name=name, area_type=area_type,
+                        area_parent=self.areas.get(parent_label))
+            if area.area_parent is None:
+                area.area_path, area.area_ancestry = u'/', u''
+            else:
+                parent = area.area_parent
+                area.area_path, area.area_ancestry = Area.child_tree_fields(
+                    parent.pk, parent.area_name, parent.area_path,
+                    parent.area_ancestry)
+            area.area_label = Area.make_label(name, area_type,
+                                              area.area_ancestry)
+            keyed.append((index, record, area, self.area_key(area)))
+        existing = self.existing_areas(key for _, _, _, key in keyed)
+        new = OrderedDict()
+        for index, record, area, key in keyed:
+            if key not in existing:
+                new.setdefault(key, area)
+        similar = self.similar(Area, new)
+        Area.objects.bulk_create(new.values())
+        stored = self.existing_areas(new)
+        search.index_objects(Area, stored.values())
+        self.remember(Area, stored.values())
+        for index, record, area, key in keyed:
+            if key in new:
+                area = stored[key]
+                self.results[index] = _result(index, record, CREATED, area,
+                                              similar=similar.get(key))
+                # report the later duplicates of the record as existing
+                del new[key]
+                existing[key] = area
+            else:
+                area = existing[key]
+                self.results[index] = _result(index, record, EXISTING, area)
+            self.areas.setdefault(area.area_label, area)
+
+    @staticmethod
+    def area_key(area):
+        return area.area_name, area.area_type, area.area_parent_id
+
+    def existing_areas(self, keys):
+        """Look the areas up by their natural keys (one query per chunk)."""
+        found = {}
+        for chunk in _chunks(list(set(keys)), LOOKUP_CHUNK_SIZE // 2):
+            names = set(name for name, _, _ in chunk)
+            parent_ids = set(parent_id for _, _, parent_id in chunk)
+            parents = Q(area_parent__isnull=True) if None in parent_ids \
+                else Q()
+            parent_ids.discard(None)
+            if parent_ids:
+                parents |= Q(area_parent__in=parent_ids)
+            for area in Area.objects.filter(parents, area_name__in=names):
+                found[self.area_key(area)] = area
+        return found
+
+    def import_facilities(self, batch):
+        self.load_areas(item[2][3] for item in batch if item[2][3])
+        keyed = []
+        for index, record, (name, facility_type, status, area_label,
+                            document) in batch:
+            if area_label and area_label not in self.areas:
+                self.results[index] = _result(
+                    index, record, INVALID,
+                    error='Unknown facility_area: %s.' % area_label)
+                continue
+            area = self.areas.get(area_label) if area_label else None
+            facility = Facility(
+                facility_name=name, facility_type=facility_type,
+                facility_status=status, facility_area=area, json=document,
+                has_json=document is not None,
+                facility_external_id=Facility.external_id_from_json(document))
+            keyed.append((index, record, facility,
+                          self.facility_key(facility)))
+        existing = self.existing_facilities(f for _, _, f, _ in keyed)
+        new = OrderedDict()
+        for index, record, facility, key in keyed:
+            stored = self.match(existing, facility, key)
+            if stored is not None:
+                existing[key] = stored
+                status = self.update_facility(stored, facility)
+                self.results[index] = _result(index, record, status,
+                                              existing[key])
+            else:
+                new.setdefault(key, facility)
+        similar = self.similar(Facility, new)
+        Facility.objects.bulk_create(new.values())
+        stored = self.existing_facilities(new.values())
+        self.remember(Facility, [stored[key] for key in new])
+        for index, record, facility, key in keyed:
+            if key in new:
+                self.results[index] = _result(index, record, CREATED,
+                                              stored[key],
+                                              similar=similar.get(key))
+                self.count_deltas[facility.count_key()] += 1
+                del new[key]
+                existing[key] = stored[key]
+            elif self.results[index] is None:
+                self.results[index] = _result(index, record, EXISTING,
+                                              existing[key])
+        # bulk_create and update() send no signals
+        self.changed_area_ids.update(
+            area_id for area_id, _, _ in self.count_deltas)
+        FacilityCount.objects.apply(self.count_deltas)
+        self.count_deltas.clear()
+        search.index_objects(Facility, [
+            existing[key] for index, _, _, key in keyed
+            if self.results[index]['status'] in (CREATED, UPDATED)])
+
+    def similar(self, model, new):
+        """Return the candidate matches among the stored objects of the
+        objects about to be created, for the keys of new which have any."""
+        name_field, block_field = fuzzy.FIELDS[model]
+        found = self.matchers[model].candidates(
+            (getattr(obj, block_field + '_id'), getattr(obj, name_field))
+            for obj in new.values())
+        return dict((key, candidates)
+                    for key, candidates in zip(new.keys(), found)
+                    if candidates)
+
+    def remember(self, model, created):
+        name_field, block_field = fuzzy.FIELDS[model]
+        for obj in created:
+            self.matchers[model].add(getattr(obj, block_field + '_id'),
+                                     obj.pk, getattr(obj, name_field))
+
+    @staticmethod
+    def facility_key(facility):
+        """Facilities with an external id are identified by it alone."""
+        if facility.facility_external_id is not None:
+            return (facility.facility_external_id,)
+        return BulkImporter.natural_key(facility)
+
+    @staticmethod
+    def natural_key(facility):
+        return (facility.facility_name, facility.facility_type,
+                facility.facility_area_id)
+
+    def match(self, existing, facility, key):
+        """The stored facility the imported one is, if any.  A facility with
+        an external id not stored yet is matched by its natural key to a
+        stored facility without one (e.g. imported before the external ids
+        were stored), which then gets the external id."""
+        stored = existing.get(key)
+        if stored is None and facility.facility_external_id is not None:
+            stored = existing.get(self.natural_key(facility))
+            if stored is not None and stored.facility_external_id is not None:
+                stored = None
+        return stored
+
+    def existing_facilities(self, facilities):
+        """Look the facilities up by their external ids and natural keys (two
+        queries per chunk).  Returns a dict mapping the keys to the
+        facilities."""
+        facilities = list(facilities)
+        found = {}
+        for chunk in _chunks(facilities, LOOKUP_CHUNK_SIZE // 2):
+            external_ids = set(f.facility_external_id for f in chunk
+                               if f.facility_external_id is not None)
+            # facilities with external ids too, for the fallback of match()
+            keys = set(self.natural_key(f) for f in chunk)
+            area_ids = set(area_id for _, _, area_id in keys)
+            areas = Q(facility_area__in=area_ids.difference([None]))
+            if None in area_ids:
+                areas |= Q(facility_area__isnull=True)
+            # the facilities sharing a name and an area with the chunk are
+            # narrowed down to its natural keys without loading any document
+            pks = [pk for pk, name, facility_type, area_id in
+                   Facility.objects.filter(
+                       areas, facility_name__in=set(
+                           name for name, _, _ in keys)).values_list(
+                       'pk', 'facility_name', 'facility_type',
+                       'facility_area')
+                   if (name, facility_type, area_id) in keys]
+            for facility in Facility.objects.filter(
+                    Q(facility_external_id__in=external_ids) |
+                    Q(pk__in=pks)):
+                if facility.facility_external_id is not None:
+                    found[(facility.facility_external_id,)] = facility
+                key = self.natural_key(facility)
+                # prefer the facility without an external id match() can use
+                if key not in found or \
+                        found[key].facility_external_id is not None:
+                    found[key] = facility
+        return found
+
+    def update_facility(self, stored, facility):
+        """Bring the stored facility up to date with the imported one."""
+        # the external id is copied from the document (see Facility.save)
+        fields = ['facility_status', 'json', 'has_json',
+                  'facility_external_id']
+        if facility.facility_external_id is not None:
+            fields += ['facility_name', 'facility_type']
+        changed = dict(
+            (f, getattr(facility, f)) for f in fields
+            if getattr(facility, f) != getattr(stored, f))
+        # compare the ids (getting stored.facility_area would run a query)
+        if facility.facility_external_id is not None and \
+                facility.facility_area_id != stored.facility_area_id:
+            changed['facility_area'] = facility.facility_area
+        if not changed:
+            return EXISTING
+        Facility.objects.filter(pk=stored.pk).update(**changed)
+        self.count_deltas[stored.count_key()] -= 1
+        for field, value in changed.items():
+            setattr(stored, field, value)
+        self.count_deltas[stored.count_key()] += 1
+        return UPDATED
+
+
+def import_records(records, batch_size=500):
+    """Import the records and return a list with a result for each record."""
+    return BulkImporter(batch_size).run(records)
+
+
+def summarise(results):
+    summary = {CREATED: 0, UPDATED: 0, EXISTING: 0, INVALID: 0}
+    for result in results:
+        summary[result['status']] += 1
+    return summary
@@ -0,0 +1,226 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Storage of the JSON documents of facilities and contacts and SQL filters on
+# the values stored in them.
+#
+# With FM_JSON_STORAGE = 'jsonb' (the default) the documents are stored in
+# jsonb columns on PostgreSQL and filtered with the containment operator (@>),
+# which is served by a GIN index.  Otherwise PostgreSQL stores them as json
+# and a filter compares (json #>> '{path}') while SQLite (for development)
+# compares json_extract(json, '$."path"'), which needs the JSON1 extension.
+# Both of the latter can use expression indexes on the paths listed in
+# FM_JSON_INDEXED_PATHS, e.g.:
+#
+#   FM_JSON_INDEXED_PATHS = {'fm.Facility': ['sector', 'lga', 'facility_id']}
+#
+# Paths are written the way they are passed to json_filter, with nested keys
+# separated by '__' (e.g. 'gps__latitude').
+
+import hashlib
+import json
+import re
+
+from django.conf import settings
+from django.db import connections, models
+from django.db.models.query import QuerySet
+
+from jsonfield import JSONField
+
+from fm import versions
+
+_KEY = re.compile(r'^[\w -]+$', re.UNICODE)
+
+
+def json_storage():
+    return getattr(settings, 'FM_JSON_STORAGE', 'jsonb')
+
+
+class DocumentField(JSONField):
+    """A JSONField stored as jsonb on PostgreSQL if so configured."""
+
+    def db_type(self, connection):
+        if (connection.vendor == 'postgresql' and json_storage() == 'jsonb'
+                and connection.pg_version >= 90400):
+            return 'jsonb'
+        return super(DocumentField, self).db_type(connection)
+
+
+def split_path(path):
+    """Split a json_filter path ('gps__latitude') into its keys."""
+    keys = path.split('__')
+    for key in keys:
+        if not _KEY.match(key):
+            raise ValueError('Unsupported key in JSON path: %r.' % path)
+    return keys
+
+
+def path_expression(connection, column, keys):
+    """The SQL expression extracting the value at the path from the column.
+    The path is inlined (not passed as a parameter) so that the expression
+    matches the one of the expression index on the path."""
+    if connection.vendor == 'sqlite':
+        return u"json_extract(%s, '$%s')" % (
+            column, u''.join(u'."%s"' % key for key in keys))
+    if connection.vendor == 'postgresql':
+        return u"(%s #>> '{%s}')" % (column, u','.join(keys))
+    raise NotImplementedError('JSON path queries are not supported by %s.' %
+                              connection.vendor)
+
+
+def uses_containment(connection, field):
+    return field.db_type(connection) == 'jsonb'
+
+
+def _nested(keys, value):
+    for key in reversed(keys):
+        value = {key: value}
+    return value
+
+
+def _merge(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+def _sql_value(connection, value):
+    """The value as returned by the path expression."""
+    if connection.vendor == 'postgresql':
+        # #>> returns text
+        return value if isinstance(value, basestring) else json.dumps(value)
+    return int(value) if isinstance(value, bool) else value
+
+
+class DocumentQuerySet(QuerySet):
+    def json_filter(self, field_name='json', **paths):
+        """Filter by the values stored at the paths of the JSON documents,
+        e.g. json_filter(sector='health', lga='Dala', gps__elevation=480).
+        """
+        connection = connections[self.db]
+        field = self.model._meta.get_field(field_name)
+        qn = connection.ops.quote_name
+        column = u'%s.%s' % (qn(self.model._meta.db_table), qn(field.column))
+        where, params = [], []
+        if uses_containment(connection, field):
+            document = {}
+            for path, value in sorted(paths.items()):
+                _merge(document, _nested(split_path(path), value))
+            where.append(u'%s @> %%s::jsonb' % column)
+            params.append(json.dumps(document))
+        else:
+            for path, value in sorted(paths.items()):
+                expression = path_expression(connection, column,
+                                             split_path(path))
+                if value is None:
+                    where.append(u'%s IS NULL' % expression)
+                else:
+                    where.append(u'%s = %%s' % expression)
+                    params.append(_sql_value(connection, value))
+        return self.extra(where=where, params=params)
+
+
+class DocumentManager(models.Manager):
+    def get_queryset(self):
+        return DocumentQuerySet(self.model, using=self._db)
+
+    def json_filter(self, field_name='json', **paths):
+        return self.get_queryset().json_filter(field_name, **paths)
+
+    def rebuild_has_json(self, field_name='json'):
+        """Set the has_json flag of every row from whether its document is
+        set (for models keeping one, see fm.models).  Returns the number of
+        rows updated."""
+        isnull = field_name + '__isnull'
+        updated = self.filter(**{isnull: False}).exclude(
+            has_json=True).update(has_json=True)
+        updated += self.filter(**{isnull: True}).exclude(
+            has_json=False).update(has_json=False)
+        if updated:
+            versions.bump_models(self.model)
+        return updated
+
+
+def indexed_paths(model):
+    paths = getattr(settings, 'FM_JSON_INDEXED_PATHS', {})
+    return paths.get('%s.%s' % (model._meta.app_label,
+                                model._meta.object_name), None)
+
+
+def index_statements(connection, model, field_name='json'):
+    """Return (index name, CREATE INDEX statement) pairs for the indexes on
+    the JSON documents of the model configured in FM_JSON_INDEXED_PATHS."""
+    paths = indexed_paths(model)
+    if paths is None:
+        return []
+    field = model._meta.get_field(field_name)
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    if uses_containment(connection, field):
+        name = '%s_%s_gin' % (table, field.column)
+        return [(name, 'CREATE INDEX %s ON %s USING gin (%s jsonb_path_ops)' %
+                 (qn(name), qn(table), qn(field.column)))]
+    statements = []
+    for path in paths:
+        name = '%s_%s_%s' % (table, field.column,
+                             hashlib.md5(path.encode('utf-8')).hexdigest()[:8])
+        expression = path_expression(connection, qn(field.column),
+                                     split_path(path))
+        statements.append((name, u'CREATE INDEX %s ON %s (%s)' % (
+            qn(name), qn(table), expression)))
+    return statements
+
+
+def _index_exists(cursor, connection, name):
+    if connection.vendor == 'sqlite':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND"
+                       " name = %s", [name])
+    else:
+        cursor.execute("SELECT 1 FROM pg_class WHERE relkind = 'i' AND"
+                       " relname = %s", [name])
+    return cursor.fetchone() is not None
+
+
+def create_indexes(models_with_documents, using='default'):
+    """Create the missing JSON indexes.  Returns the names of the indexes
+    created."""
+    connection = connections[using]
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return []
+    cursor = connection.cursor()
+    created = []
+    for model in models_with_documents:
+        for name, statement in index_statements(connection, model):
+            if not _index_exists(cursor, connection, name):
+                cursor.execute(statement)
+                created.append(name)
+    return created
+
+
+def convert_columns(models_with_documents, using='default',
+                    field_name='json'):
+    """Change the type of the existing JSON columns on PostgreSQL to the one
+    of the current storage mode.  Returns the names of the tables changed."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return []
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    converted = []
+    for model in models_with_documents:
+        field = model._meta.get_field(field_name)
+        table = model._meta.db_table
+        db_type = field.db_type(connection)
+        cursor.execute('SELECT data_type FROM information_schema.columns'
+                       ' WHERE table_name = %s AND column_name = %s',
+                       [table, field.column])
+        row = cursor.fetchone()
+        if row is not None and row[0] != db_type:
+            cursor.execute('ALTER TABLE %s ALTER COLUMN %s TYPE %s USING'
+                           ' %s::%s' % (qn(table), qn(field.column), db_type,
+                                        qn(field.column), db_type))
+            converted.append(table)
+    return converted
@@ -0,0 +1,20 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.db.models.signals import post_syncdb
+from django.dispatch import receiver
+
+from fm import jsondb, models, search
+
+
+@receiver(post_syncdb, sender=models)
+def create_json_indexes(sender, db, verbosity=1, **kwargs):
+    for name in jsondb.create_indexes([models.Facility, models.Contact], db):
+        if verbosity >= 2:
+            print 'Created index %s' % name
+
+
+@receiver(post_syncdb, sender=models)
+def create_search_index(sender, db, verbosity=1, **kwargs):
+    if search.create_index(db) and verbosity >= 2:
+        print 'Created the full-text search index'
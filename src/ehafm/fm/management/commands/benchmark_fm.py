@@ -0,0 +1,48 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import io
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from fm import benchmark
+
+
+class Command(NoArgsCommand):
+    help = ('Times and counts the queries of every fm URL and of the stages'
+            ' of the importer against the current database (see'
+            ' generate_fm_data) and writes the results as JSON.  Leaves the'
+            ' database unchanged.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Number of times each request is timed.'),
+        make_option('--cold', action='store_true', dest='cold',
+                    default=False,
+                    help='Time every request without the data cached '
+                         'by fm (the cache is not cleared).'),
+        make_option('--no-importer', action='store_false', dest='importer',
+                    default=True, help='Skip the importer stages.'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write the results to (standard output by'
+                         ' default).'),
+    )
+
+    def handle_noargs(self, **options):
+        results = benchmark.run(options['repeat'], options['cold'],
+                                options['importer'])
+        content = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(unicode(content) + u'\n')
+            for view in results['views']:
+                self.stdout.write('%-28s %4d %8.4fs %5d queries' % (
+                    view['label'], view['status'], view['median_seconds'],
+                    view['queries'][-1]))
+            for stage in results.get('importer', ()):
+                self.stdout.write('%-28s %9d %8.4fs %5d queries' % (
+                    stage['stage'], stage['records'], stage['median_seconds'],
+                    stage['queries'][-1]))
+        else:
+            self.stdout.write(content)
@@ -0,0 +1,37 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from fm import synthetic
+
+
+class Command(NoArgsCommand):
+    help = ('Generates a synthetic national data set (36 states, ~770 LGAs,'
+            ' ~9k wards, ~30k facilities, contacts and roles) for measuring'
+            ' performance.  The same seed always generates the same data and'
+            ' running the command again with it changes nothing.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Seed of the random number generator.'),
+        make_option('--scale', type='float', dest='scale', default=1.0,
+                    help='Multiplies the number of states (e.g. 0.1 for'
+                         ' about a tenth of the data set).'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of records inserted per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        data = synthetic.generate(options['seed'], options['scale'])
+        counts = data.counts()
+        self.stdout.write('Generated %(areas)d areas, %(facilities)d'
+                          ' facilities, %(contacts)d contacts and %(roles)d'
+                          ' roles.' % counts)
+        results, contacts, roles = synthetic.load(data, options['batch_size'])
+        created = sum(1 for r in results if r['status'] == 'created')
+        self.stdout.write('Stored %d new areas and facilities, %d new'
+                          ' contacts and %d new roles.' % (created, contacts,
+                                                           roles))
@@ -0,0 +1,45 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import io
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fm.importer import import_records, parse_records, summarise, RecordError
+from fm.importer import INVALID
+
+
+class Command(BaseCommand):
+    args = '<file.json|file.ndjson|->'
+    help = ('Imports areas and facilities from a JSON array or NDJSON file'
+            ' (see fm/importer.py for the record format).  Use - to read'
+            ' from the standard input.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of records inserted per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: import_fm_records %s' % self.args)
+        if args[0] == '-':
+            content = sys.stdin.read()
+        else:
+            with io.open(args[0], 'rb') as f:
+                content = f.read()
+        try:
+            records = parse_records(content)
+        except RecordError as e:
+            raise CommandError(unicode(e))
+        results = import_records(records, options['batch_size'])
+        for result in results:
+            if result['status'] == INVALID:
+                self.stderr.write('record %d: %s' % (result['index'],
+                                                     result['error']))
+        summary = summarise(results)
+        self.stdout.write('%(created)d created, %(updated)d updated,'
+                          ' %(existing)d already up to date,'
+                          ' %(invalid)d invalid.' % summary)
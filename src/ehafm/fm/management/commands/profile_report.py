@@ -0,0 +1,42 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from fm import profiling
+
+
+class Command(NoArgsCommand):
+    help = ('Lists the functions taking the most time across the profiles'
+            ' stored by fm.profiling.ProfilerMiddleware in FM_PROFILE_DIR.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dir', dest='directory', default=None,
+                    help='Directory of the profiles (FM_PROFILE_DIR by'
+                         ' default).'),
+        make_option('--view', dest='view', default=None,
+                    help='Only the profiles of the view (URL name).'),
+        make_option('--sort', dest='sort', default='self',
+                    choices=['self', 'cumulative'],
+                    help='Sort by the time spent in the functions themselves'
+                         ' (self, default) or in them and their callees'
+                         ' (cumulative).'),
+        make_option('--limit', type='int', dest='limit', default=20,
+                    help='Number of functions listed.'),
+    )
+
+    def handle_noargs(self, **options):
+        profiles = list(profiling.read_profiles(options['directory']))
+        count, functions = profiling.hot_functions(
+            profiles, options['sort'], options['limit'], options['view'])
+        if not count:
+            raise CommandError('No profiles found.')
+        views = sorted(set(p['view'] for p in profiles
+                           if options['view'] in (None, p['view'])))
+        self.stdout.write('%d profiles of %s' % (count, ', '.join(views)))
+        self.stdout.write('%10s %10s %8s  %s' % ('self (s)', 'cumul (s)',
+                                                 'profiles', 'function'))
+        for name, own, total, seen in functions:
+            self.stdout.write('%10.4f %10.4f %8d  %s' % (own, total, seen,
+                                                         name))
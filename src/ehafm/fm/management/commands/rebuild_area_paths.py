@@ -0,0 +1,16 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.management.base import NoArgsCommand
+
+from fm.models import Area
+
+
+class Command(NoArgsCommand):
+    help = ('Recomputes the materialised ancestry (path and label) stored for'
+            ' every area.  Needed only after the areas table has been'
+            ' modified bypassing Area.save().')
+
+    def handle_noargs(self, **options):
+        updated = Area.objects.rebuild_paths()
+        self.stdout.write('%d area(s) updated.' % updated)
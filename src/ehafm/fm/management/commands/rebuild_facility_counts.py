@@ -0,0 +1,17 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.management.base import NoArgsCommand
+
+from fm.models import FacilityCount
+
+
+class Command(NoArgsCommand):
+    help = ('Recounts the facilities by type and status in every area.'
+            '  Needed once after upgrading an existing database and after'
+            ' the facilities or areas tables have been modified bypassing'
+            ' the models.')
+
+    def handle_noargs(self, **options):
+        stored = FacilityCount.objects.rebuild()
+        self.stdout.write('%d count(s) stored.' % stored)
@@ -0,0 +1,21 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.management.base import NoArgsCommand
+
+from fm.models import Facility
+
+
+class Command(NoArgsCommand):
+    help = ('Copies the facility_id of the JSON document of every facility'
+            ' into its external id, by which the importer recognises it.'
+            '  Needed once after upgrading a database holding imported'
+            ' facilities and after the facilities table has been modified'
+            ' bypassing Facility.save().')
+
+    def handle_noargs(self, **options):
+        updated, duplicates = Facility.objects.rebuild_external_ids()
+        for pk, external_id in duplicates:
+            self.stdout.write('Facility %d duplicates the facility_id %s of'
+                              ' another facility.' % (pk, external_id))
+        self.stdout.write('%d facility(ies) updated.' % updated)
@@ -0,0 +1,19 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.management.base import NoArgsCommand
+
+from fm.models import Contact, Facility
+
+
+class Command(NoArgsCommand):
+    help = ('Recomputes the has_json flag of every facility and contact.'
+            '  Needed once after upgrading a database holding JSON documents'
+            ' and after the facilities or contacts tables have been modified'
+            ' bypassing the models.')
+
+    def handle_noargs(self, **options):
+        for model in (Facility, Contact):
+            updated = model.objects.rebuild_has_json()
+            self.stdout.write('%d %s(s) updated.' % (
+                updated, model._meta.verbose_name))
@@ -0,0 +1,19 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from fm import search
+
+
+class Command(NoArgsCommand):
+    help = ('Recreates the search entries of all the areas, facilities and'
+            ' contacts (and the full-text index if it is missing).  Needed'
+            ' once after upgrading an existing database.')
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            search.create_index()
+            indexed = search.rebuild()
+        self.stdout.write('%d object(s) indexed.' % indexed)
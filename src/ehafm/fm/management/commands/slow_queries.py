@@ -0,0 +1,42 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from fm import slowlog
+
+
+class Command(NoArgsCommand):
+    help = ('Summarises the log of the slow SQL statements (FM_SLOW_QUERY_LOG)'
+            ' by statement, slowest total first, with the plan of the slowest'
+            ' run of each.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--log', dest='log', default=None,
+                    help='Log file (FM_SLOW_QUERY_LOG by default).'),
+        make_option('--full-scans', action='store_true', dest='full_scans',
+                    default=False,
+                    help='Only the statements reading whole tables.'),
+        make_option('--limit', type='int', dest='limit', default=10,
+                    help='Number of statements listed.'),
+    )
+
+    def handle_noargs(self, **options):
+        groups = slowlog.summary(slowlog.read_log(options['log']))
+        if options['full_scans']:
+            groups = [g for g in groups if g['full_scan']]
+        if not groups:
+            raise CommandError('No slow statements logged.')
+        for group in groups[:options['limit']]:
+            slowest = group['slowest']
+            self.stdout.write('%d x, %.3fs total, %.3fs max%s in %s' % (
+                group['count'], group['total'], group['max'],
+                ', FULL SCAN' if group['full_scan'] else '',
+                ', '.join(sorted(v or '-' for v in group['views']))))
+            self.stdout.write('  %s' % group['sql'])
+            if slowest['stack']:
+                self.stdout.write('  at %s' % slowest['stack'][0])
+            for line in (slowest['plan'] or
+                         slowest.get('plan_error') or '').splitlines():
+                self.stdout.write('    %s' % line)
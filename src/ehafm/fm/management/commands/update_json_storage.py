@@ -0,0 +1,30 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from fm import jsondb
+from fm.models import Contact, Facility
+
+
+class Command(NoArgsCommand):
+    help = ('Converts the JSON columns of facilities and contacts to the type'
+            ' of FM_JSON_STORAGE (PostgreSQL only) and creates the missing'
+            ' indexes configured in FM_JSON_INDEXED_PATHS.  New databases'
+            ' get both from syncdb.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+                    help='The database to update.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options['database']
+        with transaction.atomic(using=using):
+            for table in jsondb.convert_columns([Facility, Contact], using):
+                self.stdout.write('Converted the JSON column of %s.' % table)
+            for name in jsondb.create_indexes([Facility, Contact], using):
+                self.stdout.write('Created index %s.' % name)
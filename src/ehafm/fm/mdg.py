@@ -0,0 +1,463 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Retrieval of the MDG (Nigeria MDG Information System) LGA documents and their
+# transformation into the records accepted by the bulk import.  This module
+# depends on the standard library only so that it can be used both by
+# scripts/mdg_importer.py and on the server.
+
+import codecs
+import hashlib
+import httplib
+import json
+import os
+import re
+import tempfile
+import threading
+import urllib2
+import urlparse
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+# URL to get the data from
+MDG_URL = 'http://54.204.39.128/static/lgas/'
+
+# A list of names of all LGAs in Kano
+KANO_LGA_NAMES = [
+    'Ajingi',
+    'Albasu',
+    'Bagwai',
+    'Bebeji',
+    'Bichi',
+    'Bunkure',
+    'Dala',
+    'Dambatta',
+    'Dawakin-Kudu',
+    'Dawakin-Tofa',
+    'Doguwa',
+    'Fagge',
+    'Gabasawa',
+    'Garko',
+    'Garun Mallam',
+    'Gaya',
+    'Gazewa',
+    'Gwale',
+    'Gwarzo',
+    'Kabo',
+    'Kano-Municipal',
+    'Karaye',
+    'Kibiya',
+    'Kiru',
+    'Kumbotso',
+    'Kunchi',
+    'Kura',
+    'Madobi',
+    'Makoda',
+    'Minjibir',
+    'Nassarawa',
+    'Rano',
+    'Rimin Gado',
+    'Rogo',
+    'Shanono',
+    'Sumaila',
+    'Takai',
+    'Tarauni',
+    'Tofa',
+    'Tsanyawa',
+    'Tudun-Wada',
+    'Ungogo',
+    'Warawa',
+    'Wudil',
+]
+
+MANIFEST_NAME = 'manifest.json'
+
+DOWNLOADED = 'downloaded'
+CACHED = 'cached'
+NOT_MODIFIED = 'not modified'
+FAILED = 'failed'
+
+MDG_FACILITY_STATUS = 'unknown status; data imported from MDG'
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRUCTURE = re.compile(r'[\[\]{}"]')
+_STRING_END = re.compile(r'["\\]')
+
+
+class StreamingParseError(ValueError):
+    pass
+
+
+class _Stream(object):
+    """A text buffer filled on demand from a binary UTF-8 file object.  Text
+    before position is dropped whenever more text is read."""
+
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.position = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            raise StreamingParseError('Unexpected end of the document.')
+        chunk = self.fileobj.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.position:] + self.decoder.decode(
+            chunk, final=self.eof)
+        self.position = 0
+
+    def peek(self):
+        """Skip whitespace and return the next character (None at EOF)."""
+        while True:
+            self.position = _WHITESPACE.match(self.buffer,
+                                              self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return None
+            self.read_more()
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise StreamingParseError('Expected %r at offset %d.' % (
+                character, self.position))
+        self.position += 1
+
+    def decode_value(self, decoder=json.JSONDecoder()):
+        """Decode the next JSON value, reading as much as needed."""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.eof:
+                    raise StreamingParseError('Invalid JSON at offset %d.' %
+                                              self.position)
+                self.read_more()
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end < len(self.buffer) or self.eof:
+                self.position = end
+                return value
+            self.read_more()
+
+    def skip_value(self):
+        """Skip the next JSON value without decoding it."""
+        if self.peek() not in (u'{', u'['):
+            self.decode_value()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            pattern = _STRING_END if in_string else _STRUCTURE
+            match = pattern.search(self.buffer, self.position)
+            if match is None or (in_string and match.group() == u'\\' and
+                                 match.end() == len(self.buffer)):
+                self.position = len(self.buffer) if match is None else \
+                    match.start()
+                self.read_more()
+                continue
+            character = match.group()
+            self.position = match.end()
+            if in_string:
+                if character == u'\\':
+                    self.position += 1  # skip the escaped character
+                else:
+                    in_string = False
+            elif character == u'"':
+                in_string = True
+            elif character in u'{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+
+def iter_array_items(fileobj, key, chunk_size=65536):
+    """Yield the items of the array stored under key in the top level JSON
+    object read from the binary file object, one at a time.
+
+    Only the current item (plus one chunk of the file) is held in memory, so
+    memory use does not depend on the size of the document.
+    """
+    stream = _Stream(fileobj, chunk_size)
+    stream.expect(u'{')
+    if stream.peek() == u'}':
+        return
+    while True:
+        name = stream.decode_value()
+        stream.expect(u':')
+        if name == key:
+            stream.expect(u'[')
+            if stream.peek() == u']':
+                stream.position += 1
+            else:
+                while True:
+                    yield stream.decode_value()
+                    if stream.peek() == u']':
+                        stream.position += 1
+                        break
+                    stream.expect(u',')
+        else:
+            stream.skip_value()
+        if stream.peek() == u'}':
+            return
+        stream.expect(u',')
+
+
+def iter_facilities(fileobj, sectors=('health',), chunk_size=65536):
+    """Yield the facilities of an MDG LGA document belonging to one of the
+    sectors (all the facilities if sectors is None)."""
+    for facility in iter_array_items(fileobj, 'facilities', chunk_size):
+        if sectors is None or facility.get('sector') in sectors:
+            yield facility
+
+
+def lga_document_name(state_name, lga_name):
+    # json document names on mdg replace all spaces and - with underscores
+    lga = lga_name.lower().replace(' ', '_').replace('-', '_')
+    return '%s_%s.json' % (state_name.lower(), lga)
+
+
+def lga_document_url(document_name, base_url=MDG_URL):
+    return urlparse.urljoin(base_url, document_name)
+
+
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class DownloadManifest(object):
+    """ETag, size and checksum of every document downloaded to a directory.
+
+    The manifest is rewritten (atomically) after each download so that an
+    interrupted run can be resumed.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.entries = json.load(f)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def is_intact(self, name, path):
+        """True if the file matches the size and checksum recorded for it."""
+        entry = self.get(name)
+        return (entry is not None and os.path.exists(path) and
+                os.path.getsize(path) == entry['size'] and
+                file_checksum(path) == entry['sha256'])
+
+    def record(self, name, **entry):
+        with self.lock:
+            self.entries[name] = entry
+            _write_atomically(self.path, json.dumps(
+                self.entries, indent=2, sort_keys=True).encode('utf-8'))
+
+
+def _write_atomically(path, content):
+    handle, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(content)
+        _replace(temporary_path, path)
+    except Exception:
+        os.remove(temporary_path)
+        raise
+
+
+def _replace(source, destination):
+    if os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+class DocumentDownloader(object):
+    def __init__(self, directory, revalidate=False, timeout=60,
+                 chunk_size=65536):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.manifest = DownloadManifest(directory)
+        self.revalidate = revalidate
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    def fetch(self, url, name):
+        """Download url to name (in the directory) unless an intact copy is
+        already there.  Returns (name, status, error message)."""
+        path = os.path.join(self.directory, name)
+        entry = self.manifest.get(name)
+        intact = self.manifest.is_intact(name, path)
+        if intact and not (self.revalidate and entry.get('etag')):
+            return name, CACHED, None
+        request = urllib2.Request(url)
+        if intact:
+            request.add_header('If-None-Match', entry['etag'])
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if intact and e.code == 304:
+                return name, NOT_MODIFIED, None
+            return name, FAILED, unicode(e)
+        except (urllib2.URLError, httplib.HTTPException, IOError) as e:
+            return name, FAILED, unicode(e)
+        try:
+            return self._save(response, url, name, path)
+        except (httplib.HTTPException, IOError, ValueError) as e:
+            return name, FAILED, unicode(e)
+        finally:
+            response.close()
+
+    def _save(self, response, url, name, path):
+        checksum = hashlib.sha256()
+        size = 0
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory,
+                                                  prefix='.%s-' % name)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+            expected_size = response.info().getheader('Content-Length')
+            if expected_size is not None and int(expected_size) != size:
+                raise ValueError('Truncated download: %d of %s bytes.' %
+                                 (size, expected_size))
+            _replace(temporary_path, path)
+        except Exception:
+            os.remove(temporary_path)
+            raise
+        self.manifest.record(name, url=url, size=size,
+                             sha256=checksum.hexdigest(),
+                             etag=response.info().getheader('ETag'))
+        return name, DOWNLOADED, None
+
+
+def download_documents(documents, directory, workers=8, revalidate=False,
+                       timeout=60):
+    """Download the (url, name) documents to the directory using a pool of
+    worker threads.
+
+    Documents whose local copies match the manifest are skipped (or, with
+    revalidate, fetched only if their ETag has changed).  Returns a dict
+    mapping each name to (status, error message).
+    """
+    downloader = DocumentDownloader(directory, revalidate, timeout)
+    pool = ThreadPool(max(1, min(workers, len(documents))))
+    try:
+        results = pool.map(lambda d: downloader.fetch(*d), documents)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((name, (status, error)) for name, status, error in results)
+
+
+def reformat_name(name):
+    reformatted = name.replace('.', ' ').strip().title()
+    return re.sub(r' {2,}', r' ', reformatted)
+
+
+def area_label(name, area_type, ancestors=()):
+    """The label of an area (see Area.make_label), ancestors being the names
+    of its parent, grandparent, etc."""
+    return u'%s (%s%s)' % (name, area_type,
+                           u''.join(u' in %s' % a for a in ancestors))
+
+
+def ndjson_record(record):
+    """Serialise the record as an NDJSON line (unicode, keys sorted)."""
+    return unicode(json.dumps(record, ensure_ascii=False, sort_keys=True))
+
+
+def area_record(name, area_type, parent_label=None):
+    return ndjson_record({
+        'model': 'area',
+        'area_name': name,
+        'area_type': area_type,
+        'area_parent': parent_label,
+    })
+
+
+def transform_lga_document(task):
+    """Transform one LGA document into NDJSON import records.
+
+    The task is a (state name, LGA name, document path, sectors, facility
+    type) tuple.  Returns the (ward label, ward record) pairs in the order in
+    which the wards first appear in the document and the facility records in
+    document order.  Runs in the worker processes of transform_documents.
+    """
+    state_name, lga_name, path, sectors, facility_type = task
+    state_name, lga_name = reformat_name(state_name), reformat_name(lga_name)
+    lga_label = area_label(lga_name, 'LGA', [state_name])
+    wards = OrderedDict()
+    facilities = []
+    with open(path, 'rb') as document:
+        for facility in iter_facilities(document, sectors):
+            ward_name = reformat_name(facility['ward'])
+            ward_label = area_label(ward_name, 'Ward', [lga_name, state_name])
+            if ward_label not in wards:
+                wards[ward_label] = area_record(ward_name, 'Ward', lga_label)
+            facilities.append(ndjson_record({
+                'model': 'facility',
+                'facility_name': reformat_name(facility['facility_name']),
+                'facility_type': facility_type,
+                'facility_status': MDG_FACILITY_STATUS,
+                'facility_area': ward_label,
+                'json': facility,
+            }))
+    return wards.items(), facilities
+
+
+def transform_documents(state_name, documents, sectors=('health',),
+                        facility_type='Health Facility', processes=None):
+    """Transform the (LGA name, document path) documents of a state into a
+    list of NDJSON import records (parents before children).
+
+    The documents are sharded across a pool of processes (None meaning one
+    per CPU, 1 meaning no pool at all) and the results are merged in
+    document order, so the output does not depend on the number of
+    processes.  Wards are deduplicated by their labels during the merge.
+    """
+    tasks = [(state_name, lga_name, path, sectors, facility_type)
+             for lga_name, path in documents]
+    if processes == 1 or len(tasks) <= 1:
+        results = map(transform_lga_document, tasks)
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(transform_lga_document, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    state_name = reformat_name(state_name)
+    state_label = area_label(state_name, 'State')
+    lgas = OrderedDict()
+    wards = OrderedDict()
+    facilities = []
+    for (lga_name, _), (lga_wards, lga_facilities) in zip(documents,
+                                                         results):
+        lga_name = reformat_name(lga_name)
+        lgas.setdefault(area_label(lga_name, 'LGA', [state_name]),
+                        area_record(lga_name, 'LGA', state_label))
+        for ward_label, record in lga_wards:
+            wards.setdefault(ward_label, record)
+        facilities.extend(lga_facilities)
+    return ([area_record(state_name, 'State')] + lgas.values() +
+            wards.values() + facilities)
@@ -0,0 +1,232 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Per-view request metrics: wall time, database time, number of queries and
+# number of duplicate queries (the same SQL with the same parameters run more
+# than once in a request, usually an N+1 loop).
+#
+# QueryMetricsMiddleware records every request into histograms kept in the
+# memory of the process and, every FM_METRICS_FLUSH_INTERVAL seconds, adds
+# them to the totals kept in the Django cache, so that the metrics endpoint
+# reports all the worker processes (with a cache backend shared by them, see
+# CACHES in the settings).  The endpoint renders the totals in the Prometheus
+# text format.  A request running more than FM_QUERY_ALERT_THRESHOLD queries
+# is logged as a warning with its most duplicated queries.  The queries are
+# counted by the database backends in fm.backends (see fm.capture).
+
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from fm import capture
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets (the last bucket is +Inf)
+HISTOGRAMS = (
+    ('request_duration_seconds', 'Wall time of the requests.',
+     (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    ('request_db_duration_seconds', 'Time spent in database queries.',
+     (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
+    ('request_queries', 'Number of database queries per request.',
+     (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+)
+COUNTERS = (
+    ('request_duplicate_queries_total',
+     'Queries repeating an earlier query of the same request.'),
+    ('request_query_alerts_total',
+     'Requests with more queries than FM_QUERY_ALERT_THRESHOLD.'),
+)
+# sums of seconds are kept as integer numbers of microseconds (cache.incr
+# only accepts integers)
+SCALE = {
+    'request_duration_seconds': 1000000,
+    'request_db_duration_seconds': 1000000,
+    'request_queries': 1,
+}
+
+_VIEWS_KEY = 'fm:metrics:views'
+
+
+def alert_threshold():
+    """Number of queries above which a request is logged (None: never)."""
+    return getattr(settings, 'FM_QUERY_ALERT_THRESHOLD', 100)
+
+
+def flush_interval():
+    return getattr(settings, 'FM_METRICS_FLUSH_INTERVAL', 10)
+
+
+def _key(view, name, part):
+    return 'fm:metrics:%s:%s:%s' % (view, name, part)
+
+
+def _bucket(bounds, value):
+    for index, bound in enumerate(bounds):
+        if value <= bound:
+            return index
+    return len(bounds)
+
+
+def _incr(key, delta):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # the first value (or one evicted); if another process has just
+        # added it, add it to theirs
+        if not cache.add(key, delta, None):
+            cache.incr(key, delta)
+
+
+class Registry(object):
+    """The metrics recorded by this process since the last flush."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deltas = defaultdict(Counter)
+        self.views = set()
+        self.flushed = time.time()
+
+    def record(self, view, duration, db_duration, queries, duplicates,
+               alert):
+        values = {'request_duration_seconds': duration,
+                  'request_db_duration_seconds': db_duration,
+                  'request_queries': queries}
+        with self.lock:
+            deltas = self.deltas[view]
+            for name, _, bounds in HISTOGRAMS:
+                deltas[(name, _bucket(bounds, values[name]))] += 1
+                deltas[(name, 'sum')] += int(round(values[name] *
+                                                   SCALE[name]))
+            deltas[('request_duplicate_queries_total', 'sum')] += duplicates
+            deltas[('request_query_alerts_total', 'sum')] += int(alert)
+            self.views.add(view)
+        if time.time() - self.flushed >= flush_interval():
+            self.flush()
+
+    def flush(self):
+        """Add the metrics recorded since the last flush to the totals in the
+        cache."""
+        with self.lock:
+            deltas, self.deltas = self.deltas, defaultdict(Counter)
+            views = set(self.views)
+            self.flushed = time.time()
+        for view, counts in deltas.items():
+            for (name, part), delta in counts.items():
+                if delta:
+                    _incr(_key(view, name, part), delta)
+        # every flush merges all the views seen by this process, so a view
+        # lost by two processes updating the list at once comes back
+        known = cache.get(_VIEWS_KEY) or []
+        if not views.issubset(known):
+            cache.set(_VIEWS_KEY, sorted(views.union(known)), None)
+
+
+registry = Registry()
+
+
+def totals():
+    """Return {view: {(metric, part): total}} from the cache."""
+    views = cache.get(_VIEWS_KEY) or []
+    keys = {}
+    for view in views:
+        for name, _, bounds in HISTOGRAMS:
+            for part in range(len(bounds) + 1) + ['sum']:
+                keys[_key(view, name, part)] = (view, (name, part))
+        for name, _ in COUNTERS:
+            keys[_key(view, name, 'sum')] = (view, (name, 'sum'))
+    found = cache.get_many(keys.keys())
+    result = dict((view, Counter()) for view in views)
+    for key, (view, metric) in keys.items():
+        result[view][metric] = found.get(key, 0)
+    return result
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(prefix='fm_'):
+    """Render the totals of all the processes in the Prometheus text
+    exposition format."""
+    registry.flush()
+    data = totals()
+    lines = []
+    for name, help_text, bounds in HISTOGRAMS:
+        metric = prefix + name
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s histogram' % metric)
+        for view in sorted(data):
+            counts = data[view]
+            label = 'view="%s"' % _label(view)
+            cumulative = 0
+            for index, bound in enumerate(bounds):
+                cumulative += counts[(name, index)]
+                lines.append('%s_bucket{%s,le="%s"} %d' % (
+                    metric, label, _number(bound), cumulative))
+            cumulative += counts[(name, len(bounds))]
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, label,
+                                                         cumulative))
+            lines.append('%s_sum{%s} %s' % (
+                metric, label,
+                _number(counts[(name, 'sum')] / float(SCALE[name]))))
+            lines.append('%s_count{%s} %d' % (metric, label, cumulative))
+    for name, help_text in COUNTERS:
+        metric = prefix + name
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s counter' % metric)
+        for view in sorted(data):
+            lines.append('%s{view="%s"} %d' % (metric, _label(view),
+                                              data[view][(name, 'sum')]))
+    return '\n'.join(lines) + '\n'
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    if match.url_name:
+        return match.url_name
+    return '%s.%s' % (match.func.__module__,
+                      getattr(match.func, '__name__', 'view'))
+
+
+class QueryMetricsMiddleware(object):
+    """Record the wall time, database time, number of queries and number of
+    duplicate queries of every request (see the module comment)."""
+
+    def process_request(self, request):
+        request._fm_metrics = (time.time(), capture.start())
+
+    def process_response(self, request, response):
+        started = getattr(request, '_fm_metrics', None)
+        if started is None:
+            return response
+        del request._fm_metrics
+        start, queries = started
+        capture.stop(queries)
+        duration = time.time() - start
+        db_duration = queries.duration
+        repeated = queries.repeated()
+        duplicates = queries.duplicates()
+        view = view_name(request)
+        threshold = alert_threshold()
+        alert = threshold is not None and len(queries) > threshold
+        if alert:
+            logger.warning(
+                '%d queries (%d duplicates, %.3fs) in %s for %s; most'
+                ' repeated: %s', len(queries), duplicates, db_duration, view,
+                request.path,
+                '; '.join('%dx %s' % (count, sql[:200]) for sql, count in
+                          repeated.most_common(3)) or 'none')
+        registry.record(view, duration, db_duration, len(queries),
+                        duplicates, alert)
+        return response
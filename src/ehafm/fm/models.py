@@ -1,9 +1,17 @@
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
 
-from django.db import models
+from collections import Counter
 
-from jsonfield import JSONField
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from fm.jsondb import DocumentField, DocumentManager, DocumentQuerySet
+from fm.mdg import MDG_URL
 
 
 AREA_TYPES = (
@@ -14,16 +22,170 @@ AREA_TYPES = (
 )
 
 
+class AreaManager(models.Manager):
+    def rebuild_paths(self, areas=None):
+        """Recompute the stored ancestry of the given areas (all by default).
+
+        Parents which are not among the given areas are trusted to have their
+        own ancestry up to date.  Returns the number of areas updated.
+        """
+        if areas is None:
+            areas = self.all()
+        areas = dict((a.id, a) for a in areas)
+        outside_ids = set(a.area_parent_id for a in areas.values()
+                          if a.area_parent_id is not None and
+                          a.area_parent_id not in areas)
+        outside = self.in_bulk(outside_ids) if outside_ids else {}
+        computed = {}
+
+        def compute(area, visiting):
+            if area.id in computed:
+                return computed[area.id]
+            if area.area_parent_id is None:
+                tree_fields = (u'/', u'')
+            else:
+                if area.area_parent_id in visiting:
+                    raise ValueError('Cycle in the area hierarchy at %s.' %
+                                     area.area_parent_id)
+                parent = areas.get(area.area_parent_id)
+                if parent is None:
+                    parent = outside[area.area_parent_id]
+                    parent_fields = (parent.area_path, parent.area_ancestry)
+                else:
+                    parent_fields = compute(parent, visiting | {area.id})
+                tree_fields = Area.child_tree_fields(
+                    parent.id, parent.area_name, *parent_fields)
+            computed[area.id] = tree_fields
+            return tree_fields
+
+        updated = 0
+        for area in areas.values():
+            path, ancestry = compute(area, frozenset([area.id]))
+            label = Area.make_label(area.area_name, area.area_type, ancestry)
+            if (path, ancestry, label) != (area.area_path, area.area_ancestry,
+                                           area.area_label):
+                area.area_path = path
+                area.area_ancestry = ancestry
+                area.area_label = label
+                self.filter(pk=area.id).update(area_path=path,
+                                               area_ancestry=ancestry,
+                                               area_label=label)
+                updated += 1
+        return updated
+
+    def descendants_of(self, area, include_self=False):
+        """All the areas under the given one, at any depth (one query served
+        by the index on area_path)."""
+        descendants = Q(area_path__startswith=area.subtree_path)
+        if include_self:
+            descendants |= Q(pk=area.pk)
+        return self.filter(descendants)
+
+    def ancestors_of(self, area, include_self=False):
+        """The ancestors of the given area, from the root down."""
+        ids = area.ancestor_ids + ([area.pk] if include_self else [])
+        return self.filter(pk__in=ids).order_by('area_path')
+
+
 class Area(models.Model):
     area_name = models.TextField()
     area_type = models.CharField(max_length=32, choices=AREA_TYPES)
     area_parent = models.ForeignKey('self', related_name='area_children',
                                     default=None, null=True, blank=True,
                                     on_delete=models.SET_NULL)
+    # The ancestry is materialised on save (and cascaded to the descendants)
+    # so that labelling an area never has to walk the tree.  area_path holds
+    # the ids of the ancestors from the root down (e.g. '/1/5/'),
+    # area_ancestry the ' in Parent in Grandparent' part of the label.
+    area_path = models.CharField(max_length=255, default=u'/', db_index=True,
+                                 editable=False)
+    area_ancestry = models.TextField(default=u'', editable=False)
+    area_label = models.TextField(default=u'', db_index=True, editable=False)
+
+    objects = AreaManager()
+
+    class Meta:
+        # the natural key of an area (used by the bulk importer).  SQL
+        # treats NULLs as distinct, so this does not stop duplicate roots
+        # (area_parent NULL): two imports running at the same time can both
+        # create the same root area.
+        unique_together = (('area_name', 'area_type', 'area_parent'),)
 
     def __unicode__(self):
-        return u'%s (%s%s)' % (self.area_name, self.area_type,
-                               self._path(self._ancestry_chain()))
+        if self.pk is None:
+            # not saved yet so the stored ancestry has not been computed
+            ancestry = self._path(self._ancestry_chain())
+        else:
+            ancestry = self.area_ancestry
+        return self.make_label(self.area_name, self.area_type, ancestry)
+
+    @staticmethod
+    def make_label(name, area_type, ancestry):
+        return u'%s (%s%s)' % (name, area_type, ancestry)
+
+    @staticmethod
+    def child_tree_fields(parent_id, parent_name, parent_path,
+                          parent_ancestry):
+        return (u'%s%d/' % (parent_path, parent_id),
+                u' in %s%s' % (parent_name, parent_ancestry))
+
+    @property
+    def ancestor_ids(self):
+        return self.path_ids(self.area_path)
+
+    @staticmethod
+    def path_ids(path):
+        """The ids of the areas in an area_path (e.g. '/1/5/')."""
+        return [int(i) for i in path.split(u'/') if i]
+
+    @property
+    def subtree_path(self):
+        """Prefix of area_path shared by all the descendants of this area."""
+        return u'%s%d/' % (self.area_path, self.pk)
+
+    def clean(self):
+        if self.pk is not None and self.area_parent is not None and (
+                self.area_parent.pk == self.pk or
+                self.area_parent.area_path.startswith(self.subtree_path)):
+            raise ValidationError('An area cannot be its own ancestor.')
+
+    def save(self, *args, **kwargs):
+        previous = None
+        if self.pk is not None:
+            previous = Area.objects.filter(pk=self.pk).values_list(
+                'area_path', 'area_name').first()
+        if self.area_parent is None:
+            self.area_path, self.area_ancestry = u'/', u''
+        else:
+            parent = self.area_parent
+            if self.pk is not None and (
+                    parent.pk == self.pk or
+                    parent.area_path.startswith(self.subtree_path)):
+                raise ValueError('An area cannot be its own ancestor.')
+            self.area_path, self.area_ancestry = self.child_tree_fields(
+                parent.pk, parent.area_name, parent.area_path,
+                parent.area_ancestry)
+        self.area_label = self.make_label(self.area_name, self.area_type,
+                                          self.area_ancestry)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {
+                'area_path', 'area_ancestry', 'area_label'}
+        super(Area, self).save(*args, **kwargs)
+        from fm import versions
+        subtrees = self.ancestor_ids + [self.pk]
+        if previous is not None:
+            subtrees += self.path_ids(previous[0])
+        versions.bump_subtrees(subtrees)
+        if previous is not None and previous[0] != self.area_path:
+            # the facilities of the whole subtree have moved with the area
+            FacilityCount.objects.move_subtree(
+                self.pk, self.path_ids(previous[0]), self.ancestor_ids)
+        if previous is not None and previous != (self.area_path,
+                                                 self.area_name):
+            old_subtree_path = u'%s%d/' % (previous[0], self.pk)
+            Area.objects.rebuild_paths(Area.objects.filter(
+                area_path__startswith=old_subtree_path))
 
     def _ancestry_chain(self, chain=None):
         if chain is None:
@@ -46,6 +208,63 @@ class Area(models.Model):
             return u''
 
 
+class FacilityQuerySet(DocumentQuerySet):
+    def within(self, area, include_subareas=True):
+        """The facilities in the given area or, by default, anywhere under it
+        (one query: the areas are looked up by the index on area_path in a
+        subquery and the facilities by the index on facility_area)."""
+        if not include_subareas:
+            return self.filter(facility_area=area)
+        return self.filter(facility_area__in=Area.objects.descendants_of(
+            area, include_self=True))
+
+
+class FacilityManager(DocumentManager):
+    def get_queryset(self):
+        return FacilityQuerySet(self.model, using=self._db)
+
+    def within(self, area, include_subareas=True):
+        return self.get_queryset().within(area, include_subareas)
+
+    def rebuild_external_ids(self, chunk_size=None):
+        """Recompute the facility_external_id of every facility from its JSON
+        document (one query per chunk of facilities, plus one per change).
+        Needed once after upgrading a database holding facilities imported
+        before the external ids were stored.  A facility_id already taken by
+        a facility with a lower pk is left unset: the facility is a duplicate
+        to merge or delete.  Returns the number of facilities updated and
+        the (pk, facility_id) of the duplicates."""
+        from fm import versions
+        from fm.pagination import keyset_chunks
+        taken = set()
+        changes = {}
+        duplicates = []
+        for chunk in keyset_chunks(
+                self.only('pk', 'json', 'facility_external_id'), chunk_size):
+            for facility in chunk:
+                external_id = Facility.external_id_from_json(facility.json)
+                if external_id in taken:
+                    duplicates.append((facility.pk, external_id))
+                    external_id = None
+                elif external_id is not None:
+                    taken.add(external_id)
+                if external_id != facility.facility_external_id:
+                    changes[facility.pk] = external_id
+        with transaction.atomic():
+            # unset them all first so that no id is ever held by two rows
+            pks = sorted(changes)
+            for start in range(0, len(pks), 400):
+                self.filter(pk__in=pks[start:start + 400]).update(
+                    facility_external_id=None)
+            for pk in pks:
+                if changes[pk] is not None:
+                    self.filter(pk=pk).update(facility_external_id=changes[pk])
+        if changes:
+            versions.bump_models(Facility)
+            versions.bump_rows(Facility, changes)
+        return len(changes), duplicates
+
+
 class Facility(models.Model):
     FACILITY_TYPES = (
         ('State Store',) * 2,
@@ -63,20 +282,94 @@ class Facility(models.Model):
     # Set help_text to something else than empty but still invisible so that
     # the JSONField does not set it to its custom default (we want nothing
     # displayed).
-    json = JSONField(null=True, blank=True, help_text=' ')
+    json = DocumentField(null=True, blank=True, help_text=' ')
+    # Whether json is set, kept up to date on save so that the lists of
+    # facilities can defer loading the (large) JSON documents.
+    has_json = models.BooleanField(default=False, editable=False)
+    # Id of the facility in the data source it has been imported from (the
+    # MDG facility_id), copied from the JSON document on save.
+    facility_external_id = models.CharField(max_length=64, default=None,
+                                            null=True, blank=True,
+                                            unique=True, editable=False)
+
+    objects = FacilityManager()
+
+    class Meta:
+        index_together = (
+            # the natural key of a facility without an external id (an
+            # index only, not a constraint: two imports running at the same
+            # time can both create the same facility, see fm.importer)
+            ('facility_name', 'facility_type', 'facility_area'),
+            # filtering and keyset pagination of the list of facilities
+            # (sorted on a column, ties broken by the primary key; the area
+            # column is sorted on the joined area label, which is unindexed)
+            ('facility_name', 'id'),
+            ('facility_type', 'facility_status', 'id'),
+            ('facility_status', 'id'),
+            ('has_json', 'id'),
+        )
 
     def __unicode__(self):
-        name = str(self.facility_name)
-        if self.facility_status:
-            status = u' [%s]' % self.facility_status
+        if self.facility_area_id is None:
+            area_label = None
+        else:
+            area_label = unicode(self.facility_area)
+        return self.make_label(self.facility_name, self.facility_status,
+                               area_label)
+
+    @staticmethod
+    def make_label(name, status, area_label):
+        if status:
+            status = u' [%s]' % status
         else:
             status = u''
-        if self.facility_area is None:
+        if area_label is None:
             area = u''
         else:
-            area = u' in %s' % unicode(self.facility_area)
+            area = u' in %s' % area_label
         return u'%s%s%s' % (name, status, area)
 
+    @staticmethod
+    def external_id_from_json(document):
+        if isinstance(document, dict) and \
+                document.get('facility_id') not in (None, u''):
+            return unicode(document['facility_id'])[:64]
+        return None
+
+    def clean(self):
+        external_id = self.external_id_from_json(self.json)
+        if external_id is not None and Facility.objects.filter(
+                facility_external_id=external_id).exclude(
+                pk=self.pk).exists():
+            raise ValidationError('A facility with facility_id %s already'
+                                  ' exists.' % external_id)
+
+    def save(self, *args, **kwargs):
+        self.facility_external_id = self.external_id_from_json(self.json)
+        self.has_json = self.json is not None
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                previous = Facility.objects.filter(pk=self.pk).values_list(
+                    'facility_area', 'facility_type',
+                    'facility_status').first()
+            super(Facility, self).save(*args, **kwargs)
+            deltas = Counter({self.count_key(): 1})
+            if previous is not None:
+                deltas.subtract({previous: 1})
+            FacilityCount.objects.apply(deltas)
+        # bumped once committed, so that no other process caches the old
+        # data under the new versions (see bump_versions)
+        from fm import versions
+        versions.bump([versions.model_scope(Facility),
+                       versions.row_scope(Facility, self.pk)])
+        versions.bump_areas([self.facility_area_id,
+                             previous and previous[0]])
+
+    def count_key(self):
+        """The key of the FacilityCount rows the facility is counted in."""
+        return self.facility_area_id, self.facility_type, self.facility_status
+
 
 class Contact(models.Model):
     contact_name = models.TextField()
@@ -85,14 +378,25 @@ class Contact(models.Model):
     # Set help_text to something else than empty but still invisible so that
     # the JSONField does not set it to its custom default (we want nothing
     # displayed).
-    json = JSONField(null=True, blank=True, help_text=' ')
+    json = DocumentField(null=True, blank=True, help_text=' ')
+    has_json = models.BooleanField(default=False, editable=False)
+
+    objects = DocumentManager()
 
     def __unicode__(self):
-        if self.contact_email:
-            email = u' <%s>' % self.contact_email
+        return self.make_label(self.contact_name, self.contact_email)
+
+    @staticmethod
+    def make_label(name, email):
+        if email:
+            email = u' <%s>' % email
         else:
             email = u''
-        return unicode(self.contact_name + email)
+        return u'%s%s' % (name, email)
+
+    def save(self, *args, **kwargs):
+        self.has_json = self.json is not None
+        super(Contact, self).save(*args, **kwargs)
 
 
 class Role(models.Model):
@@ -117,3 +421,323 @@ class Role(models.Model):
         else:
             facility = u' @ %s' % unicode(self.role_facility)
         return u'%s%s' % (self.role_name, facility)
+
+
+class FacilityCountManager(models.Manager):
+    def apply(self, deltas):
+        """Apply the changes in the numbers of facilities directly in areas,
+        given as a {(area id, facility type, facility status): delta}
+        mapping, to the counts of those areas and all their ancestors."""
+        deltas = dict((key, delta) for key, delta in deltas.items()
+                      if delta and key[0] is not None)
+        if not deltas:
+            return
+        paths = dict(Area.objects.filter(
+            pk__in=set(area_id for area_id, _, _ in deltas)).values_list(
+            'pk', 'area_path'))
+        expanded = Counter()
+        for (area_id, facility_type, status), delta in deltas.items():
+            if area_id in paths:
+                for counted_id in Area.path_ids(paths[area_id]) + [area_id]:
+                    expanded[(counted_id, facility_type, status)] += delta
+        self._add(expanded)
+
+    def move_subtree(self, area_id, old_ancestor_ids, new_ancestor_ids):
+        """Move the counts of the subtree of an area from its old ancestors
+        to the new ones."""
+        left = set(old_ancestor_ids).difference(new_ancestor_ids)
+        joined = set(new_ancestor_ids).difference(old_ancestor_ids)
+        if not left and not joined:
+            return
+        deltas = Counter()
+        for facility_type, status, count in self.filter(
+                area=area_id).values_list('facility_type', 'facility_status',
+                                          'facility_count'):
+            for ancestor_id in left:
+                deltas[(ancestor_id, facility_type, status)] -= count
+            for ancestor_id in joined:
+                deltas[(ancestor_id, facility_type, status)] += count
+        self._add(deltas)
+
+    def _add(self, deltas, chunk_size=400, attempts=3):
+        """Add the deltas to the counts keyed by (area id, facility type,
+        facility status), with a few set-based queries (rows sharing a delta
+        are updated together).  Safe to run in concurrent transactions: the
+        rows are locked in primary key order (so two transactions wait for
+        each other instead of deadlocking) and a count inserted by another
+        transaction meanwhile is added to instead (see _create)."""
+        deltas = dict((key, delta) for key, delta in deltas.items() if delta)
+        if not deltas:
+            return
+        area_ids = sorted(set(key[0] for key in deltas))
+        stored = {}
+        for start in range(0, len(area_ids), chunk_size):
+            for row in self.filter(
+                    area__in=area_ids[start:start + chunk_size]).values_list(
+                    'pk', 'area', 'facility_type', 'facility_status'):
+                stored[row[1:]] = row[0]
+        with transaction.atomic():
+            pks = sorted(stored[key] for key in deltas if key in stored)
+            locked = set()
+            for start in range(0, len(pks), chunk_size):
+                locked.update(self.select_for_update().filter(
+                    pk__in=pks[start:start + chunk_size]).order_by(
+                    'pk').values_list('pk', flat=True))
+            by_delta = {}
+            new = {}
+            for key, delta in sorted(deltas.items()):
+                # a count deleted meanwhile (down to 0) is created again
+                if stored.get(key) in locked:
+                    by_delta.setdefault(delta, []).append(stored[key])
+                elif delta > 0:
+                    new[key] = delta
+            for delta, pks in sorted(by_delta.items()):
+                for start in range(0, len(pks), chunk_size):
+                    self.filter(pk__in=pks[start:start + chunk_size]).update(
+                        facility_count=models.F('facility_count') + delta)
+            self._create(new, chunk_size, attempts)
+            decremented = [pk for delta, pks in by_delta.items() if delta < 0
+                           for pk in pks]
+            for start in range(0, len(decremented), chunk_size):
+                self.filter(pk__in=decremented[start:start + chunk_size],
+                            facility_count__lte=0).delete()
+
+    def _create(self, counts, chunk_size=400, attempts=3):
+        """Insert the counts, given as a {(area id, facility type, facility
+        status): count} mapping.  If another transaction has inserted any of
+        them since they were looked up, add to the stored ones instead (up
+        to attempts times)."""
+        if not counts:
+            return
+        try:
+            with transaction.atomic():
+                self.bulk_create(
+                    FacilityCount(area_id=area_id, facility_type=facility_type,
+                                  facility_status=status, facility_count=count)
+                    for (area_id, facility_type, status), count in
+                    sorted(counts.items()))
+        except IntegrityError:
+            if attempts <= 1:
+                raise
+            self._add(counts, chunk_size, attempts - 1)
+
+    def rebuild(self):
+        """Recount the facilities of every area from scratch.  Returns the
+        number of counts stored."""
+        rows = Facility.objects.filter(facility_area__isnull=False).values(
+            'facility_area', 'facility_area__area_path', 'facility_type',
+            'facility_status').annotate(total=models.Count('pk'))
+        counts = Counter()
+        for row in rows:
+            for area_id in (Area.path_ids(row['facility_area__area_path']) +
+                            [row['facility_area']]):
+                counts[(area_id, row['facility_type'],
+                        row['facility_status'])] += row['total']
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(
+                FacilityCount(area_id=area_id, facility_type=facility_type,
+                              facility_status=status, facility_count=count)
+                for (area_id, facility_type, status), count in
+                sorted(counts.items()))
+        return len(counts)
+
+    def counts_for(self, area):
+        """The (facility type, facility status, number of facilities) in the
+        area and all its subareas (one indexed lookup)."""
+        return list(self.filter(area=area).order_by(
+            'facility_type', 'facility_status').values_list(
+            'facility_type', 'facility_status', 'facility_count'))
+
+
+class FacilityCount(models.Model):
+    """The number of facilities of a type and status in an area, including
+    its subareas at any depth.  Maintained incrementally as facilities and
+    areas are saved, moved and deleted."""
+    area = models.ForeignKey(Area, related_name='facility_counts')
+    facility_type = models.CharField(max_length=32)
+    facility_status = models.TextField()
+    facility_count = models.IntegerField(default=0)
+
+    objects = FacilityCountManager()
+
+    class Meta:
+        unique_together = (('area', 'facility_type', 'facility_status'),)
+
+
+class SearchEntry(models.Model):
+    """The searchable text of an area, facility or contact (see fm.search,
+    which keeps the full-text index over search_text)."""
+    KINDS = (
+        ('area', 'area'),
+        ('facility', 'facility'),
+        ('contact', 'contact'),
+    )
+
+    kind = models.CharField(max_length=16, choices=KINDS)
+    object_id = models.IntegerField()
+    search_text = models.TextField()
+
+    class Meta:
+        unique_together = (('kind', 'object_id'),)
+
+
+class ImportJob(models.Model):
+    """A background import of the MDG LGA documents of a state (see
+    fm.tasks), one ImportJobPart per LGA."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, PENDING),
+        (RUNNING, RUNNING),
+        (FINISHED, FINISHED),
+        # finished, but some of the LGAs could not be imported
+        (FAILED, FAILED),
+    )
+    # numbers of records kept for every part
+    COUNTS = ('parsed', 'inserted', 'updated', 'skipped', 'failed')
+
+    state_name = models.CharField(max_length=64)
+    sectors = models.CharField(max_length=255, default='health')
+    source_url = models.CharField(max_length=255, default=MDG_URL)
+    status = models.CharField(max_length=16, choices=STATUSES,
+                              default=PENDING)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True,
+                                   blank=True)
+
+    def __unicode__(self):
+        return u'Import of %s #%s' % (self.state_name, self.pk)
+
+    def sector_list(self):
+        return [s.strip() for s in self.sectors.split(',') if s.strip()]
+
+    def progress(self):
+        """The numbers of records of all the parts and the numbers of parts
+        per status (two queries)."""
+        totals = self.parts.aggregate(
+            **dict((name, models.Sum(name)) for name in self.COUNTS))
+        progress = dict((name, totals[name] or 0) for name in self.COUNTS)
+        progress['lgas'] = dict(self.parts.values_list('status').annotate(
+            models.Count('pk')))
+        return progress
+
+    def as_dict(self, parts=True):
+        """A JSON serialisable summary of the job and its progress."""
+        result = {
+            'id': self.pk,
+            'state_name': self.state_name,
+            'sectors': self.sector_list(),
+            'source_url': self.source_url,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created.isoformat(),
+            'finished': self.finished and self.finished.isoformat(),
+            'progress': self.progress(),
+        }
+        if parts:
+            result['parts'] = [part.as_dict()
+                               for part in self.parts.order_by('pk')]
+        return result
+
+
+class ImportJobPart(models.Model):
+    """The import of the document of one LGA of an ImportJob."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    RETRYING = 'retrying'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, PENDING),
+        (RUNNING, RUNNING),
+        # failed, to be run again
+        (RETRYING, RETRYING),
+        (FINISHED, FINISHED),
+        (FAILED, FAILED),
+    )
+
+    job = models.ForeignKey(ImportJob, related_name='parts')
+    lga_name = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUSES,
+                              default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    parsed = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.lga_name, self.status)
+
+    def as_dict(self):
+        result = dict((name, getattr(self, name)) for name in (
+            'id', 'lga_name', 'status', 'attempts', 'error') +
+            ImportJob.COUNTS)
+        result['finished'] = self.finished and self.finished.isoformat()
+        return result
+
+
+@receiver(pre_delete, sender=Area)
+def subtract_area_facility_counts(sender, instance, **kwargs):
+    # the facilities in the area become arealess (SET_NULL) and its subareas
+    # become roots so the whole subtree leaves the ancestors of the area
+    FacilityCount.objects.move_subtree(instance.pk, instance.ancestor_ids, [])
+
+
+@receiver(post_delete, sender=Facility)
+def subtract_facility_count(sender, instance, **kwargs):
+    FacilityCount.objects.apply({instance.count_key(): -1})
+
+
+@receiver(post_delete, sender=Area)
+def detach_area_descendants(sender, instance, **kwargs):
+    # the children of a deleted area have just lost their parent (SET_NULL) so
+    # the ancestry stored for the whole former subtree has to be recomputed
+    Area.objects.rebuild_paths(Area.objects.descendants_of(instance))
+
+
+# a facility is saved in a transaction and bumps its versions in save()
+@receiver([post_save, post_delete], sender=Area)
+@receiver(post_delete, sender=Facility)
+@receiver([post_save, post_delete], sender=Contact)
+@receiver([post_save, post_delete], sender=Role)
+def bump_versions(sender, instance, **kwargs):
+    from fm import versions
+    versions.bump([versions.model_scope(sender),
+                   versions.row_scope(sender, instance.pk)])
+
+
+@receiver(post_delete, sender=Area)
+def bump_deleted_area_subtrees(sender, instance, **kwargs):
+    from fm import versions
+    versions.bump_subtrees(instance.ancestor_ids + [instance.pk])
+
+
+@receiver(post_delete, sender=Facility)
+def bump_deleted_facility_subtrees(sender, instance, **kwargs):
+    from fm import versions
+    versions.bump_areas([instance.facility_area_id])
+
+
+@receiver(post_save, sender=Area)
+@receiver(post_save, sender=Facility)
+@receiver(post_save, sender=Contact)
+def update_search_entry(sender, instance, **kwargs):
+    from fm import search
+    search.index_objects(sender, [instance])
+
+
+@receiver(post_delete, sender=Area)
+@receiver(post_delete, sender=Facility)
+@receiver(post_delete, sender=Contact)
+def remove_search_entry(sender, instance, **kwargs):
+    from fm import search
+    search.remove_objects(sender, [instance.pk])
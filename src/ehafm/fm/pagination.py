@@ -0,0 +1,177 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Keyset (a.k.a. cursor) pagination on the primary key, or on a sort field
+# with the primary key breaking ties.  Unlike OFFSET based pagination the cost
+# of fetching a page does not depend on how deep into the table the page is.
+#
+# The cursor is the primary key of the last row of the previous page (the
+# after parameter) and, when sorting on a field, the value of that field in
+# the row (after_value, left out when the value is NULL).
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from django.utils.http import urlencode
+
+
+def default_page_size():
+    return getattr(settings, 'FM_PAGE_SIZE', 100)
+
+
+def max_page_size():
+    return getattr(settings, 'FM_MAX_PAGE_SIZE', 1000)
+
+
+def _positive_int(value, default):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, page_size, after, next_after,
+                 next_value=None, params=()):
+        self.object_list = object_list
+        self.page_size = page_size
+        self.after = after
+        self.next_after = next_after
+        self.next_value = next_value
+        # the other GET parameters (filters, sort order) of the page links
+        self.params = list(params)
+
+    @property
+    def first_query(self):
+        return urlencode(self.params + [('page_size', self.page_size)])
+
+    @property
+    def next_query(self):
+        params = self.params + [('after', self.next_after)]
+        if self.next_value is not None:
+            params.append(('after_value', self.next_value))
+        return urlencode(params + [('page_size', self.page_size)])
+
+    @property
+    def has_next(self):
+        return self.next_after is not None
+
+    @property
+    def has_previous(self):
+        return self.after is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _field(model, path):
+    """Return the model field at the end of a field__field lookup path."""
+    names = path.split('__')
+    for name in names[:-1]:
+        model = model._meta.get_field(name).rel.to
+    return model._meta.get_field(names[-1])
+
+
+def _value(obj, path):
+    for name in path.split('__'):
+        if obj is None:
+            return None
+        obj = getattr(obj, name)
+    return obj
+
+
+def _nulls_largest(queryset):
+    # PostgreSQL and Oracle sort NULLs after all the other values, SQLite and
+    # MySQL before them
+    vendor = connections[queryset.db].vendor
+    return vendor in ('postgresql', 'oracle')
+
+
+def _after(queryset, path, descending, value, after):
+    """Filter queryset, ordered on (path, pk), to the rows following the row
+    with the given value and primary key."""
+    cmp = 'lt' if descending else 'gt'
+    nulls_after = _nulls_largest(queryset) != descending
+    if value is None:
+        condition = Q(**{'%s__isnull' % path: True, 'pk__%s' % cmp: after})
+        if not nulls_after:
+            condition |= Q(**{'%s__isnull' % path: False})
+    else:
+        condition = Q(**{'%s__%s' % (path, cmp): value}) | Q(
+            **{path: value, 'pk__%s' % cmp: after})
+        if nulls_after:
+            condition |= Q(**{'%s__isnull' % path: True})
+    return queryset.filter(condition)
+
+
+def keyset_page(queryset, after=None, page_size=None, order_by=None,
+                after_value=None, params=()):
+    """Return the page of queryset holding the rows following the row with
+    pk == after.
+
+    order_by is a field (or field__field) path, optionally prefixed with '-'
+    for the descending order, to sort the rows on before the pk; after_value
+    is then the (string) value of that field in the row with pk == after.
+    """
+    page_size = min(_positive_int(page_size, default_page_size()),
+                    max_page_size())
+    after = _positive_int(after, None)
+    if not order_by or order_by.lstrip('-') == 'pk':
+        descending = False
+        path = None
+        queryset = queryset.order_by('pk')
+    else:
+        descending = order_by.startswith('-')
+        path = order_by.lstrip('-')
+        sign = '-' if descending else ''
+        queryset = queryset.order_by(order_by, sign + 'pk')
+    if after is not None:
+        if path is None:
+            queryset = queryset.filter(pk__gt=after)
+        else:
+            field = _field(queryset.model, path)
+            try:
+                value = None if after_value is None else \
+                    field.to_python(after_value)
+            except ValidationError:
+                # a mangled cursor: start from the first page
+                after = None
+            else:
+                queryset = _after(queryset, path, descending, value, after)
+    # fetch one extra row to find out if there is a next page
+    object_list = list(queryset[:page_size + 1])
+    next_after = next_value = None
+    if len(object_list) > page_size:
+        object_list = object_list[:page_size]
+        next_after = object_list[-1].pk
+        if path is not None:
+            next_value = _value(object_list[-1], path)
+    return KeysetPage(object_list, page_size, after, next_after, next_value,
+                      params)
+
+
+def request_page(request, queryset, order_by=None, params=()):
+    """Return the page of queryset selected by the after, after_value and
+    page_size GET parameters of the request."""
+    return keyset_page(queryset, request.GET.get('after'),
+                       request.GET.get('page_size'), order_by,
+                       request.GET.get('after_value'), params)
+
+
+def keyset_chunks(queryset, chunk_size=None, order_by=None):
+    """Yield the whole queryset, sorted as by keyset_page, as consecutive
+    lists of at most chunk_size rows, running one bounded query per chunk."""
+    after = after_value = None
+    while True:
+        page = keyset_page(queryset, after, chunk_size or max_page_size(),
+                           order_by, after_value)
+        if page.object_list:
+            yield page.object_list
+        if not page.has_next:
+            return
+        after, after_value = page.next_after, page.next_value
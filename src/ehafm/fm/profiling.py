@@ -0,0 +1,290 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Opt-in profiling of production requests.
+#
+# ProfilerMiddleware profiles a random FM_PROFILE_SAMPLE_RATE fraction of the
+# requests with cProfile.  With FM_PROFILE_SLOW_THRESHOLD set, every other
+# request is watched by a stack sampler instead (a thread taking a snapshot
+# of the stack of the request every FM_PROFILE_SAMPLE_INTERVAL seconds, which
+# costs far less than cProfile) and its samples are kept if the request takes
+# longer than the threshold.  Each kept profile is written to FM_PROFILE_DIR
+# as a JSON file holding the view name, the timings, the queries (with their
+# parameters redacted, see fm.capture) and the per-function statistics; only
+# the newest FM_PROFILE_KEEP files are kept.
+# The profile_report command aggregates the hottest functions over the
+# stored profiles.
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from fm import capture
+from fm.metrics import view_name
+
+# Maximum number of queries stored with a profile
+MAX_QUERIES = 500
+
+
+def sample_rate():
+    return getattr(settings, 'FM_PROFILE_SAMPLE_RATE', 0.0)
+
+
+def slow_threshold():
+    """Duration (in seconds) above which sampled requests are kept (None
+    disables the sampler)."""
+    return getattr(settings, 'FM_PROFILE_SLOW_THRESHOLD', None)
+
+
+def sample_interval():
+    return getattr(settings, 'FM_PROFILE_SAMPLE_INTERVAL', 0.005)
+
+
+def profile_dir():
+    return getattr(settings, 'FM_PROFILE_DIR',
+                   os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+def keep():
+    return getattr(settings, 'FM_PROFILE_KEEP', 200)
+
+
+def function_name(filename, lineno, name):
+    """file:line(function), or file(function) without a line, with the file
+    relative to the project if inside it."""
+    if not filename.startswith(('<', '~')):
+        base = os.path.abspath(settings.BASE_DIR) + os.sep
+        filename = os.path.abspath(filename)
+        if filename.startswith(base):
+            filename = filename[len(base):]
+    if lineno is None:
+        return '%s(%s)' % (filename, name)
+    return '%s:%d(%s)' % (filename, lineno, name)
+
+
+class StackSampler(object):
+    """Samples the stacks of the registered threads from a daemon thread,
+    which stops when no thread is left to sample."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.thread = None
+
+    def start(self, thread_id):
+        with self.lock:
+            self.samples[thread_id] = Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='fm-stack-sampler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self, thread_id):
+        """Stop sampling the thread; returns a Counter of its stacks (tuples
+        of (file, line, function), outermost first)."""
+        with self.lock:
+            return self.samples.pop(thread_id, Counter())
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.samples:
+                    self.thread = None
+                    return
+                for thread_id, samples in self.samples.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_filename, frame.f_lineno,
+                                      code.co_name))
+                        frame = frame.f_back
+                    if stack:
+                        samples[tuple(reversed(stack))] += 1
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = StackSampler(sample_interval())
+        return _sampler
+
+
+def cprofile_functions(profiler):
+    """Per-function statistics of a cProfile run."""
+    stats = pstats.Stats(profiler, stream=io.BytesIO())
+    functions = []
+    for (filename, lineno, name), (_, calls, tottime, cumtime, _) in \
+            stats.stats.items():
+        functions.append({'function': function_name(filename, lineno, name),
+                          'calls': calls, 'self': tottime,
+                          'cumulative': cumtime})
+    return functions
+
+
+def sampled_functions(samples, interval):
+    """Per-function statistics estimated from the stack samples: seconds on
+    top of the stack (self) and on the stack at all (cumulative).  Lines
+    are dropped so that all the samples of a function add up."""
+    own, total = Counter(), Counter()
+    for stack, count in samples.items():
+        names = [function_name(filename, None, name)
+                 for filename, _, name in stack]
+        own[names[-1]] += count
+        for name in set(names):
+            total[name] += count
+    return [{'function': name, 'samples': total[name],
+             'self': own[name] * interval,
+             'cumulative': total[name] * interval}
+            for name in total]
+
+
+def write_profile(profile, directory=None, limit=None):
+    """Write the profile to the directory and remove the oldest profiles
+    beyond the limit.  Returns the path of the new file."""
+    directory = directory or profile_dir()
+    limit = keep() if limit is None else limit
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = '%s-%s-%s.json' % (
+        time.strftime('%Y%m%dT%H%M%S', time.gmtime(profile['started'])),
+        ''.join(c if c.isalnum() or c in '-_.' else '_'
+                for c in profile['view']), uuid.uuid4().hex[:8])
+    path = os.path.join(directory, name)
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(unicode(json.dumps(profile)))
+    stored = sorted(f for f in os.listdir(directory) if f.endswith('.json'))
+    for old in stored[:max(0, len(stored) - limit)]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except OSError:
+            # removed by another process
+            pass
+    return path
+
+
+def read_profiles(directory=None):
+    directory = directory or profile_dir()
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            try:
+                with io.open(os.path.join(directory, name),
+                             encoding='utf-8') as f:
+                    yield json.loads(f.read())
+            except (IOError, ValueError):
+                # being written or rotated away
+                continue
+
+
+def hot_functions(profiles, sort='self', limit=20, view=None):
+    """Aggregate the functions of the profiles (of the given view only if
+    given).  Returns (number of profiles, [(function, self seconds,
+    cumulative seconds, number of profiles it appears in)]) sorted by self
+    or cumulative time."""
+    own, total, seen = Counter(), Counter(), Counter()
+    count = 0
+    for profile in profiles:
+        if view is not None and profile['view'] != view:
+            continue
+        count += 1
+        for function in profile['functions']:
+            name = function['function']
+            own[name] += function['self']
+            total[name] += function['cumulative']
+            seen[name] += 1
+    column = own if sort == 'self' else total
+    ranked = sorted(column, key=lambda n: (-column[n], n))[:limit]
+    return count, [(name, own[name], total[name], seen[name])
+                   for name in ranked]
+
+
+class ProfilerMiddleware(object):
+    """Profile sampled and slow requests (see the module comment).  Put it
+    last in MIDDLEWARE_CLASSES, so that it profiles the view and as little
+    of the other middleware as possible."""
+
+    def __init__(self):
+        if not sample_rate() and slow_threshold() is None:
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        mode = 'cprofile' if random.random() < sample_rate() else None
+        if mode is None and slow_threshold() is not None:
+            mode = 'sampling'
+            sampler().start(threading.current_thread().ident)
+        if mode is not None:
+            request._fm_profile = {'started': time.time(), 'mode': mode,
+                                   'queries': capture.start()}
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # the view is left to the handler (which wraps it in the transaction
+        # of ATOMIC_REQUESTS and the exception middleware), profiled from
+        # here to the response
+        state = getattr(request, '_fm_profile', None)
+        if state is not None and state['mode'] == 'cprofile':
+            state['profiler'] = cProfile.Profile()
+            state['profiler'].enable()
+        return None
+
+    def process_exception(self, request, exception):
+        self._stop_profiler(request)
+        return None
+
+    def _stop_profiler(self, request):
+        state = getattr(request, '_fm_profile', None)
+        if state is not None and 'profiler' in state:
+            state['profiler'].disable()
+
+    def process_response(self, request, response):
+        self._stop_profiler(request)
+        state = getattr(request, '_fm_profile', None)
+        if state is None:
+            return response
+        del request._fm_profile
+        duration = time.time() - state['started']
+        queries = capture.stop(state['queries'])
+        if state['mode'] == 'sampling':
+            samples = sampler().stop(threading.current_thread().ident)
+            if duration <= slow_threshold():
+                return response
+            functions = sampled_functions(samples, sample_interval())
+        elif 'profiler' in state:
+            functions = cprofile_functions(state['profiler'])
+        else:
+            return response
+        write_profile({
+            'started': state['started'],
+            'view': view_name(request),
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'mode': state['mode'],
+            'duration': duration,
+            'db_duration': queries.duration,
+            'query_count': len(queries),
+            'queries': queries.redacted(MAX_QUERIES),
+            'functions': functions,
+        })
+        return response
@@ -0,0 +1,210 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Full-text search over areas (area_name), facilities (facility_name) and
+# contacts (contact_name, contact_email and contact_phone).
+#
+# The searchable text of every object is kept in a SearchEntry row, updated on
+# save and delete (and by the bulk import).  The index over the entries is a
+# GIN index on to_tsvector('simple', search_text) on PostgreSQL and an FTS5
+# table kept in sync by triggers on SQLite; both are created on syncdb.  Other
+# databases (and SQLite without FTS5) fall back to unindexed substring
+# matching.  Every word of a query is matched as a prefix and the results are
+# ranked by relevance.
+
+import re
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connections, DatabaseError
+
+from fm.models import Area, Contact, Facility, SearchEntry
+
+FTS_TABLE = 'fm_searchentry_fts'
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def search_limit():
+    """Maximum number of search results."""
+    return getattr(settings, 'FM_SEARCH_LIMIT', 50)
+
+
+def _area_text(area):
+    return area.area_name
+
+
+def _facility_text(facility):
+    return facility.facility_name
+
+
+def _contact_text(contact):
+    return u' '.join([contact.contact_name, contact.contact_email,
+                      contact.contact_phone])
+
+
+# kind -> (model, function returning the searchable text of an object)
+SOURCES = {
+    'area': (Area, _area_text),
+    'facility': (Facility, _facility_text),
+    'contact': (Contact, _contact_text),
+}
+KINDS = dict((model, kind) for kind, (model, _) in SOURCES.items())
+
+
+def index_objects(model, objects, chunk_size=400):
+    """Create or replace the search entries of the objects."""
+    kind = KINDS[model]
+    text = SOURCES[kind][1]
+    entries = dict((obj.pk, SearchEntry(kind=kind, object_id=obj.pk,
+                                        search_text=text(obj)))
+                   for obj in objects)
+    remove_objects(model, entries.keys(), chunk_size)
+    SearchEntry.objects.bulk_create(entries.values())
+
+
+def remove_objects(model, pks, chunk_size=400):
+    pks = list(pks)
+    for start in range(0, len(pks), chunk_size):
+        SearchEntry.objects.filter(
+            kind=KINDS[model], object_id__in=pks[start:start + chunk_size]
+        ).delete()
+
+
+def rebuild(chunk_size=1000):
+    """Recreate the search entries of all the objects.  Returns the number of
+    entries."""
+    SearchEntry.objects.all().delete()
+    for model, _ in SOURCES.values():
+        objects = model.objects.order_by('pk')
+        if model is not Area:
+            objects = objects.defer('json')
+        last_pk = 0
+        while True:
+            chunk = list(objects.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            index_objects(model, chunk)
+            last_pk = chunk[-1].pk
+    return SearchEntry.objects.count()
+
+
+def words(query):
+    return [w.lower() for w in _WORD.findall(query)]
+
+
+def _fts5_available(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s",
+                   [FTS_TABLE])
+    return cursor.fetchone() is not None
+
+
+def matching_entries(query, limit=None, using='default'):
+    """Return the (kind, object id) pairs of the best matching entries."""
+    if limit is None:
+        limit = search_limit()
+    terms = words(query)
+    if not terms:
+        return []
+    connection = connections[using]
+    entries = SearchEntry.objects.using(using)
+    if connection.vendor == 'postgresql':
+        tsquery = u' & '.join(u'%s:*' % t for t in terms)
+        vector = "to_tsvector('simple', fm_searchentry.search_text)"
+        entries = entries.extra(
+            select={'rank': "ts_rank(%s, to_tsquery('simple', %%s))" % vector},
+            select_params=[tsquery],
+            where=["%s @@ to_tsquery('simple', %%s)" % vector],
+            params=[tsquery],
+            order_by=['-rank', 'id'])
+    elif connection.vendor == 'sqlite' and _fts5_available(connection):
+        entries = entries.extra(
+            tables=[FTS_TABLE],
+            where=['%s.rowid = fm_searchentry.id' % FTS_TABLE,
+                   '%s MATCH %%s' % FTS_TABLE],
+            params=[u' AND '.join(u'"%s"*' % t for t in terms)],
+            order_by=['%s.rank' % FTS_TABLE, 'id'])
+    else:
+        for term in terms:
+            entries = entries.filter(search_text__icontains=term)
+        entries = entries.order_by('id')
+    return list(entries.values_list('kind', 'object_id')[:limit])
+
+
+def _labels(kind, ids):
+    if kind == 'area':
+        return dict(Area.objects.filter(pk__in=ids).values_list(
+            'pk', 'area_label'))
+    if kind == 'facility':
+        rows = Facility.objects.filter(pk__in=ids).values_list(
+            'pk', 'facility_name', 'facility_status',
+            'facility_area__area_label')
+        return dict((pk, Facility.make_label(name, status, area_label))
+                    for pk, name, status, area_label in rows)
+    rows = Contact.objects.filter(pk__in=ids).values_list(
+        'pk', 'contact_name', 'contact_email')
+    return dict((pk, Contact.make_label(name, email))
+                for pk, name, email in rows)
+
+
+def _url(kind, pk):
+    if kind == 'facility':
+        return reverse('fm_facility_view', args=[pk])
+    if kind == 'area':
+        return reverse('fm_areas')
+    return reverse('fm_contacts')
+
+
+def search(query, limit=None, using='default'):
+    """Return up to limit results, best first, as dicts with the kind, id,
+    label and url of the matching objects."""
+    entries = matching_entries(query, limit, using)
+    ids = {}
+    for kind, pk in entries:
+        ids.setdefault(kind, []).append(pk)
+    labels = dict((kind, _labels(kind, kind_ids))
+                  for kind, kind_ids in ids.items())
+    return [{'kind': kind, 'id': pk, 'label': labels[kind][pk],
+             'url': _url(kind, pk)}
+            for kind, pk in entries if pk in labels[kind]]
+
+
+def create_index(using='default'):
+    """Create the full-text index over the search entries unless it exists.
+    Returns True if it has been created."""
+    connection = connections[using]
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT 1 FROM pg_class WHERE relkind = 'i' AND"
+                       " relname = 'fm_searchentry_tsv'")
+        if cursor.fetchone() is not None:
+            return False
+        cursor.execute("CREATE INDEX fm_searchentry_tsv ON fm_searchentry"
+                       " USING gin (to_tsvector('simple', search_text))")
+        return True
+    if connection.vendor != 'sqlite' or _fts5_available(connection):
+        return False
+    try:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE %(fts)s USING fts5(search_text,"
+            " content='fm_searchentry', content_rowid='id')" %
+            {'fts': FTS_TABLE})
+    except DatabaseError:
+        # SQLite compiled without FTS5: searches fall back to LIKE
+        return False
+    for statement in (
+            "CREATE TRIGGER %(fts)s_ai AFTER INSERT ON fm_searchentry BEGIN"
+            " INSERT INTO %(fts)s(rowid, search_text)"
+            " VALUES (new.id, new.search_text); END",
+            "CREATE TRIGGER %(fts)s_ad AFTER DELETE ON fm_searchentry BEGIN"
+            " INSERT INTO %(fts)s(%(fts)s, rowid, search_text)"
+            " VALUES ('delete', old.id, old.search_text); END",
+            "CREATE TRIGGER %(fts)s_au AFTER UPDATE ON fm_searchentry BEGIN"
+            " INSERT INTO %(fts)s(%(fts)s, rowid, search_text)"
+            " VALUES ('delete', old.id, old.search_text);"
+            " INSERT INTO %(fts)s(rowid, search_text)"
+            " VALUES (new.id, new.search_text); END",
+            "INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')"):
+        cursor.execute(statement % {'fts': FTS_TABLE})
+    return True
@@ -0,0 +1,280 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Log of the slow SQL statements.
+#
+# The database backends in fm.backends (use e.g. 'fm.backends.sqlite3' or
+# 'fm.backends.postgresql_psycopg2' as the ENGINE of a database) time every
+# statement.  A statement taking at least FM_SLOW_QUERY_THRESHOLD seconds is
+# written as a line of JSON to FM_SLOW_QUERY_LOG, a file rotated once it grows
+# over FM_SLOW_QUERY_LOG_MAX_BYTES (FM_SLOW_QUERY_LOG_BACKUPS old files are
+# kept), together with:
+#   - its parameters, with all but numbers, booleans and None redacted,
+#   - the view of the request running it (see SlowQueryMiddleware) and the
+#     innermost frames of the project calling it,
+#   - its plan (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on PostgreSQL and
+#     MySQL, EXPLAIN ANALYZE for SELECTs on PostgreSQL if
+#     FM_SLOW_QUERY_ANALYZE is set, which runs them a second time).
+# The slow_queries command summarises the log.  The same cursors hand the
+# statements to the captures of fm.capture.
+
+import json
+import logging.handlers
+import os
+import re
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db.backends import util
+
+from fm import capture
+from fm.capture import redact
+from fm.metrics import view_name
+from fm.profiling import function_name
+
+# Number of frames of the project stored with a statement
+STACK_DEPTH = 8
+# Statements with a plan (EXPLAIN of anything else fails or means nothing)
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+# Lists of placeholders (IN clauses)
+_PLACEHOLDERS = re.compile(r'%s(?:, %s)+')
+
+_local = threading.local()
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def threshold():
+    """Duration (in seconds) from which statements are logged (None: none
+    is)."""
+    return getattr(settings, 'FM_SLOW_QUERY_THRESHOLD', None)
+
+
+def analyze():
+    return getattr(settings, 'FM_SLOW_QUERY_ANALYZE', False)
+
+
+def log_path():
+    return getattr(settings, 'FM_SLOW_QUERY_LOG',
+                   os.path.join(settings.BASE_DIR, 'slow_queries.log'))
+
+
+def caller_frames(stack=None):
+    """The innermost frames of the project (neither of Django nor of this
+    module) in the stack, innermost first."""
+    if stack is None:
+        stack = traceback.extract_stack()
+    base = os.path.abspath(settings.BASE_DIR) + os.sep
+    here = os.path.dirname(os.path.abspath(__file__))
+    skipped = (os.path.join(here, 'slowlog.py'),
+               os.path.join(here, 'backends') + os.sep)
+    frames = []
+    for filename, lineno, name, _ in reversed(stack):
+        path = os.path.abspath(filename)
+        if path.startswith(base) and not path.startswith(skipped):
+            frames.append(function_name(filename, lineno, name))
+            if len(frames) == STACK_DEPTH:
+                break
+    return frames
+
+
+def full_scan(vendor, plan):
+    """Whether the plan reads a whole table (a missing index, unless the
+    table is small)."""
+    if plan is None:
+        return False
+    if vendor == 'sqlite':
+        # 'SCAN TABLE t' before SQLite 3.36, 'SCAN t' since; scans of an
+        # index, of a subquery or of a constant row are no table scans
+        return any(line.strip().startswith('SCAN ') and
+                   not any(word in line for word in ('USING', 'SUBQUERY',
+                                                     'CONSTANT ROW'))
+                   for line in plan.splitlines())
+    if vendor == 'postgresql':
+        return 'Seq Scan' in plan
+    return False
+
+
+def explain(connection, sql, params):
+    """The plan of the statement as text, None if the database cannot
+    explain it.  Raises the error of EXPLAIN if it fails."""
+    statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    if statement not in EXPLAINABLE:
+        return None
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE ' if analyze() and \
+            statement == 'SELECT' else 'EXPLAIN '
+    elif connection.vendor == 'mysql':
+        prefix = 'EXPLAIN '
+    else:
+        return None
+    # a cursor of the database itself: neither logged nor timed
+    cursor = connection._cursor()
+    # a failed statement aborts the transaction it runs in on PostgreSQL
+    savepoint = connection.vendor == 'postgresql' and \
+        not connection.get_autocommit()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT fm_slowlog_explain')
+        try:
+            if params is None:
+                cursor.execute(prefix + sql)
+            else:
+                cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+        except Exception:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT fm_slowlog_explain')
+            raise
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT fm_slowlog_explain')
+    finally:
+        cursor.close()
+    if connection.vendor == 'sqlite':
+        # (id, parent, notused, detail)
+        return u'\n'.join(unicode(row[-1]) for row in rows)
+    return u'\n'.join(u' | '.join(unicode(column) for column in row)
+                      for row in rows)
+
+
+def _handler(path):
+    with _handlers_lock:
+        handler = _handlers.get(path)
+        if handler is None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=getattr(settings, 'FM_SLOW_QUERY_LOG_MAX_BYTES',
+                                       5 * 1024 * 1024),
+                backupCount=getattr(settings, 'FM_SLOW_QUERY_LOG_BACKUPS', 3),
+                encoding='utf-8', delay=True)
+            _handlers[path] = handler
+        return handler
+
+
+def record(connection, sql, params, duration, many=False):
+    """Log the statement (see the module comment) and return the entry."""
+    request = getattr(_local, 'request', None)
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'duration': round(duration, 6),
+        'database': connection.alias,
+        'vendor': connection.vendor,
+        'sql': sql,
+        'params': None if many else redact(params),
+        'executemany': many,
+        'view': None if request is None else view_name(request),
+        'path': None if request is None else request.path,
+        'stack': caller_frames(),
+        'plan': None,
+    }
+    if not many:
+        try:
+            entry['plan'] = explain(connection, sql, params)
+        except Exception as e:
+            # errors of the driver itself (the cursor is not wrapped)
+            entry['plan_error'] = u'%s: %s' % (type(e).__name__, e)
+    entry['full_scan'] = full_scan(connection.vendor, entry['plan'])
+    _handler(log_path()).emit(logging.makeLogRecord(
+        {'msg': json.dumps(entry, sort_keys=True), 'args': None}))
+    return entry
+
+
+def read_log(path=None):
+    """The entries of the log and of its backups, oldest first."""
+    path = path or log_path()
+    files = [path]
+    for index in range(1, getattr(settings, 'FM_SLOW_QUERY_LOG_BACKUPS', 3) +
+                       1):
+        files.insert(0, '%s.%d' % (path, index))
+    for name in files:
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a line being written
+                    continue
+
+
+def statement_shape(sql):
+    """The statement with its lists of placeholders of any length collapsed,
+    so that the same query for another number of ids counts as the same."""
+    return _PLACEHOLDERS.sub('%s, ...', sql)
+
+
+def summary(entries):
+    """Group the entries by statement_shape.  Returns dicts of the count,
+    total and maximum duration, views, whether any plan is a full scan and
+    the slowest entry, slowest total first."""
+    groups = {}
+    for entry in entries:
+        shape = statement_shape(entry['sql'])
+        group = groups.get(shape)
+        if group is None:
+            group = groups[shape] = {'sql': shape, 'count': 0, 'total': 0.0,
+                                     'max': 0.0, 'views': set(),
+                                     'full_scan': False, 'slowest': entry}
+        group['count'] += 1
+        group['total'] += entry['duration']
+        group['views'].add(entry['view'])
+        group['full_scan'] = group['full_scan'] or entry.get('full_scan',
+                                                             False)
+        if entry['duration'] >= group['max']:
+            group['max'] = entry['duration']
+            group['slowest'] = entry
+    return sorted(groups.values(), key=lambda g: (-g['total'], g['sql']))
+
+
+class SlowQueryCursorWrapper(util.CursorWrapper):
+    """Times the statements run through the cursor of the connection, logs
+    the slow ones and hands them all to the running captures."""
+
+    def _timed(self, function, sql, params, many):
+        limit = threshold()
+        start = time.time()
+        result = function(sql, params)
+        duration = time.time() - start
+        capture.record(self.db.alias, sql, params, duration, many)
+        if limit is not None and duration >= limit and \
+                not getattr(_local, 'recording', False):
+            _local.recording = True
+            try:
+                record(self.db, sql, params, duration, many)
+            finally:
+                _local.recording = False
+        return result
+
+    def execute(self, sql, params=None):
+        return self._timed(self.cursor.execute, sql, params, False)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list, True)
+
+
+class SlowQueryLogMixin(object):
+    """Mixed into the DatabaseWrapper of a backend (see fm.backends)."""
+
+    def cursor(self):
+        cursor = super(SlowQueryLogMixin, self).cursor()
+        if threshold() is None and not capture.capturing():
+            return cursor
+        return SlowQueryCursorWrapper(cursor, self)
+
+
+class SlowQueryMiddleware(object):
+    """Make the request known to the log of the statements it runs."""
+
+    def process_request(self, request):
+        _local.request = request
+
+    def process_response(self, request, response):
+        _local.request = None
+        return response
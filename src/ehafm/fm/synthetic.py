@@ -0,0 +1,297 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Synthetic data at the scale of the national data set, for measuring
+# performance: 36 states with 3 zones each, ~770 LGAs, ~9k wards, ~30k
+# facilities (a store per state, zone and LGA and 1-5 health facilities with
+# MDG-shaped JSON documents per ward) and ~4k contacts with their roles.
+#
+# Everything is derived from a seed by a single random.Random, so the same
+# seed (and scale) always produces the same data.  The areas and facilities
+# are loaded through the bulk importer and loading is idempotent: running it
+# again with the same seed changes nothing.
+
+import hashlib
+import json
+import os
+import random
+from collections import OrderedDict
+
+from fm import mdg, search, versions
+from fm.importer import import_records, INVALID
+from fm.models import Contact, Role
+
+STATE_NAMES = (
+    'Abia', 'Adamawa', 'Akwa Ibom', 'Anambra', 'Bauchi', 'Bayelsa', 'Benue',
+    'Borno', 'Cross River', 'Delta', 'Ebonyi', 'Edo', 'Ekiti', 'Enugu',
+    'Gombe', 'Imo', 'Jigawa', 'Kaduna', 'Kano', 'Katsina', 'Kebbi', 'Kogi',
+    'Kwara', 'Lagos', 'Nasarawa', 'Niger', 'Ogun', 'Ondo', 'Osun', 'Oyo',
+    'Plateau', 'Rivers', 'Sokoto', 'Taraba', 'Yobe', 'Zamfara',
+)
+ZONES_PER_STATE = 3
+LGAS_PER_STATE = (14, 29)
+WARDS_PER_LGA = (7, 18)
+HEALTH_FACILITIES_PER_WARD = (1, 5)
+# share of the health facilities with a contact in charge (HFIC)
+HFIC_SHARE = 0.1
+
+SYLLABLES = (
+    'ba', 'bi', 'bu', 'da', 'di', 'du', 'fa', 'ga', 'gi', 'gwa', 'ja', 'ka',
+    'ki', 'ku', 'la', 'ma', 'mi', 'na', 'ni', 'ra', 'ri', 'sa', 'shi', 'ta',
+    'tu', 'wa', 'ya', 'yo', 'za', 'zu',
+)
+FIRST_NAMES = (
+    'Abubakar', 'Aisha', 'Amina', 'Bello', 'Chinedu', 'Fatima', 'Halima',
+    'Ibrahim', 'Ifeoma', 'Musa', 'Ngozi', 'Olumide', 'Sani', 'Tunde',
+    'Usman', 'Yusuf', 'Zainab',
+)
+LAST_NAMES = (
+    'Abdullahi', 'Adebayo', 'Bako', 'Danjuma', 'Eze', 'Garba', 'Ibrahim',
+    'Lawal', 'Mohammed', 'Nwosu', 'Okafor', 'Suleiman', 'Umar', 'Yakubu',
+)
+# MDG facility types -> name suffix
+MDG_TYPES = (
+    ('healthpost', 'Health Post'),
+    ('dispensary', 'Dispensary'),
+    ('primaryhealthclinic', 'Primary Health Clinic'),
+    ('primaryhealthcarecentre', 'Primary Health Care Centre'),
+    ('comprehensivehealthcentre', 'Comprehensive Health Centre'),
+    ('generalhospital', 'General Hospital'),
+)
+STATUSES = (('functional', 75), ('non-functional', 15),
+            ('under construction', 5), ('unknown', 5))
+
+
+def _weighted(generator, choices):
+    pick = generator.uniform(0, sum(weight for _, weight in choices))
+    for value, weight in choices:
+        pick -= weight
+        if pick <= 0:
+            return value
+    return choices[-1][0]
+
+
+class Names(object):
+    """Pronounceable names, unique within each scope."""
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.used = set()
+
+    def __call__(self, scope, syllables=(2, 3)):
+        name = ''.join(self.generator.choice(SYLLABLES) for _ in range(
+            self.generator.randint(*syllables))).title()
+        unique, suffix = name, 1
+        while (scope, unique) in self.used:
+            suffix += 1
+            unique = '%s %d' % (name, suffix)
+        self.used.add((scope, unique))
+        return unique
+
+
+class Dataset(object):
+    """The generated data: import records, contacts and roles."""
+
+    def __init__(self):
+        # area and facility records for fm.importer
+        self.records = []
+        # (name, phone, e-mail) of the contacts
+        self.contacts = []
+        # (role name, index in contacts, index of the facility in records)
+        self.roles = []
+
+    def area(self, name, area_type, ancestors=()):
+        self.records.append({
+            'model': 'area', 'area_name': name, 'area_type': area_type,
+            'area_parent': mdg.area_label(ancestors[0][0], ancestors[0][1],
+                                          [a[0] for a in ancestors[1:]])
+            if ancestors else None})
+        return [(name, area_type)] + list(ancestors)
+
+    def facility(self, name, facility_type, status, area, document=None):
+        self.records.append({
+            'model': 'facility', 'facility_name': name,
+            'facility_type': facility_type, 'facility_status': status,
+            'facility_area': mdg.area_label(area[0][0], area[0][1],
+                                            [a[0] for a in area[1:]]),
+            'json': document})
+        return len(self.records) - 1
+
+    def contact(self, generator, role_name, facility_index):
+        number = len(self.contacts) + 1
+        self.contacts.append((
+            '%s %s' % (generator.choice(FIRST_NAMES),
+                       generator.choice(LAST_NAMES)),
+            '+234 80%d %03d %04d' % (generator.randint(2, 9),
+                                     generator.randint(0, 999),
+                                     generator.randint(0, 9999)),
+            'contact%06d@example.org' % number))
+        self.roles.append((role_name, number - 1, facility_index))
+
+    def counts(self):
+        counts = {'contacts': len(self.contacts), 'roles': len(self.roles)}
+        for record in self.records:
+            kind = 'areas' if record['model'] == 'area' else 'facilities'
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+
+def facility_id(name, area):
+    """A facility_id unique to the name and the area (whatever the seed)."""
+    label = mdg.area_label(area[0][0], area[0][1], [a[0] for a in area[1:]])
+    return 'SYN-%s' % hashlib.md5(
+        (u'%s|%s' % (name, label)).encode('utf-8')).hexdigest()[:16]
+
+
+def mdg_document(generator, facility_id, name, mdg_type, ward, lga, state):
+    """A facility document shaped like the MDG health facility ones."""
+    return {
+        'facility_id': facility_id,
+        'facility_name': name,
+        'facility_type': mdg_type,
+        'sector': 'health',
+        'state': state,
+        'lga': lga,
+        'ward': ward,
+        'gps': '%.6f %.6f %d %d' % (generator.uniform(4.3, 13.9),
+                                    generator.uniform(2.7, 14.6),
+                                    generator.randint(0, 900),
+                                    generator.randint(5, 30)),
+        'facility_owner_manager': generator.choice(
+            ['federalgovernment', 'stategovernment', 'lga', 'private',
+             'faith_based']),
+        'num_doctors_fulltime': generator.randint(0, 6),
+        'num_nurses_fulltime': generator.randint(0, 20),
+        'num_chews_fulltime': generator.randint(0, 12),
+        'vaccines_fridge_freezer': generator.random() < 0.6,
+        'power_sources_grid': generator.random() < 0.4,
+        'water_sources_none': generator.random() < 0.2,
+        'date_of_survey': '2012-%02d-%02d' % (generator.randint(1, 12),
+                                              generator.randint(1, 28)),
+    }
+
+
+def state_names(scale):
+    count = max(1, int(round(len(STATE_NAMES) * scale)))
+    return [STATE_NAMES[i % len(STATE_NAMES)] +
+            ('' if i < len(STATE_NAMES) else ' %d' % (i // len(STATE_NAMES)))
+            for i in range(count)]
+
+
+def generate(seed=0, scale=1.0, states=None):
+    """Generate a Dataset.  scale multiplies the number of states (the
+    subtrees of the states keep their sizes); states overrides the names of
+    the states."""
+    generator = random.Random(seed)
+    names = Names(generator)
+    data = Dataset()
+    for state_name in states or state_names(scale):
+        state = data.area(state_name, 'State')
+        data.contact(generator, 'SCCO', data.facility(
+            '%s State Cold Store' % state_name, 'State Store', 'functional',
+            state))
+        zones = []
+        for number in range(1, ZONES_PER_STATE + 1):
+            zone = data.area('%s Zone %d' % (state_name, number),
+                             'State Zone', state)
+            data.contact(generator, 'ZCCO', data.facility(
+                '%s Zone %d Store' % (state_name, number), 'Zonal Store',
+                _weighted(generator, STATUSES), zone))
+            zones.append(zone)
+        for _ in range(generator.randint(*LGAS_PER_STATE)):
+            lga_name = names(state_name)
+            lga = data.area(lga_name, 'LGA', generator.choice(zones))
+            data.contact(generator, 'LGA CCO', data.facility(
+                '%s LGA Store' % lga_name, 'LGA Store',
+                _weighted(generator, STATUSES), lga))
+            for _ in range(generator.randint(*WARDS_PER_LGA)):
+                ward_name = names((state_name, lga_name))
+                ward = data.area(ward_name, 'Ward', lga)
+                for number in range(generator.randint(
+                        *HEALTH_FACILITIES_PER_WARD)):
+                    mdg_type, suffix = generator.choice(MDG_TYPES)
+                    name = '%s %s %d' % (ward_name, suffix, number + 1)
+                    document = mdg_document(
+                        generator, facility_id(name, ward),
+                        name, mdg_type, ward_name, lga_name, state_name)
+                    index = data.facility(name, 'Health Facility',
+                                          _weighted(generator, STATUSES),
+                                          ward, document)
+                    if generator.random() < HFIC_SHARE:
+                        data.contact(generator, 'HFIC', index)
+    return data
+
+
+def write_mdg_documents(data, directory):
+    """Write the health facility documents of the dataset as MDG LGA
+    documents (one JSON file per LGA) to the directory.  Returns the (LGA
+    name, path) pairs for mdg.transform_documents."""
+    by_lga = OrderedDict()
+    for record in data.records:
+        document = record.get('json')
+        if record['model'] == 'facility' and document is not None:
+            by_lga.setdefault((document['state'], document['lga']),
+                              []).append(document)
+    documents = []
+    for (state_name, lga_name), facilities in by_lga.items():
+        path = os.path.join(directory, mdg.lga_document_name(state_name,
+                                                             lga_name))
+        with open(path, 'wb') as f:
+            json.dump({'lga': {'name': lga_name, 'state': state_name},
+                       'facilities': facilities}, f)
+        documents.append((lga_name, path))
+    return documents
+
+
+def load(data, batch_size=500, chunk_size=400):
+    """Store the dataset (areas and facilities through the bulk importer).
+    Returns the import results and the number of contacts and roles
+    created."""
+    results = import_records(data.records, batch_size)
+    invalid = [r for r in results if r['status'] == INVALID]
+    if invalid:
+        raise ValueError('Invalid record %(index)d: %(error)s' % invalid[0])
+    emails = [email for _, _, email in data.contacts]
+    contact_ids = _contact_ids(emails, chunk_size)
+    new = [Contact(contact_name=name, contact_phone=phone,
+                   contact_email=email)
+           for name, phone, email in data.contacts
+           if email not in contact_ids]
+    Contact.objects.bulk_create(new, batch_size)
+    contact_ids = _contact_ids(emails, chunk_size)
+    # bulk_create sends no signals
+    if new:
+        search.index_objects(Contact, _contacts(
+            [c.contact_email for c in new], chunk_size))
+    roles = set((name, contact_ids[emails[contact]],
+                 results[facility]['id'])
+                for name, contact, facility in data.roles)
+    existing = set()
+    for start in range(0, len(emails), chunk_size):
+        existing.update(Role.objects.filter(
+            role_contact__contact_email__in=emails[start:start + chunk_size]
+        ).values_list('role_name', 'role_contact', 'role_facility'))
+    created_roles = [Role(role_name=name, role_contact_id=contact_id,
+                          role_facility_id=facility_id)
+                     for name, contact_id, facility_id in sorted(roles)
+                     if (name, contact_id, facility_id) not in existing]
+    Role.objects.bulk_create(created_roles, batch_size)
+    versions.bump_models(Contact, Role)
+    return results, len(new), len(created_roles)
+
+
+def _contact_ids(emails, chunk_size):
+    found = {}
+    for start in range(0, len(emails), chunk_size):
+        found.update(Contact.objects.filter(
+            contact_email__in=emails[start:start + chunk_size]).values_list(
+            'contact_email', 'pk'))
+    return found
+
+
+def _contacts(emails, chunk_size):
+    contacts = []
+    for start in range(0, len(emails), chunk_size):
+        contacts.extend(Contact.objects.filter(
+            contact_email__in=emails[start:start + chunk_size]).defer('json'))
+    return contacts
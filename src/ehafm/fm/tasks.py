@@ -0,0 +1,196 @@
+from __future__ import absolute_import
+
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Background imports of the MDG LGA documents of a state (see ehafm/celery.py
+# for the Celery application).
+#
+# start_import creates an ImportJob with an ImportJobPart per LGA and queues
+# run_import.  run_import imports the state and its LGAs, so that no two of
+# the following tasks insert the same area, and fans out to one import_lga
+# task per LGA in a chord ending with finish_import.  import_lga downloads,
+# transforms, parses and imports the document of its LGA, in chunks of
+# FM_IMPORT_CHUNK_SIZE records, and adds to the counts of its part after
+# every chunk so that the import pages show the progress as it goes.  A
+# failed attempt is retried from the start (the records imported already are
+# skipped) up to FM_IMPORT_MAX_RETRIES times.  A part failing for good does
+# not fail the chord, so finish_import always runs and marks the job as
+# finished or failed.
+#
+# The documents are only downloaded from URLs with a scheme listed in
+# FM_IMPORT_URL_SCHEMES and only to files directly in FM_IMPORT_DOWNLOAD_DIR.
+
+import os
+import urlparse
+
+from celery import chord, shared_task
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from fm import mdg
+from fm.importer import CREATED, EXISTING, INVALID, UPDATED, import_records, \
+    parse_records, summarise
+from fm.models import ImportJob, ImportJobPart
+
+# The counts of an ImportJobPart the statuses of the imported records add to
+COUNTS = {
+    CREATED: 'inserted',
+    UPDATED: 'updated',
+    EXISTING: 'skipped',
+    INVALID: 'failed',
+}
+
+
+def chunk_size():
+    return getattr(settings, 'FM_IMPORT_CHUNK_SIZE', 1000)
+
+
+def max_retries():
+    return getattr(settings, 'FM_IMPORT_MAX_RETRIES', 3)
+
+
+def retry_delay():
+    return getattr(settings, 'FM_IMPORT_RETRY_DELAY', 60)
+
+
+def download_dir():
+    return getattr(settings, 'FM_IMPORT_DOWNLOAD_DIR',
+                   os.path.join(settings.BASE_DIR, 'mdg_download'))
+
+
+def url_schemes():
+    return getattr(settings, 'FM_IMPORT_URL_SCHEMES', ('http', 'https'))
+
+
+def check_source_url(url):
+    """Raise ValueError unless the documents may be downloaded from the
+    URL."""
+    scheme = urlparse.urlsplit(url).scheme.lower()
+    if scheme not in url_schemes():
+        raise ValueError('Documents cannot be downloaded from %s URLs.' %
+                         (scheme or 'relative'))
+
+
+def download_path(name):
+    """The path of name in the download directory.  Raises ValueError if it
+    would resolve to anywhere else (a name holding a path separator or
+    '..')."""
+    base = os.path.realpath(download_dir())
+    path = os.path.realpath(os.path.join(base, name))
+    if os.path.dirname(path) != base:
+        raise ValueError('%r is not a name of a file.' % name)
+    return path
+
+
+def _error(exception):
+    return u'%s: %s' % (type(exception).__name__, exception)
+
+
+def start_import(state_name, lga_names, sectors=('health',),
+                 source_url=mdg.MDG_URL, user=None):
+    """Create an import job of the LGAs of the state and queue it.  Has to
+    be called outside of a transaction, so that the workers see the job."""
+    check_source_url(source_url)
+    job = ImportJob.objects.create(
+        state_name=state_name, sectors=u','.join(sectors),
+        source_url=source_url, created_by=user)
+    ImportJobPart.objects.bulk_create([
+        ImportJobPart(job=job, lga_name=name) for name in lga_names])
+    run_import.delay(job.pk)
+    return job
+
+
+def lga_records(job, lga_name):
+    """Download (unless an intact copy is there already) and transform the
+    document of the LGA into a list of import records."""
+    document = mdg.lga_document_name(job.state_name, lga_name)
+    url = mdg.lga_document_url(document, job.source_url)
+    check_source_url(url)
+    # a directory (and so a download manifest) per document, as the
+    # documents are downloaded by several worker processes at once
+    directory = download_path(os.path.splitext(document)[0])
+    status, error = mdg.download_documents(
+        [(url, document)], directory, workers=1, revalidate=True)[document]
+    if status == mdg.FAILED:
+        raise IOError(error)
+    wards, facilities = mdg.transform_lga_document(
+        (job.state_name, lga_name, os.path.join(directory, document),
+         job.sector_list(), 'Health Facility'))
+    return parse_records(u'\n'.join([record for _, record in wards] +
+                                    facilities))
+
+
+@shared_task(bind=True)
+def run_import(self, job_id):
+    job = ImportJob.objects.get(pk=job_id)
+    lga_names = list(job.parts.order_by('pk').values_list('lga_name',
+                                                          flat=True))
+    state_name = mdg.reformat_name(job.state_name)
+    state_label = mdg.area_label(state_name, 'State')
+    lines = [mdg.area_record(state_name, 'State')] + [
+        mdg.area_record(mdg.reformat_name(name), 'LGA', state_label)
+        for name in lga_names]
+    ImportJob.objects.filter(pk=job_id).update(status=ImportJob.RUNNING)
+    try:
+        results = import_records(parse_records(u'\n'.join(lines)))
+    except Exception as e:
+        if self.request.retries < max_retries():
+            raise self.retry(exc=e, countdown=retry_delay(),
+                             max_retries=max_retries())
+        ImportJob.objects.filter(pk=job_id).update(
+            status=ImportJob.FAILED, error=_error(e),
+            finished=timezone.now())
+        return ImportJob.FAILED
+    invalid = [r for r in results if r['status'] == INVALID]
+    if invalid:
+        ImportJob.objects.filter(pk=job_id).update(
+            status=ImportJob.FAILED, error=invalid[0]['error'],
+            finished=timezone.now())
+        return ImportJob.FAILED
+    part_ids = job.parts.order_by('pk').values_list('pk', flat=True)
+    if not part_ids:
+        return finish_import(job_id)
+    chord(import_lga.si(part_id) for part_id in part_ids)(
+        finish_import.si(job_id))
+    return ImportJob.RUNNING
+
+
+@shared_task(bind=True)
+def import_lga(self, part_id):
+    part = ImportJobPart.objects.select_related('job').get(pk=part_id)
+    parts = ImportJobPart.objects.filter(pk=part_id)
+    # a retry starts from scratch
+    parts.update(status=ImportJobPart.RUNNING, attempts=F('attempts') + 1,
+                 error='', **dict((name, 0) for name in ImportJob.COUNTS))
+    try:
+        records = lga_records(part.job, part.lga_name)
+        parts.update(parsed=len(records))
+        size = chunk_size()
+        for start in range(0, len(records), size):
+            summary = summarise(import_records(records[start:start + size]))
+            parts.update(**dict((COUNTS[status], F(COUNTS[status]) + count)
+                                for status, count in summary.items()
+                                if count))
+    except Exception as e:
+        if self.request.retries < max_retries():
+            parts.update(status=ImportJobPart.RETRYING, error=_error(e))
+            raise self.retry(exc=e, countdown=retry_delay(),
+                             max_retries=max_retries())
+        parts.update(status=ImportJobPart.FAILED, error=_error(e),
+                     finished=timezone.now())
+        return ImportJobPart.FAILED
+    parts.update(status=ImportJobPart.FINISHED, finished=timezone.now())
+    return ImportJobPart.FINISHED
+
+
+@shared_task
+def finish_import(job_id):
+    failed = ImportJobPart.objects.filter(
+        job=job_id, status=ImportJobPart.FAILED).count()
+    status = ImportJob.FAILED if failed else ImportJob.FINISHED
+    ImportJob.objects.filter(pk=job_id).update(
+        status=status, finished=timezone.now(),
+        error=u'%d LGAs could not be imported.' % failed if failed else u'')
+    return status
@@ -1,8 +1,11 @@
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
 
+from django.core.cache import cache
 from django.test import TestCase
 
+from fm import choices
+from fm.choices import choice_labels
 from fm.forms import AreaForm, FacilityForm, ContactForm, RoleForm
 
 from fm.models import Area, AREA_TYPES
@@ -12,6 +15,9 @@ from fm.models import Role
 
 
 class FMFormTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def reject_invalid_json(self, form_class, data, number_of_objects_before):
         model_class = form_class._meta.model
         # fill in the form and save it and see if the number of objects is
@@ -528,3 +534,78 @@ class RoleFormTest(FMFormTest):
         role = self.create_save_and_return_role(
             'HFIC', contact, facility, 0)
         self.assertIn(role, facility.facility_roles.all())
+
+
+class CachedChoicesTest(FMFormTest):
+    def add_roles_data(self, number):
+        area = None
+        for level in range(4):
+            area = Area.objects.create(area_name='Area %d' % level,
+                                       area_type='Ward', area_parent=area)
+        for i in range(number):
+            Contact.objects.create(contact_name='Contact %d' % i)
+            Facility.objects.create(facility_name='Facility %d' % i,
+                                    facility_area=area)
+
+    def test_choice_labels_built_from_one_query_per_list_and_cached(self):
+        self.add_roles_data(10)
+        with self.assertNumQueries(2):
+            form_html = RoleForm().as_p()
+        self.assertIn('Contact 9', form_html)
+        self.assertIn(
+            'Facility 9 in Area 3 (Ward in Area 2 in Area 1 in Area 0)',
+            form_html)
+        with self.assertNumQueries(0):
+            self.assertEqual(form_html, RoleForm().as_p())
+
+    def test_choice_labels_invalidated_when_rows_change(self):
+        self.add_roles_data(1)
+        RoleForm().as_p()
+        area = Area.objects.get(area_name='Area 0')
+        area.area_name = 'Renamed'
+        area.save()
+        Contact.objects.create(contact_name='Contact new')
+        form_html = RoleForm().as_p()
+        self.assertIn('Area 1 in Renamed)', form_html)
+        self.assertIn('Contact new', form_html)
+        self.assertIn('(Ward in Area 2 in Area 1 in Renamed)',
+                      AreaForm().as_p())
+
+    def test_choice_labels_cached_in_chunks(self):
+        self.add_roles_data(5)
+        with self.settings(FM_CHOICES_CACHE_CHUNK_SIZE=2):
+            with self.assertNumQueries(1):
+                labels = choice_labels('contacts')
+            key = choices._cache_key('contacts')
+            self.assertEqual(cache.get(key), 3)
+            self.assertEqual([len(cache.get('%s:%d' % (key, index)))
+                              for index in range(3)], [2, 2, 1])
+            with self.assertNumQueries(0):
+                self.assertEqual(choice_labels('contacts'), labels)
+            # an evicted chunk gets all the labels rebuilt
+            cache.delete('%s:1' % key)
+            with self.assertNumQueries(1):
+                self.assertEqual(choice_labels('contacts'), labels)
+        self.assertEqual([label for _, label in labels],
+                         ['Contact %d' % i for i in range(5)])
+
+    def test_long_choice_lists_are_searched_lazily(self):
+        self.add_roles_data(3)
+        facility = Facility.objects.get(facility_name='Facility 1')
+        with self.settings(FM_CHOICES_INLINE_LIMIT=2):
+            form_html = RoleForm(
+                initial={'role_facility': facility.id}).as_p()
+        self.assertIn('id="id_role_facility_search"', form_html)
+        self.assertIn('/fm/choices/facilities', form_html)
+        self.assertIn('Facility 1', form_html)
+        self.assertNotIn('Facility 2', form_html)
+        self.assertNotIn('Contact 2', form_html)
+
+    def test_lazily_searched_form_still_validates(self):
+        self.add_roles_data(3)
+        with self.settings(FM_CHOICES_INLINE_LIMIT=2):
+            form = RoleForm(data={
+                'role_name': 'SCCO',
+                'role_contact': Contact.objects.first().id,
+                'role_facility': Facility.objects.first().id, })
+            self.assertTrue(form.is_valid())
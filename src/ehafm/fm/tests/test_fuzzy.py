@@ -0,0 +1,96 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from fm import fuzzy
+from fm.importer import import_records, CREATED
+from fm.models import Area, Facility
+
+
+class TrigramTest(TestCase):
+    def test_punctuation_and_case_ignored(self):
+        self.assertEqual(fuzzy.similarity('Dawakin-Kudu', 'dawakin kudu'),
+                         1.0)
+        self.assertEqual(fuzzy.similarity('Gen. Hosp.', 'GEN HOSP'), 1.0)
+
+    def test_similar_names_score_higher(self):
+        close = fuzzy.similarity('Kofar Mazugal', 'Kofar Mazugall')
+        far = fuzzy.similarity('Kofar Mazugal', 'Gwammaja')
+        self.assertGreater(close, 0.7)
+        self.assertLess(far, 0.1)
+        self.assertEqual(fuzzy.similarity('', 'Gwammaja'), 0.0)
+
+    def test_index_returns_candidates_above_threshold_best_first(self):
+        index = fuzzy.TrigramIndex()
+        for key, name in enumerate(['Dala Clinic', 'Dala Clinics',
+                                    'Gwammaja Health Post', 'Dala']):
+            index.add(key, name)
+        self.assertEqual(
+            [(key, round(score, 2)) for key, _, score in
+             index.candidates('dala clinic', 0.5)],
+            [(0, 1.0), (1, 0.79)])
+        self.assertEqual(len(index.candidates('Dala Clinic', 0.3, 1)), 1)
+        self.assertEqual(index.candidates('Fagge', 0.5), [])
+
+
+class CandidateMatchesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        kano = Area.objects.create(area_name='Kano', area_type='State')
+        self.dawakin = Area.objects.create(area_name='Dawakin-Kudu',
+                                           area_type='LGA', area_parent=kano)
+        self.fagge = Area.objects.create(area_name='Fagge', area_type='LGA',
+                                         area_parent=kano)
+        self.clinic = Facility.objects.create(
+            facility_name='Dawakin Kudu General Hospital',
+            facility_type='Health Facility', facility_area=self.dawakin)
+
+    def test_matches_blocked_by_parent_area(self):
+        kano = self.dawakin.area_parent_id
+        found = fuzzy.candidate_matches(Area, [(kano, 'Dawakin Kudu'),
+                                               (None, 'Dawakin Kudu'),
+                                               (kano, 'Gwale')])
+        self.assertEqual([[(pk, name) for pk, name, _ in c] for c in found],
+                         [[(self.dawakin.id, 'Dawakin-Kudu')], [], []])
+        self.assertEqual(fuzzy.candidate_matches(
+            Facility, [(self.fagge.id, 'Dawakin Kudu General Hospital')]),
+            [[]])
+
+    def test_one_query_per_batch_of_blocks(self):
+        with self.assertNumQueries(1):
+            fuzzy.candidate_matches(Facility, [
+                (self.dawakin.id, 'Dawakin-Kudu Gen. Hospital'),
+                (self.fagge.id, 'Fagge Clinic')] * 10)
+
+    def test_import_results_list_probable_duplicates(self):
+        results = import_records([
+            {'model': 'area', 'area_name': 'Dawakin Kudu', 'area_type': 'LGA',
+             'area_parent': 'Kano (State)'},
+            {'model': 'facility',
+             'facility_name': 'Dawakin-Kudu General Hospital.',
+             'facility_type': 'Health Facility', 'facility_status': 'ok',
+             'facility_area': 'Dawakin-Kudu (LGA in Kano)'},
+            {'model': 'facility', 'facility_name': 'Dawakin Kudu Clinic',
+             'facility_type': 'Health Facility', 'facility_status': 'ok',
+             'facility_area': 'Fagge (LGA in Kano)'}])
+        self.assertEqual([r['status'] for r in results], [CREATED] * 3)
+        self.assertEqual(results[0]['similar'], [
+            {'id': self.dawakin.id, 'name': 'Dawakin-Kudu',
+             'similarity': 1.0}])
+        self.assertEqual([s['id'] for s in results[1]['similar']],
+                         [self.clinic.id])
+        self.assertNotIn('similar', results[2])
+
+    def test_later_batches_matched_against_earlier_ones(self):
+        records = [{'model': 'facility', 'facility_name': name,
+                    'facility_type': 'Health Facility',
+                    'facility_status': 'ok',
+                    'facility_area': 'Fagge (LGA in Kano)'}
+                   for name in ('Fagge Clinic', 'Fagge Clinic.',
+                                'Fage Clinic')]
+        results = import_records(records, batch_size=1)
+        self.assertNotIn('similar', results[0])
+        self.assertEqual([s['name'] for s in results[2]['similar']],
+                         ['Fagge Clinic', 'Fagge Clinic.'])
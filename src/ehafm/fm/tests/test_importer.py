@@ -0,0 +1,282 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from fm.importer import import_records, parse_records, summarise
+from fm.importer import CREATED, UPDATED, EXISTING, INVALID
+from fm.models import Area, Facility, FacilityCount
+
+
+def area(name, area_type, parent=None):
+    return {'model': 'area', 'area_name': name, 'area_type': area_type,
+            'area_parent': parent}
+
+
+def facility(name, area_label, document=None):
+    return {'model': 'facility', 'facility_name': name,
+            'facility_type': 'Health Facility', 'facility_status': 'ok',
+            'facility_area': area_label, 'json': document}
+
+
+KANO_RECORDS = [
+    facility('Clinic 1', 'Ward 1 (Ward in Dala in Kano)', {'id': 1}),
+    area('Ward 1', 'Ward', 'Dala (LGA in Kano)'),
+    area('Dala', 'LGA', 'Kano (State)'),
+    area('Kano', 'State'),
+    facility('Store', 'Kano (State)'),
+]
+
+
+class BulkImportTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_records_imported_whatever_their_order(self):
+        results = import_records(KANO_RECORDS)
+        self.assertEqual([r['status'] for r in results], [CREATED] * 5)
+        ward = Area.objects.get(area_name='Ward 1')
+        self.assertEqual(unicode(ward), u'Ward 1 (Ward in Dala in Kano)')
+        self.assertEqual(ward.area_parent.area_parent.area_name, 'Kano')
+        clinic = Facility.objects.get(facility_name='Clinic 1')
+        self.assertEqual(clinic.facility_area, ward)
+        self.assertEqual(clinic.json, {'id': 1})
+        self.assertTrue(clinic.has_json)
+        self.assertFalse(Facility.objects.get(facility_name='Store').has_json)
+        self.assertEqual(results[0]['id'], clinic.id)
+        self.assertEqual(results[1]['id'], ward.id)
+
+    def test_reimport_detects_existing_records(self):
+        import_records(KANO_RECORDS)
+        results = import_records(KANO_RECORDS)
+        self.assertEqual([r['status'] for r in results], [EXISTING] * 5)
+        self.assertEqual(Area.objects.count(), 3)
+        self.assertEqual(Facility.objects.count(), 2)
+
+    def test_duplicates_within_a_batch_imported_once(self):
+        results = import_records([area('Kano', 'State'),
+                                  area('Kano', 'State')])
+        self.assertEqual([r['status'] for r in results], [CREATED, EXISTING])
+        self.assertEqual(results[0]['id'], results[1]['id'])
+        self.assertEqual(Area.objects.count(), 1)
+
+    def test_reimport_updates_changed_facilities(self):
+        import_records(KANO_RECORDS)
+        records = [facility('Clinic 1', 'Ward 1 (Ward in Dala in Kano)',
+                            {'id': 2}),
+                   facility('Store', 'Kano (State)')]
+        records[1]['facility_status'] = 'non-functional'
+        results = import_records(records)
+        self.assertEqual([r['status'] for r in results], [UPDATED] * 2)
+        self.assertEqual(Facility.objects.get(id=results[0]['id']).json,
+                         {'id': 2})
+        cleared = import_records([facility('Clinic 1',
+                                           'Ward 1 (Ward in Dala in Kano)')])
+        self.assertEqual(cleared[0]['status'], UPDATED)
+        self.assertFalse(Facility.objects.get(id=cleared[0]['id']).has_json)
+        self.assertEqual(
+            Facility.objects.get(id=results[1]['id']).facility_status,
+            'non-functional')
+        self.assertEqual(Facility.objects.count(), 2)
+
+    def test_facility_counts_maintained(self):
+        import_records(KANO_RECORDS)
+        kano = Area.objects.get(area_name='Kano')
+        self.assertEqual(FacilityCount.objects.counts_for(kano),
+                         [('Health Facility', 'ok', 2)])
+        records = [facility('Clinic 1', 'Ward 1 (Ward in Dala in Kano)',
+                            {'id': 1})]
+        records[0]['facility_status'] = 'non-functional'
+        import_records(records)
+        self.assertEqual(FacilityCount.objects.counts_for(kano),
+                         [('Health Facility', 'non-functional', 1),
+                          ('Health Facility', 'ok', 1)])
+        self.assertEqual(FacilityCount.objects.counts_for(
+            Area.objects.get(area_name='Ward 1')),
+            [('Health Facility', 'non-functional', 1)])
+
+    def test_facilities_with_a_facility_id_upserted_by_it(self):
+        import_records(KANO_RECORDS + [
+            facility('Clinic 2', 'Dala (LGA in Kano)', {'facility_id': 'X1'})])
+        results = import_records([
+            facility('Clinic Two', 'Ward 1 (Ward in Dala in Kano)',
+                     {'facility_id': 'X1', 'num_doctors': 1})])
+        self.assertEqual(results[0]['status'], UPDATED)
+        clinic = Facility.objects.get(facility_external_id='X1')
+        self.assertEqual(clinic.facility_name, 'Clinic Two')
+        self.assertEqual(clinic.facility_area.area_name, 'Ward 1')
+        self.assertEqual(Facility.objects.count(), 3)
+
+    def test_facilities_stored_without_an_external_id_matched_by_name(self):
+        import_records(KANO_RECORDS[1:4])
+        ward = Area.objects.get(area_name='Ward 1')
+        # imported before the external ids were stored
+        Facility.objects.bulk_create([Facility(
+            facility_name='Clinic 1', facility_type='Health Facility',
+            facility_status='ok', facility_area=ward,
+            json={'facility_id': 'X1'})])
+        results = import_records([
+            facility('Clinic 1', 'Ward 1 (Ward in Dala in Kano)',
+                     {'facility_id': 'X1', 'num_doctors': 1})])
+        self.assertEqual(results[0]['status'], UPDATED)
+        self.assertEqual(Facility.objects.count(), 1)
+        clinic = Facility.objects.get()
+        self.assertEqual(clinic.facility_external_id, 'X1')
+        self.assertEqual(clinic.json['num_doctors'], 1)
+
+    def test_namesakes_in_other_areas_not_loaded(self):
+        import_records(KANO_RECORDS[1:4] + [area('Lagos', 'State')])
+        lagos = Area.objects.get(area_name='Lagos')
+        Facility.objects.bulk_create([
+            Facility(facility_name='Clinic 1', facility_type='Health Facility',
+                     facility_status='ok', facility_area=lagos,
+                     json={'beds': i}, has_json=True) for i in range(3)])
+        with CaptureQueriesContext(connection) as queries:
+            results = import_records([
+                facility('Clinic 1', 'Ward 1 (Ward in Dala in Kano)')])
+        self.assertEqual(results[0]['status'], CREATED)
+        lookups = [q['sql'] for q in queries
+                   if 'FROM "fm_facility"' in q['sql'] and
+                   '"fm_facility"."facility_name" IN' in q['sql']]
+        self.assertTrue(lookups)
+        for sql in lookups:
+            self.assertNotIn('"json"', sql)
+            self.assertIn('"fm_facility"."facility_area_id" IN', sql)
+
+    def test_rebuild_external_ids_command_backfills_them(self):
+        import_records(KANO_RECORDS[1:4])
+        ward = Area.objects.get(area_name='Ward 1')
+        Facility.objects.bulk_create([
+            Facility(facility_name=name, facility_type='Health Facility',
+                     facility_status='ok', facility_area=ward,
+                     json=document, has_json=document is not None)
+            for name, document in [('Clinic 1', {'facility_id': 'X1'}),
+                                   ('Clinic 2', {'facility_id': 'X1'}),
+                                   ('Store', None)]])
+        out = StringIO()
+        call_command('rebuild_facility_external_ids', stdout=out)
+        self.assertEqual(
+            dict(Facility.objects.values_list('facility_name',
+                                              'facility_external_id')),
+            {'Clinic 1': 'X1', 'Clinic 2': None, 'Store': None})
+        self.assertIn('1 facility(ies) updated.', out.getvalue())
+        self.assertIn('duplicates the facility_id X1', out.getvalue())
+        results = import_records([
+            facility('Clinic 1', 'Ward 1 (Ward in Dala in Kano)',
+                     {'facility_id': 'X1'})])
+        self.assertEqual(results[0]['status'], EXISTING)
+
+    def test_rerun_after_a_partial_import_completes_it(self):
+        import_records(KANO_RECORDS[2:4])
+        results = import_records(KANO_RECORDS)
+        self.assertEqual([r['status'] for r in results],
+                         [CREATED, CREATED, EXISTING, EXISTING, CREATED])
+        self.assertEqual(Area.objects.count(), 3)
+
+    def test_invalid_records_reported_and_the_rest_imported(self):
+        results = import_records([
+            area('Kano', 'State'),
+            area('Kano', 'Planet'),
+            area('', 'State'),
+            area('Dala', 'LGA', 'Lagos (State)'),
+            facility('Clinic 1', 'Nowhere (Ward)'),
+            {'model': 'role'},
+            'not a record',
+        ])
+        self.assertEqual([r['status'] for r in results],
+                         [CREATED] + [INVALID] * 6)
+        self.assertIn('Unknown area_parent', results[3]['error'])
+        self.assertEqual(summarise(results),
+                         {CREATED: 1, UPDATED: 0, EXISTING: 0, INVALID: 6})
+
+    def test_query_count_does_not_grow_with_the_number_of_records(self):
+        def count_queries(number):
+            records = [area('State %d' % number, 'State')]
+            records += [area('LGA %d' % i, 'LGA', 'State %d (State)' % number)
+                        for i in range(number)]
+            records += [facility('Facility %d' % i,
+                                 'LGA %d (LGA in State %d)' % (i, number))
+                        for i in range(number)]
+            with CaptureQueriesContext(connection) as queries:
+                import_records(records)
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(20))
+        self.assertEqual(Facility.objects.count(), 22)
+
+    def test_query_count_of_a_reimport_does_not_grow_with_the_records(self):
+        def count_queries(number):
+            records = [area('State %d' % number, 'State')]
+            records += [facility('Facility %d' % i,
+                                 'State %d (State)' % number,
+                                 {'facility_id': '%d-%d' % (number, i)})
+                        for i in range(number)]
+            import_records(records)
+            with CaptureQueriesContext(connection) as queries:
+                results = import_records(records)
+            self.assertEqual(set(r['status'] for r in results), {EXISTING})
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(20))
+
+    def test_json_array_and_ndjson_parsed(self):
+        records = [area('Kano', 'State'), facility('Store', 'Kano (State)')]
+        self.assertEqual(parse_records(json.dumps(records)), records)
+        ndjson = '\n'.join(json.dumps(r) for r in records) + '\n'
+        self.assertEqual(parse_records(ndjson.encode('utf-8')), records)
+
+    def test_management_command_imports_a_file(self):
+        handle, path = tempfile.mkstemp(suffix='.ndjson')
+        with os.fdopen(handle, 'w') as f:
+            f.write('\n'.join(json.dumps(r) for r in KANO_RECORDS))
+        try:
+            call_command('import_fm_records', path, stdout=StringIO())
+        finally:
+            os.remove(path)
+        self.assertEqual(Area.objects.count(), 3)
+        self.assertEqual(Facility.objects.count(), 2)
+
+
+class ImportViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@b.cc', 'adminpasswd')
+        User.objects.create_user('user1', 'user@b.cc', 'userpasswd')
+
+    def test_page_redirects_and_asks_non_staff_users_to_log_in(self):
+        self.client.login(username='user1', password='userpasswd')
+        response = self.client.post('/fm/import', json.dumps(KANO_RECORDS),
+                                    content_type='application/json',
+                                    follow=True)
+        self.assertContains(response, 'Log in')
+        self.assertEqual(Area.objects.count(), 0)
+
+    def test_only_posts_accepted(self):
+        self.client.login(username='admin', password='adminpasswd')
+        self.assertEqual(self.client.get('/fm/import').status_code, 405)
+
+    def test_invalid_json_rejected(self):
+        self.client.login(username='admin', password='adminpasswd')
+        response = self.client.post('/fm/import', '[{',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_returns_per_record_results(self):
+        self.client.login(username='admin', password='adminpasswd')
+        response = self.client.post('/fm/import', json.dumps(KANO_RECORDS),
+                                    content_type='application/json')
+        content = json.loads(response.content.decode())
+        self.assertEqual(content['summary'],
+                         {CREATED: 5, UPDATED: 0, EXISTING: 0, INVALID: 0})
+        self.assertEqual(len(content['results']), 5)
+        self.assertEqual(Facility.objects.count(), 2)
@@ -0,0 +1,105 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from fm import jsondb
+from fm.models import Contact, Facility
+
+
+class JSONFilterTest(TestCase):
+    def setUp(self):
+        self.documents = [
+            {'facility_id': 'A1', 'sector': 'health', 'lga': 'Dala',
+             'gps': {'elevation': 480, 'accurate': True}},
+            {'facility_id': 'A2', 'sector': 'health', 'lga': 'Fagge',
+             'gps': {'elevation': 470, 'accurate': False}},
+            {'facility_id': 'B1', 'sector': 'education', 'lga': 'Dala',
+             'phone': None},
+            None,
+        ]
+        for i, document in enumerate(self.documents):
+            Facility.objects.create(
+                facility_name='Facility %d' % i, facility_type='Zonal Store',
+                facility_status='ok', json=document)
+
+    def names(self, queryset):
+        return sorted(f.facility_name for f in queryset)
+
+    def test_filter_on_string_values(self):
+        self.assertEqual(
+            self.names(Facility.objects.json_filter(sector='health',
+                                                    lga='Dala')),
+            ['Facility 0'])
+        self.assertEqual(
+            self.names(Facility.objects.json_filter(lga='Dala')),
+            ['Facility 0', 'Facility 2'])
+
+    def test_filter_on_nested_numbers_and_booleans(self):
+        self.assertEqual(
+            self.names(Facility.objects.json_filter(gps__elevation=470)),
+            ['Facility 1'])
+        self.assertEqual(
+            self.names(Facility.objects.json_filter(gps__accurate=True)),
+            ['Facility 0'])
+
+    def test_filter_combines_with_other_filters(self):
+        facilities = Facility.objects.filter(
+            facility_name__endswith='2').json_filter(sector='education')
+        self.assertEqual(self.names(facilities), ['Facility 2'])
+        self.assertEqual(
+            self.names(Facility.objects.json_filter(sector='health').exclude(
+                facility_name='Facility 0')),
+            ['Facility 1'])
+
+    def test_contacts_filtered_too(self):
+        Contact.objects.create(contact_name='Contact 1', contact_phone='0',
+                               contact_email='a@b.cc', json={'role': 'nurse'})
+        self.assertEqual(Contact.objects.json_filter(role='nurse').count(), 1)
+        self.assertEqual(Contact.objects.json_filter(role='doctor').count(), 0)
+
+    def test_unsupported_keys_rejected(self):
+        with self.assertRaises(ValueError):
+            Facility.objects.json_filter(**{"lga')--": 'Dala'})
+
+    def test_filter_uses_the_index_on_the_path(self):
+        queryset = Facility.objects.json_filter(lga='Dala')
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = ' '.join(unicode(row[-1]) for row in cursor.fetchall())
+        indexes = dict(jsondb.index_statements(connection, Facility))
+        self.assertTrue(any(name in plan for name in indexes), plan)
+
+
+class JSONStorageTest(TestCase):
+    class PostgreSQL(object):
+        vendor = 'postgresql'
+        pg_version = 90400
+
+    def test_jsonb_used_on_postgresql(self):
+        field = Facility._meta.get_field('json')
+        self.assertEqual(field.db_type(self.PostgreSQL()), 'jsonb')
+        with self.settings(FM_JSON_STORAGE='json'):
+            self.assertEqual(field.db_type(self.PostgreSQL()), 'json')
+        self.assertEqual(field.db_type(connection), 'text')
+
+    @override_settings(FM_JSON_INDEXED_PATHS={'fm.Facility': ['sector'],
+                                              'fm.Contact': ['role']})
+    def test_missing_indexes_created_by_the_command(self):
+        out = StringIO()
+        call_command('update_json_storage', stdout=out)
+        self.assertIn('Created index fm_contact_json_', out.getvalue())
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'"
+                       " AND tbl_name = 'fm_contact'")
+        self.assertIn(jsondb.index_statements(connection, Contact)[0][0],
+                      [row[0] for row in cursor.fetchall()])
+        out = StringIO()
+        call_command('update_json_storage', stdout=out)
+        self.assertEqual(out.getvalue(), '')
@@ -0,0 +1,281 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from django.utils import unittest
+
+from fm import mdg
+
+
+class MDGStandIn(HTTPServer):
+    """A local HTTP server standing in for the MDG site."""
+
+    def __init__(self, documents):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MDGStandInHandler)
+        self.documents = documents
+        self.truncated = set()
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/static/lgas/' % self.server_port
+
+
+class MDGStandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        name = self.path.rsplit('/', 1)[-1]
+        self.server.requests.append(name)
+        content = self.server.documents.get(name)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if name in self.server.truncated:
+            content = content[:len(content) // 2]
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadDocumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.documents = dict(
+            ('kano_lga%d.json' % i,
+             json.dumps({'facilities': [{'id': i}] * 100}))
+            for i in range(5))
+        self.server = MDGStandIn(self.documents)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def download(self, names=None, **kwargs):
+        if names is None:
+            names = sorted(self.documents)
+        return mdg.download_documents(
+            [(mdg.lga_document_url(n, self.server.url), n) for n in names],
+            self.directory, workers=3, **kwargs)
+
+    def test_documents_downloaded_and_recorded_in_the_manifest(self):
+        results = self.download()
+        self.assertEqual(set(s for s, _ in results.values()),
+                         {mdg.DOWNLOADED})
+        manifest = mdg.DownloadManifest(self.directory)
+        for name, content in self.documents.items():
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+            entry = manifest.get(name)
+            self.assertEqual(entry['size'], len(content))
+            self.assertEqual(entry['sha256'],
+                             hashlib.sha256(content).hexdigest())
+            self.assertTrue(entry['etag'])
+
+    def test_intact_documents_not_downloaded_again(self):
+        self.download()
+        del self.server.requests[:]
+        results = self.download()
+        self.assertEqual(set(s for s, _ in results.values()), {mdg.CACHED})
+        self.assertEqual(self.server.requests, [])
+
+    def test_damaged_documents_downloaded_again(self):
+        self.download()
+        with open(os.path.join(self.directory, 'kano_lga1.json'), 'wb') as f:
+            f.write('{"facilities": [')
+        del self.server.requests[:]
+        results = self.download()
+        self.assertEqual(results['kano_lga1.json'][0], mdg.DOWNLOADED)
+        self.assertEqual(self.server.requests, ['kano_lga1.json'])
+
+    def test_revalidation_uses_etags(self):
+        self.download()
+        self.documents['kano_lga2.json'] = '{"facilities": []}'
+        results = self.download(revalidate=True)
+        self.assertEqual(results['kano_lga1.json'][0], mdg.NOT_MODIFIED)
+        self.assertEqual(results['kano_lga2.json'][0], mdg.DOWNLOADED)
+
+    def test_truncated_download_fails_without_leaving_files_behind(self):
+        self.server.truncated.add('kano_lga3.json')
+        results = self.download()
+        self.assertEqual(results['kano_lga3.json'][0], mdg.FAILED)
+        self.assertIn('Truncated', results['kano_lga3.json'][1])
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted([mdg.MANIFEST_NAME] +
+                   [n for n in self.documents if n != 'kano_lga3.json']))
+        self.assertIsNone(
+            mdg.DownloadManifest(self.directory).get('kano_lga3.json'))
+
+    def test_interrupted_run_resumed(self):
+        self.server.truncated.add('kano_lga3.json')
+        self.download()
+        self.server.truncated.clear()
+        del self.server.requests[:]
+        results = self.download()
+        self.assertEqual(self.server.requests, ['kano_lga3.json'])
+        self.assertEqual(results['kano_lga3.json'][0], mdg.DOWNLOADED)
+
+    def test_missing_document_reported_as_failed(self):
+        results = self.download(['kano_nowhere.json'])
+        self.assertEqual(results['kano_nowhere.json'][0], mdg.FAILED)
+
+    def test_document_names_follow_the_mdg_convention(self):
+        self.assertEqual(mdg.lga_document_name('Kano', 'Dawakin-Kudu'),
+                         'kano_dawakin_kudu.json')
+        self.assertEqual(mdg.lga_document_name('Kano', 'Garun Mallam'),
+                         'kano_garun_mallam.json')
+
+
+class IterFacilitiesTest(unittest.TestCase):
+    DOCUMENT = {
+        'lga': {'name': 'Dala', 'notes': u'brackets ]}[{ and "quotes" \\'},
+        'gap_sheets': [[1, 2.5e3, None], {'nested': [{}, []]}],
+        'facilities': [
+            {'facility_id': 'A1', 'sector': 'health',
+             'facility_name': u'Kofar Mazugal \u00c9 Clinic',
+             'ward': 'Kofar Mazugal', 'beds': 12},
+            {'facility_id': 'B1', 'sector': 'education',
+             'facility_name': 'Dala Primary School', 'ward': 'Gwammaja'},
+            {'facility_id': 'A2', 'sector': 'health',
+             'facility_name': 'Gwammaja {PHC}', 'ward': 'Gwammaja'},
+            {'facility_id': 'C1', 'sector': 'water',
+             'facility_name': 'Borehole "7"', 'ward': 'Dala'},
+        ],
+        'population': 418759,
+        'summary': 'done',
+    }
+
+    def facilities(self, content, **kwargs):
+        return list(mdg.iter_facilities(io.BytesIO(content), **kwargs))
+
+    def expected(self, sectors=('health',)):
+        return [f for f in json.loads(json.dumps(self.DOCUMENT))['facilities']
+                if sectors is None or f['sector'] in sectors]
+
+    def test_only_facilities_of_the_sectors_yielded(self):
+        content = json.dumps(self.DOCUMENT)
+        self.assertEqual(self.facilities(content), self.expected())
+        self.assertEqual(
+            self.facilities(content, sectors=('education', 'water')),
+            self.expected(('education', 'water')))
+        self.assertEqual(self.facilities(content, sectors=None),
+                         self.expected(None))
+
+    def test_result_independent_of_chunk_size_and_formatting(self):
+        for content in (json.dumps(self.DOCUMENT),
+                        json.dumps(self.DOCUMENT, indent=4),
+                        json.dumps(self.DOCUMENT, ensure_ascii=False
+                                   ).encode('utf-8')):
+            for chunk_size in (1, 2, 3, 7, 64, 65536):
+                self.assertEqual(
+                    self.facilities(content, chunk_size=chunk_size,
+                                    sectors=None),
+                    self.expected(None))
+
+    def test_empty_and_missing_facilities(self):
+        self.assertEqual(self.facilities('{}'), [])
+        self.assertEqual(self.facilities('{"facilities": []}'), [])
+        self.assertEqual(self.facilities('{"lga": {"name": "Dala"}}'), [])
+
+    def test_invalid_documents_rejected(self):
+        for content in ('', '[]', '{"facilities": [{"sector": "health"}',
+                        '{"facilities": [{"sector": "health"} {}]}',
+                        '{"lga": {"name": "Dala"}'):
+            with self.assertRaises(mdg.StreamingParseError):
+                self.facilities(content, chunk_size=4)
+
+    def test_facilities_parsed_one_at_a_time(self):
+        document = json.dumps({'facilities': [
+            {'sector': 'health', 'padding': 'x' * 1000}] * 100})
+        source = io.BytesIO(document)
+        facilities = mdg.iter_facilities(source, chunk_size=1024)
+        next(facilities)
+        # only the beginning of the document has been read
+        self.assertLess(source.tell(), 4096)
+        self.assertEqual(len(list(facilities)), 99)
+
+
+class TransformDocumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.documents = []
+        for lga_name, wards in (('Dala', ['gwammaja', 'Kofar.Mazugal',
+                                          'GWAMMAJA']),
+                                ('Dawakin-Kudu', ['Dawaki']),
+                                ('Fagge', ['Fagge  A', 'fagge a'])):
+            facilities = [{'facility_id': '%s%d' % (lga_name, i),
+                           'sector': 'health', 'ward': ward,
+                           'facility_name': u'clinic %d \u00e9' % i}
+                          for i, ward in enumerate(wards)]
+            facilities.insert(1, {'facility_id': 'school', 'ward': 'x',
+                                  'sector': 'education',
+                                  'facility_name': 'School'})
+            path = os.path.join(self.directory, lga_name)
+            with open(path, 'wb') as f:
+                json.dump({'facilities': facilities}, f)
+            self.documents.append((lga_name, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_normalised_and_wards_deduplicated(self):
+        records = [json.loads(r) for r in
+                   mdg.transform_documents('kano', self.documents,
+                                           processes=1)]
+        areas = [(r['area_name'], r['area_type'], r['area_parent'])
+                 for r in records if r['model'] == 'area']
+        self.assertEqual(areas, [
+            ('Kano', 'State', None),
+            ('Dala', 'LGA', 'Kano (State)'),
+            ('Dawakin-Kudu', 'LGA', 'Kano (State)'),
+            ('Fagge', 'LGA', 'Kano (State)'),
+            ('Gwammaja', 'Ward', 'Dala (LGA in Kano)'),
+            ('Kofar Mazugal', 'Ward', 'Dala (LGA in Kano)'),
+            ('Dawaki', 'Ward', 'Dawakin-Kudu (LGA in Kano)'),
+            ('Fagge A', 'Ward', 'Fagge (LGA in Kano)'),
+        ])
+        facilities = [r for r in records if r['model'] == 'facility']
+        self.assertEqual(
+            [(f['json']['facility_id'], f['facility_area']) for f in
+             facilities],
+            [('Dala0', 'Gwammaja (Ward in Dala in Kano)'),
+             ('Dala1', 'Kofar Mazugal (Ward in Dala in Kano)'),
+             ('Dala2', 'Gwammaja (Ward in Dala in Kano)'),
+             ('Dawakin-Kudu0', 'Dawaki (Ward in Dawakin-Kudu in Kano)'),
+             ('Fagge0', 'Fagge A (Ward in Fagge in Kano)'),
+             ('Fagge1', 'Fagge A (Ward in Fagge in Kano)')])
+        self.assertEqual(facilities[0]['facility_name'], u'Clinic 0 \u00c9')
+        self.assertEqual(facilities[0]['facility_type'], 'Health Facility')
+        self.assertEqual(facilities[0]['facility_status'],
+                         mdg.MDG_FACILITY_STATUS)
+
+    def test_process_pool_output_identical_to_sequential_output(self):
+        sequential = mdg.transform_documents('Kano', self.documents,
+                                             processes=1)
+        self.assertEqual(
+            mdg.transform_documents('Kano', self.documents, processes=2),
+            sequential)
+        self.assertEqual(
+            mdg.transform_documents('Kano', self.documents * 2, processes=3),
+            mdg.transform_documents('Kano', self.documents * 2, processes=1))
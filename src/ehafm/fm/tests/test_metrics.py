@@ -0,0 +1,121 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import logging
+import re
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpRequest
+from django.test import TestCase
+
+from fm import capture, metrics
+from fm.models import Area, Facility
+
+
+def metric(text, name, view, le=None):
+    labels = 'view="%s"' % view
+    if le is not None:
+        labels += ',le="%s"' % le
+    match = re.search(r'^%s\{%s\} (\S+)$' % (re.escape(name),
+                                            re.escape(labels)), text, re.M)
+    return None if match is None else float(match.group(1))
+
+
+class QueryMetricsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry = metrics.Registry()
+        User.objects.create_superuser('admin', 'admin@b.cc', 'adminpasswd')
+        User.objects.create_user('user1', 'user@b.cc', 'userpasswd')
+        self.client.login(username='admin', password='adminpasswd')
+
+    def test_requests_recorded_per_view(self):
+        self.client.get('/fm/facilities/')
+        self.client.get('/fm/facilities/')
+        self.client.get('/fm/areas/')
+        text = self.client.get('/fm/metrics').content.decode()
+        self.assertEqual(metric(text, 'fm_request_duration_seconds_count',
+                                'fm_facilities'), 2)
+        self.assertEqual(metric(text, 'fm_request_queries_bucket',
+                                'fm_areas', '+Inf'), 1)
+        self.assertGreater(metric(text, 'fm_request_queries_sum',
+                                  'fm_facilities'), 0)
+        self.assertIn('# TYPE fm_request_db_duration_seconds histogram', text)
+
+    def test_duplicate_queries_counted_and_alerted(self):
+        def get_areas_one_by_one(request):
+            for area_id in (area.id, area.id, area.id):
+                Area.objects.get(pk=area_id)
+
+        area = Area.objects.create(area_name='Kano', area_type='State')
+        with self.settings(FM_QUERY_ALERT_THRESHOLD=2):
+            middleware = metrics.QueryMetricsMiddleware()
+            request = HttpRequest()
+            request.path = '/x'
+            middleware.process_request(request)
+            get_areas_one_by_one(request)
+            logged = []
+            handler = logging.Handler()
+            handler.emit = lambda record: logged.append(record.getMessage())
+            metrics.logger.addHandler(handler)
+            try:
+                middleware.process_response(request, None)
+            finally:
+                metrics.logger.removeHandler(handler)
+        self.assertEqual(len(logged), 1)
+        self.assertIn('3 queries (2 duplicates', logged[0])
+        self.assertIn('3x ', logged[0])
+        self.assertIn('FROM "fm_area"', logged[0])
+        metrics.registry.flush()
+        totals = metrics.totals()['unresolved']
+        self.assertEqual(totals[('request_duplicate_queries_total', 'sum')], 2)
+        self.assertEqual(totals[('request_query_alerts_total', 'sum')], 1)
+        self.assertEqual(totals[('request_queries', 'sum')], 3)
+
+    def test_queries_counted_without_the_debug_cursor(self):
+        middleware = metrics.QueryMetricsMiddleware()
+        request = HttpRequest()
+        request.path = '/x'
+        middleware.process_request(request)
+        self.assertFalse(connection.use_debug_cursor)
+        kept = len(connection.queries)
+        Area.objects.count()
+        middleware.process_response(request, None)
+        self.assertEqual(len(connection.queries), kept)
+        self.assertFalse(capture.capturing())
+        metrics.registry.flush()
+        self.assertEqual(metrics.totals()['unresolved'][
+            ('request_queries', 'sum')], 1)
+
+    def test_metrics_shared_by_processes_through_the_cache(self):
+        other = metrics.Registry()
+        other.record('fm_areas', 0.02, 0.001, 3, 0, False)
+        other.flush()
+        metrics.registry.record('fm_areas', 0.3, 0.2, 30, 1, False)
+        text = metrics.prometheus_text()
+        self.assertEqual(metric(text, 'fm_request_queries_count',
+                                'fm_areas'), 2)
+        self.assertEqual(metric(text, 'fm_request_queries_bucket',
+                                'fm_areas', '5'), 1)
+        self.assertEqual(metric(text, 'fm_request_queries_sum',
+                                'fm_areas'), 33)
+        self.assertEqual(metric(text, 'fm_request_duration_seconds_sum',
+                                'fm_areas'), 0.32)
+
+    def test_query_count_does_not_grow_when_recorded(self):
+        area = Area.objects.create(area_name='Kano', area_type='State')
+        for i in range(3):
+            Facility.objects.create(facility_name='F%d' % i,
+                                    facility_area=area)
+        with self.assertNumQueries(0):
+            metrics.registry.record('fm_facilities', 0.1, 0.01, 5, 0, False)
+            metrics.registry.flush()
+
+    def test_metrics_page_for_staff_only(self):
+        self.client.logout()
+        self.client.login(username='user1', password='userpasswd')
+        response = self.client.get('/fm/metrics', follow=True)
+        self.assertContains(response, 'Log in')
+        self.assertNotContains(response, 'fm_request')
@@ -1,12 +1,19 @@
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
 
+from StringIO import StringIO
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
 
 from fm.models import Area
 from fm.models import Facility
 from fm.models import Contact
 from fm.models import Role
+from fm.models import FacilityCount
+from fm.slowlog import full_scan
 
 
 class AreaModelTest(TestCase):
@@ -67,6 +74,140 @@ class AreaModelTest(TestCase):
         self.assertIn(area1, Area.objects.all())
         self.assertEqual(0, area1.area_children.count())
 
+    def test_area_label_is_stored_and_read_without_queries(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        area1 = Area.objects.create(area_name='Area 1', area_type='LGA',
+                                    area_parent=area0)
+        area2 = Area.objects.create(area_name='Area 2', area_type='Ward',
+                                    area_parent=area1)
+        area2 = Area.objects.get(id=area2.id)
+        self.assertEqual(area2.area_path, '/%d/%d/' % (area0.id, area1.id))
+        self.assertEqual(area2.area_label, 'Area 2 (Ward in Area 1 in Area 0)')
+        with self.assertNumQueries(0):
+            self.assertEqual(u'Area 2 (Ward in Area 1 in Area 0)',
+                             area2.__unicode__())
+
+    def test_unsaved_area_string_contains_its_path(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        area1 = Area(area_name='Area 1', area_type='LGA', area_parent=area0)
+        self.assertEqual(u'Area 1 (LGA in Area 0)', area1.__unicode__())
+
+    def test_renaming_an_area_updates_the_labels_of_its_descendants(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        area1 = Area.objects.create(area_name='Area 1', area_type='LGA',
+                                    area_parent=area0)
+        area2 = Area.objects.create(area_name='Area 2', area_type='Ward',
+                                    area_parent=area1)
+        area0.area_name = 'Area X'
+        area0.save()
+        area2 = Area.objects.get(id=area2.id)
+        self.assertEqual(u'Area 2 (Ward in Area 1 in Area X)',
+                         area2.__unicode__())
+
+    def test_reparenting_an_area_updates_the_paths_of_its_descendants(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        area1 = Area.objects.create(area_name='Area 1', area_type='State')
+        area2 = Area.objects.create(area_name='Area 2', area_type='LGA',
+                                    area_parent=area0)
+        area3 = Area.objects.create(area_name='Area 3', area_type='Ward',
+                                    area_parent=area2)
+        area2.area_parent = area1
+        area2.save()
+        area3 = Area.objects.get(id=area3.id)
+        self.assertEqual(area3.area_path, '/%d/%d/' % (area1.id, area2.id))
+        self.assertEqual(u'Area 3 (Ward in Area 2 in Area 1)',
+                         area3.__unicode__())
+
+    def test_area_cannot_become_its_own_ancestor(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        area1 = Area.objects.create(area_name='Area 1', area_type='LGA',
+                                    area_parent=area0)
+        area0.area_parent = area1
+        with self.assertRaises(ValidationError):
+            area0.full_clean()
+        with self.assertRaises(ValueError):
+            area0.save()
+
+    def test_descendants_detached_on_ancestor_delete(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        area1 = Area.objects.create(area_name='Area 1', area_type='LGA',
+                                    area_parent=area0)
+        area2 = Area.objects.create(area_name='Area 2', area_type='Ward',
+                                    area_parent=area1)
+        area0.delete()
+        area2 = Area.objects.get(id=area2.id)
+        self.assertEqual(area2.area_path, '/%d/' % area1.id)
+        self.assertEqual(u'Area 2 (Ward in Area 1)', area2.__unicode__())
+
+    def test_natural_key_is_unique(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        Area.objects.create(area_name='Area 1', area_type='LGA',
+                            area_parent=area0)
+        Area.objects.create(area_name='Area 1', area_type='Ward',
+                            area_parent=area0)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Area.objects.create(area_name='Area 1', area_type='LGA',
+                                area_parent=area0)
+
+    def add_kano(self):
+        kano = Area.objects.create(area_name='Kano', area_type='State')
+        dala = Area.objects.create(area_name='Dala', area_type='LGA',
+                                   area_parent=kano)
+        fagge = Area.objects.create(area_name='Fagge', area_type='LGA',
+                                    area_parent=kano)
+        for parent, names in ((dala, ['Gwammaja', 'Kofar Mazugal']),
+                              (fagge, ['Fagge A'])):
+            for name in names:
+                Area.objects.create(area_name=name, area_type='Ward',
+                                    area_parent=parent)
+        Area.objects.create(area_name='Lagos', area_type='State')
+        return kano, dala
+
+    def test_descendants_found_at_any_depth_in_one_query(self):
+        kano, dala = self.add_kano()
+        with self.assertNumQueries(1):
+            wards = sorted(a.area_name for a in Area.objects.descendants_of(
+                kano).filter(area_type='Ward'))
+        self.assertEqual(wards, ['Fagge A', 'Gwammaja', 'Kofar Mazugal'])
+        self.assertEqual(
+            sorted(a.area_name for a in Area.objects.descendants_of(
+                dala, include_self=True)),
+            ['Dala', 'Gwammaja', 'Kofar Mazugal'])
+        ward = Area.objects.get(area_name='Gwammaja')
+        self.assertEqual(list(Area.objects.descendants_of(ward)), [])
+
+    def test_descendants_follow_reparenting(self):
+        kano, dala = self.add_kano()
+        lagos = Area.objects.get(area_name='Lagos')
+        dala.area_parent = lagos
+        dala.save()
+        self.assertEqual(
+            sorted(a.area_name for a in Area.objects.descendants_of(lagos)),
+            ['Dala', 'Gwammaja', 'Kofar Mazugal'])
+        self.assertEqual(Area.objects.descendants_of(kano).count(), 2)
+
+    def test_ancestors_listed_from_the_root_down(self):
+        self.add_kano()
+        ward = Area.objects.get(area_name='Kofar Mazugal')
+        with self.assertNumQueries(1):
+            names = [a.area_name for a in Area.objects.ancestors_of(ward)]
+        self.assertEqual(names, ['Kano', 'Dala'])
+        self.assertEqual(
+            [a.area_name for a in Area.objects.ancestors_of(
+                ward, include_self=True)],
+            ['Kano', 'Dala', 'Kofar Mazugal'])
+
+    def test_rebuild_paths_repairs_stale_ancestry(self):
+        area0 = Area.objects.create(area_name='Area 0', area_type='State')
+        area1 = Area.objects.create(area_name='Area 1', area_type='LGA',
+                                    area_parent=area0)
+        Area.objects.filter(pk=area0.id).update(area_name='Area X')
+        Area.objects.filter(pk=area1.id).update(area_path='/', area_label='')
+        self.assertEqual(Area.objects.rebuild_paths(), 2)
+        area1 = Area.objects.get(id=area1.id)
+        self.assertEqual(area1.area_path, '/%d/' % area0.id)
+        self.assertEqual(area1.area_label, u'Area 1 (LGA in Area X)')
+
 
 class FacilityModelTest(TestCase):
     def test_default_field_values(self):
@@ -76,6 +217,79 @@ class FacilityModelTest(TestCase):
         self.assertEqual(facility.facility_area, None)
         self.assertEqual(facility.json, None)
 
+    def test_external_id_copied_from_the_json_document(self):
+        facility = Facility.objects.create(json={'facility_id': 'A1'})
+        self.assertEqual(facility.facility_external_id, 'A1')
+        facility.json = {'sector': 'health'}
+        facility.save()
+        self.assertIsNone(Facility.objects.get(
+            id=facility.id).facility_external_id)
+
+    def test_has_json_kept_up_to_date(self):
+        facility = Facility.objects.create(json={'facility_id': 'A1'})
+        self.assertTrue(Facility.objects.get(id=facility.id).has_json)
+        facility.json = None
+        facility.save()
+        self.assertFalse(Facility.objects.get(id=facility.id).has_json)
+
+    def test_rebuild_has_json_backfills_the_flags(self):
+        Facility.objects.bulk_create([
+            Facility(facility_name='A', json={'facility_id': 'A1'}),
+            Facility(facility_name='B', has_json=True),
+            Facility(facility_name='C', json={}, has_json=True)])
+        Contact.objects.bulk_create([Contact(contact_name='A', json=[])])
+        out = StringIO()
+        call_command('rebuild_has_json', stdout=out)
+        self.assertEqual(
+            dict(Facility.objects.values_list('facility_name', 'has_json')),
+            {'A': True, 'B': False, 'C': True})
+        self.assertTrue(Contact.objects.get().has_json)
+        self.assertEqual(out.getvalue(),
+                         '2 facility(s) updated.\n1 contact(s) updated.\n')
+
+    def test_external_id_is_unique(self):
+        Facility.objects.create(json={'facility_id': 'A1'})
+        facility = Facility(facility_name='F', facility_type='LGA Store',
+                            facility_status='ok', json={'facility_id': 'A1'})
+        with self.assertRaisesMessage(ValidationError, 'facility_id A1'):
+            facility.full_clean()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            facility.save()
+
+    def test_facilities_within_an_area_and_its_subareas(self):
+        kano = Area.objects.create(area_name='Kano', area_type='State')
+        dala = Area.objects.create(area_name='Dala', area_type='LGA',
+                                   area_parent=kano)
+        ward = Area.objects.create(area_name='Gwammaja', area_type='Ward',
+                                   area_parent=dala)
+        lagos = Area.objects.create(area_name='Lagos', area_type='State')
+        for name, area in (('Store', kano), ('LGA Store', dala),
+                           ('Clinic', ward), ('Other', lagos),
+                           ('Nowhere', None)):
+            Facility.objects.create(facility_name=name, facility_area=area)
+        with self.assertNumQueries(1):
+            names = sorted(f.facility_name for f in
+                           Facility.objects.within(kano))
+        self.assertEqual(names, ['Clinic', 'LGA Store', 'Store'])
+        self.assertEqual(
+            sorted(f.facility_name for f in Facility.objects.within(dala)),
+            ['Clinic', 'LGA Store'])
+        self.assertEqual(
+            [f.facility_name for f in Facility.objects.within(
+                kano, include_subareas=False)],
+            ['Store'])
+        self.assertEqual(Facility.objects.within(kano).filter(
+            facility_name='Clinic').count(), 1)
+
+    def test_facilities_within_an_area_looked_up_by_indexes(self):
+        kano = Area.objects.create(area_name='Kano', area_type='State')
+        sql, params = Facility.objects.within(kano).query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = '\n'.join(unicode(row[-1]) for row in cursor.fetchall())
+        # the facilities by the index on facility_area, not a table scan
+        self.assertFalse(full_scan(connection.vendor, plan), plan)
+
     def test_area_set_correctly_on_adding_a_facility_to_an_area(self):
         facility = Facility.objects.create()
         area = Area.objects.create()
@@ -139,6 +353,13 @@ class ContactModelTest(TestCase):
         self.assertEqual(contact.contact_email, '')
         self.assertEqual(contact.json, None)
 
+    def test_has_json_kept_up_to_date(self):
+        contact = Contact.objects.create(json={'role': 'nurse'})
+        self.assertTrue(Contact.objects.get(id=contact.id).has_json)
+        contact.json = None
+        contact.save()
+        self.assertFalse(Contact.objects.get(id=contact.id).has_json)
+
     def test_by_default_contact_string_contains_its_name(self):
         contact = Contact.objects.create(contact_name='Contact 0',
                                          contact_phone='055555',
@@ -225,3 +446,110 @@ class RoleModelTest(TestCase):
         facility = Facility.objects.get(id=facility.id)
         self.assertNotIn(role, contact.contact_roles.all())
         self.assertNotIn(role, facility.facility_roles.all())
+
+
+class FacilityCountTest(TestCase):
+    def setUp(self):
+        self.kano = Area.objects.create(area_name='Kano', area_type='State')
+        self.dala = Area.objects.create(area_name='Dala', area_type='LGA',
+                                        area_parent=self.kano)
+        self.ward = Area.objects.create(area_name='Gwammaja',
+                                        area_type='Ward',
+                                        area_parent=self.dala)
+        self.lagos = Area.objects.create(area_name='Lagos', area_type='State')
+
+    def add(self, area, status='ok', facility_type='Health Facility'):
+        return Facility.objects.create(facility_name='F', facility_area=area,
+                                       facility_type=facility_type,
+                                       facility_status=status)
+
+    def counts(self, area):
+        return FacilityCount.objects.counts_for(area)
+
+    def assertRebuildKeepsCounts(self):
+        counts = sorted(FacilityCount.objects.values_list(
+            'area', 'facility_type', 'facility_status', 'facility_count'))
+        FacilityCount.objects.rebuild()
+        self.assertEqual(sorted(FacilityCount.objects.values_list(
+            'area', 'facility_type', 'facility_status', 'facility_count')),
+            counts)
+
+    def test_facilities_counted_in_their_areas_and_all_ancestors(self):
+        self.add(self.ward)
+        self.add(self.ward, 'broken')
+        self.add(self.dala, facility_type='LGA Store')
+        self.add(None)
+        with self.assertNumQueries(1):
+            counts = self.counts(self.kano)
+        self.assertEqual(counts, [('Health Facility', 'broken', 1),
+                                  ('Health Facility', 'ok', 1),
+                                  ('LGA Store', 'ok', 1)])
+        self.assertEqual(self.counts(self.ward),
+                         [('Health Facility', 'broken', 1),
+                          ('Health Facility', 'ok', 1)])
+        self.assertEqual(self.counts(self.lagos), [])
+        self.assertRebuildKeepsCounts()
+
+    def test_counts_follow_facility_changes_and_deletes(self):
+        facility = self.add(self.ward)
+        self.add(self.ward)
+        facility.facility_status = 'broken'
+        facility.save()
+        self.assertEqual(self.counts(self.kano),
+                         [('Health Facility', 'broken', 1),
+                          ('Health Facility', 'ok', 1)])
+        facility.facility_area = self.lagos
+        facility.save()
+        self.assertEqual(self.counts(self.kano),
+                         [('Health Facility', 'ok', 1)])
+        self.assertEqual(self.counts(self.lagos),
+                         [('Health Facility', 'broken', 1)])
+        facility.delete()
+        self.assertEqual(self.counts(self.lagos), [])
+        self.assertRebuildKeepsCounts()
+
+    def test_counts_follow_reparented_areas(self):
+        self.add(self.ward)
+        self.add(self.dala)
+        self.dala.area_parent = self.lagos
+        self.dala.save()
+        self.assertEqual(self.counts(self.kano), [])
+        self.assertEqual(self.counts(self.lagos),
+                         [('Health Facility', 'ok', 2)])
+        self.assertEqual(self.counts(self.ward),
+                         [('Health Facility', 'ok', 1)])
+        self.assertRebuildKeepsCounts()
+
+    def test_counts_follow_deleted_areas(self):
+        self.add(self.ward)
+        self.add(self.dala)
+        self.add(self.kano)
+        Area.objects.get(pk=self.dala.pk).delete()
+        # the facility in Dala has no area now, the ward is a root
+        self.assertEqual(self.counts(self.kano),
+                         [('Health Facility', 'ok', 1)])
+        self.assertEqual(self.counts(self.ward),
+                         [('Health Facility', 'ok', 1)])
+        self.assertRebuildKeepsCounts()
+
+    def test_counts_inserted_meanwhile_by_another_transaction_added_to(self):
+        self.add(self.ward)
+        key = (self.ward.pk, 'Health Facility', 'ok')
+        # as if another import had inserted the count after it was looked up
+        FacilityCount.objects._create({key: 2})
+        self.assertEqual(self.counts(self.ward),
+                         [('Health Facility', 'ok', 3)])
+        FacilityCount.objects._create({key: 1, (self.kano.pk, 'x', 'y'): 1})
+        self.assertEqual(self.counts(self.ward),
+                         [('Health Facility', 'ok', 4)])
+        self.assertEqual(self.counts(self.kano),
+                         [('Health Facility', 'ok', 1), ('x', 'y', 1)])
+
+    def test_rebuild_command_repairs_the_counts(self):
+        self.add(self.ward)
+        FacilityCount.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_facility_counts', stdout=out)
+        self.assertIn('3 count(s) stored.', out.getvalue())
+        self.assertEqual(self.counts(self.kano),
+                         [('Health Facility', 'ok', 1)])
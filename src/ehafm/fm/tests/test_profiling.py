@@ -0,0 +1,193 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase
+
+from fm import capture, profiling
+from fm.models import Area
+
+
+def busy_loop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class ProfilerMiddlewareTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        User.objects.create_superuser('admin', 'admin@b.cc', 'adminpasswd')
+        self.client.login(username='admin', password='adminpasswd')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def profile_settings(self, **kwargs):
+        kwargs.setdefault('FM_PROFILE_DIR', self.directory)
+        return self.settings(**kwargs)
+
+    def process(self, view, *args):
+        middleware = profiling.ProfilerMiddleware()
+        request = HttpRequest()
+        request.path = '/x'
+        request.method = 'GET'
+        middleware.process_request(request)
+        response = middleware.process_view(request, view, args, {})
+        if response is None:
+            response = view(request, *args)
+        return middleware.process_response(request, response)
+
+    def test_not_used_unless_enabled(self):
+        with self.profile_settings(FM_PROFILE_SAMPLE_RATE=0.0,
+                                   FM_PROFILE_SLOW_THRESHOLD=None):
+            self.assertRaises(MiddlewareNotUsed,
+                              profiling.ProfilerMiddleware)
+
+    def test_sampled_request_profiled_with_view_and_queries(self):
+        with self.profile_settings(FM_PROFILE_SAMPLE_RATE=1.0):
+            response = self.client.get('/fm/areas/')
+        self.assertEqual(response.status_code, 200)
+        profiles = list(profiling.read_profiles(self.directory))
+        self.assertEqual(len(profiles), 1)
+        profile = profiles[0]
+        self.assertEqual(profile['view'], 'fm_areas')
+        self.assertEqual(profile['mode'], 'cprofile')
+        self.assertEqual(profile['status'], 200)
+        self.assertGreater(profile['query_count'], 0)
+        self.assertEqual(profile['query_count'], len(profile['queries']))
+        self.assertGreaterEqual(profile['duration'], profile['db_duration'])
+        self.assertTrue(any(f['function'].endswith('(areas_view)')
+                            for f in profile['functions']))
+
+    def test_query_parameters_redacted(self):
+        with self.profile_settings(FM_PROFILE_SAMPLE_RATE=1.0):
+            self.client.get('/fm/areas/')
+        profile, = profiling.read_profiles(self.directory)
+        session = [q for q in profile['queries']
+                   if '"django_session"' in q['sql']][0]
+        self.assertIn('%s', session['sql'])
+        self.assertIn(session['params'][0], ('<str>', '<unicode>'))
+        content = open(os.path.join(self.directory,
+                                    os.listdir(self.directory)[0])).read()
+        self.assertNotIn(self.client.session.session_key, content)
+        self.assertNotIn(User.objects.get().password, content)
+
+    def test_queries_of_requests_not_profiled_not_kept(self):
+        with self.profile_settings(FM_PROFILE_SAMPLE_RATE=0.5):
+            middleware = profiling.ProfilerMiddleware()
+        with self.profile_settings(FM_PROFILE_SAMPLE_RATE=0.0):
+            request = HttpRequest()
+            middleware.process_request(request)
+            self.assertFalse(hasattr(request, '_fm_profile'))
+            self.assertFalse(capture.capturing())
+            self.assertFalse(connection.use_debug_cursor)
+
+    def test_view_left_to_the_handler_and_its_exceptions(self):
+        def failing_view(request):
+            raise ValueError('failed')
+
+        with self.profile_settings(FM_PROFILE_SAMPLE_RATE=1.0):
+            middleware = profiling.ProfilerMiddleware()
+            request = HttpRequest()
+            request.path = '/x'
+            request.method = 'GET'
+            middleware.process_request(request)
+            self.assertIsNone(
+                middleware.process_view(request, failing_view, (), {}))
+            try:
+                failing_view(request)
+            except ValueError as e:
+                self.assertIsNone(middleware.process_exception(request, e))
+            middleware.process_response(request, HttpResponse(status=500))
+        profile, = profiling.read_profiles(self.directory)
+        self.assertEqual(profile['status'], 500)
+        self.assertTrue(any(f['function'].endswith('(failing_view)')
+                            for f in profile['functions']))
+
+    def test_ancestry_chain_hot_spot_reported(self):
+        state = Area.objects.create(area_name='Kano', area_type='State')
+        lga = Area.objects.create(area_name='Ajingi', area_type='LGA',
+                                  area_parent=state)
+        ward = Area.objects.create(area_name='Balan', area_type='Ward',
+                                   area_parent=lga)
+
+        def label_unsaved_areas(request):
+            # unsaved areas compute their labels by walking up their parents
+            return HttpResponse(u'\n'.join(
+                unicode(Area(area_name='New %d' % i, area_type='Ward',
+                             area_parent_id=ward.id)) for i in range(50)))
+
+        with self.profile_settings(FM_PROFILE_SAMPLE_RATE=1.0):
+            self.process(label_unsaved_areas)
+        count, functions = profiling.hot_functions(
+            profiling.read_profiles(self.directory), sort='cumulative')
+        self.assertEqual(count, 1)
+        names = [name for name, _, _, _ in functions]
+        self.assertTrue(any(n.startswith(os.path.join('fm', 'models.py')) and
+                            n.endswith('(_ancestry_chain)') for n in names),
+                        names)
+
+    def test_slow_request_sampled(self):
+        def slow(request):
+            busy_loop(0.2)
+            return HttpResponse()
+
+        with self.profile_settings(FM_PROFILE_SLOW_THRESHOLD=0.1,
+                                   FM_PROFILE_SAMPLE_INTERVAL=0.001):
+            self.process(slow)
+        profiles = list(profiling.read_profiles(self.directory))
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['mode'], 'sampling')
+        self.assertGreater(profiles[0]['duration'], 0.1)
+        functions = dict((f['function'], f) for f in profiles[0]['functions'])
+        name = profiling.function_name(
+            busy_loop.__code__.co_filename, None, 'busy_loop')
+        self.assertIn(name, functions)
+        self.assertGreater(functions[name]['samples'], 0)
+
+    def test_fast_request_not_kept(self):
+        with self.profile_settings(FM_PROFILE_SLOW_THRESHOLD=10):
+            self.process(lambda request: HttpResponse())
+        self.assertEqual(list(profiling.read_profiles(self.directory)), [])
+        self.assertEqual(profiling.sampler().samples, {})
+
+    def test_oldest_profiles_removed(self):
+        paths = []
+        for started in range(5):
+            paths.append(profiling.write_profile(
+                {'started': 1400000000 + started, 'view': 'fm_areas',
+                 'functions': []}, self.directory, limit=3))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(os.path.basename(p) for p in paths[2:]))
+
+    def test_report_aggregates_profiles(self):
+        for view, own in (('fm_areas', 0.5), ('fm_areas', 0.25),
+                          ('fm_facilities', 2.0)):
+            profiling.write_profile({
+                'started': time.time(), 'view': view, 'functions': [
+                    {'function': 'fm/models.py:202(_ancestry_chain)',
+                     'self': own, 'cumulative': own * 2},
+                    {'function': 'fm/views.py:10(areas_view)',
+                     'self': 0.1, 'cumulative': 1.0}]}, self.directory)
+        out = StringIO()
+        call_command('profile_report', directory=self.directory,
+                     view='fm_areas', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '2 profiles of fm_areas')
+        self.assertEqual(lines[2].split(),
+                         ['0.7500', '1.5000', '2',
+                          'fm/models.py:202(_ancestry_chain)'])
+        self.assertEqual(lines[3].split()[0], '0.2000')
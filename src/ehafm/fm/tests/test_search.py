@@ -0,0 +1,132 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import json
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpRequest
+from django.test import TestCase
+
+from fm import search
+from fm.importer import import_records
+from fm.models import Area, Contact, Facility, SearchEntry
+from fm.views import search_view
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        kano = Area.objects.create(area_name='Kano', area_type='State')
+        self.dala = Area.objects.create(area_name='Dala', area_type='LGA',
+                                        area_parent=kano)
+        self.clinic = Facility.objects.create(
+            facility_name='Dala Clinic', facility_type='Health Facility',
+            facility_status='ok', facility_area=self.dala)
+        self.store = Facility.objects.create(
+            facility_name='Kano State Store', facility_type='State Store',
+            facility_status='ok', facility_area=kano)
+        self.contact = Contact.objects.create(
+            contact_name='Amina Bello', contact_email='amina@dala.example',
+            contact_phone='08031234567')
+
+    def found(self, query, **kwargs):
+        return [(r['kind'], r['id']) for r in search.search(query, **kwargs)]
+
+    def test_index_used(self):
+        self.assertTrue(search._fts5_available(connection))
+
+    def test_names_matched_by_word_prefixes(self):
+        self.assertEqual(self.found('clin'), [('facility', self.clinic.id)])
+        self.assertEqual(self.found('DALA cli'),
+                         [('facility', self.clinic.id)])
+        self.assertEqual(self.found('stor kan'),
+                         [('facility', self.store.id)])
+        self.assertEqual(self.found('nowhere'), [])
+        self.assertEqual(self.found('  '), [])
+
+    def test_areas_and_contact_details_searched(self):
+        self.assertIn(('area', self.dala.id), self.found('dala'))
+        self.assertIn(('contact', self.contact.id), self.found('dala'))
+        self.assertEqual(self.found('bello'),
+                         [('contact', self.contact.id)])
+        self.assertEqual(self.found('0803123'),
+                         [('contact', self.contact.id)])
+
+    def test_results_ranked_and_capped(self):
+        Facility.objects.create(facility_name='Dala Dala Dala',
+                                facility_type='Health Facility')
+        results = search.search('dala')
+        self.assertEqual(results[0]['label'], 'Dala Dala Dala')
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(search.search('dala', limit=2)), 2)
+        with self.settings(FM_SEARCH_LIMIT=1):
+            self.assertEqual(len(search.search('dala')), 1)
+
+    def test_results_labelled_and_linked(self):
+        result = search.search('clinic')[0]
+        self.assertEqual(result['label'], unicode(self.clinic))
+        self.assertEqual(result['url'],
+                         '/fm/facilities/%d/view' % self.clinic.id)
+
+    def test_index_updated_on_save_and_delete(self):
+        self.clinic.facility_name = 'Gwammaja Health Post'
+        self.clinic.save()
+        self.assertEqual(self.found('clinic'), [])
+        self.assertEqual(self.found('gwammaja'),
+                         [('facility', self.clinic.id)])
+        self.clinic.delete()
+        self.assertEqual(self.found('gwammaja'), [])
+
+    def test_imported_objects_indexed(self):
+        import_records([
+            {'model': 'area', 'area_name': 'Fagge', 'area_type': 'LGA',
+             'area_parent': 'Kano (State)'},
+            {'model': 'facility', 'facility_name': 'Fagge Clinic',
+             'facility_type': 'Health Facility', 'facility_status': 'ok',
+             'facility_area': 'Fagge (LGA in Kano)'}])
+        self.assertEqual(sorted(kind for kind, _ in self.found('fagge')),
+                         ['area', 'facility'])
+
+    def test_rebuild_command_recreates_the_entries(self):
+        SearchEntry.objects.all().delete()
+        self.assertEqual(self.found('clinic'), [])
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('5 object(s) indexed.', out.getvalue())
+        self.assertEqual(self.found('clinic'), [('facility', self.clinic.id)])
+
+
+class SearchViewTest(TestCase):
+    def setUp(self):
+        self.superuser = User.objects.create_superuser(
+            'admin', 'admin@b.cc', 'adminpasswd')
+        Facility.objects.create(facility_name='Dala Clinic',
+                                facility_type='Health Facility')
+
+    def get(self, **params):
+        request = HttpRequest()
+        request.user = self.superuser
+        request.GET.update(params)
+        return search_view(request)
+
+    def test_page_redirects_and_asks_anonymous_users_to_log_in(self):
+        response = self.client.get('/fm/search?q=dala', follow=True)
+        self.assertContains(response, 'Log in')
+
+    def test_results_listed(self):
+        response = self.get(q='dal')
+        self.assertContains(response, 'Dala Clinic')
+        self.assertContains(self.get(q='gwammaja'), 'Nothing found.')
+        self.assertNotContains(self.get(), 'Nothing found.')
+
+    def test_results_as_json(self):
+        response = self.get(q='dal', format='json')
+        self.assertEqual([r['label'] for r in json.loads(response.content)],
+                         ['Dala Clinic'])
+
+    def test_search_box_on_every_page(self):
+        self.client.login(username='admin', password='adminpasswd')
+        response = self.client.get('/fm/facilities/')
+        self.assertContains(response, 'id="id_search_box"')
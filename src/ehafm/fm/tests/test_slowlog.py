@@ -0,0 +1,148 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase
+
+from fm import slowlog
+from fm.models import Area, Contact
+
+
+class SlowQueryLogTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'slow.log')
+
+    def tearDown(self):
+        handler = slowlog._handlers.pop(self.log, None)
+        if handler is not None:
+            handler.close()
+        shutil.rmtree(self.directory)
+
+    def log_settings(self, **kwargs):
+        kwargs.setdefault('FM_SLOW_QUERY_LOG', self.log)
+        kwargs.setdefault('FM_SLOW_QUERY_THRESHOLD', 0)
+        return self.settings(**kwargs)
+
+    def entries(self):
+        return list(slowlog.read_log(self.log))
+
+    def test_default_connection_logs(self):
+        self.assertIsInstance(connections['default'],
+                              slowlog.SlowQueryLogMixin)
+
+    def test_slow_statement_logged_with_redacted_params_and_plan(self):
+        def find_contacts_by_phone():
+            return Contact.objects.filter(contact_phone=u'+234 803',
+                                          pk__gt=7).count()
+
+        with self.log_settings():
+            self.assertEqual(find_contacts_by_phone(), 0)
+        entries = self.entries()
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertIn('"fm_contact"', entry['sql'])
+        self.assertEqual(sorted(entry['params']), [7, '<unicode>'])
+        self.assertNotIn('+234', repr(entry))
+        self.assertIsNone(entry['view'])
+        self.assertEqual(entry['database'], 'default')
+        self.assertTrue(entry['stack'][0].endswith(
+            '(find_contacts_by_phone)'), entry['stack'])
+        self.assertTrue(entry['stack'][0].startswith(
+            os.path.join('fm', 'tests', 'test_slowlog.py')), entry['stack'])
+        self.assertIn('fm_contact', entry['plan'])
+
+    def test_full_scan_flagged(self):
+        with self.log_settings():
+            Contact.objects.filter(contact_phone='1').count()
+            Contact.objects.filter(pk=1).count()
+        full_scan, by_pk = self.entries()
+        self.assertTrue(full_scan['full_scan'], full_scan['plan'])
+        self.assertFalse(by_pk['full_scan'], by_pk['plan'])
+
+    def test_fast_statements_not_logged(self):
+        with self.log_settings(FM_SLOW_QUERY_THRESHOLD=60):
+            Area.objects.count()
+        with self.log_settings(FM_SLOW_QUERY_THRESHOLD=None):
+            Area.objects.count()
+            self.assertNotIsInstance(connection.cursor(),
+                                     slowlog.SlowQueryCursorWrapper)
+        self.assertEqual(self.entries(), [])
+
+    def test_view_of_request_recorded(self):
+        User.objects.create_superuser('admin', 'admin@b.cc', 'adminpasswd')
+        self.client.login(username='admin', password='adminpasswd')
+        with self.log_settings():
+            self.client.get('/fm/areas/')
+        views = set(entry['view'] for entry in self.entries())
+        self.assertIn('fm_areas', views)
+        self.assertIsNone(slowlog._local.request)
+
+    def test_failed_explain_recorded(self):
+        with self.log_settings():
+            entry = slowlog.record(connection, 'SELECT * FROM fm_missing',
+                                   None, 1.0)
+        self.assertIsNone(entry['plan'])
+        self.assertIn('fm_missing', entry['plan_error'])
+        self.assertEqual(self.entries(), [entry])
+
+    def test_statements_without_plans(self):
+        self.assertIsNone(slowlog.explain(connection, 'SAVEPOINT "s1"', None))
+        self.assertIsNone(slowlog.explain(connection, '  ', None))
+
+    def test_full_scan_of_plans(self):
+        self.assertTrue(slowlog.full_scan('sqlite', 'SCAN fm_contact'))
+        self.assertTrue(slowlog.full_scan('sqlite', 'SCAN TABLE fm_contact'))
+        self.assertFalse(slowlog.full_scan(
+            'sqlite', 'SEARCH fm_contact USING INTEGER PRIMARY KEY (rowid=?)'))
+        self.assertFalse(slowlog.full_scan(
+            'sqlite', 'SCAN fm_area USING COVERING INDEX fm_area_1b2c'))
+        self.assertTrue(slowlog.full_scan(
+            'postgresql', 'Seq Scan on fm_contact  (cost=0.00..1.01 rows=1)'))
+        self.assertFalse(slowlog.full_scan(
+            'postgresql', 'Index Scan using fm_contact_pkey on fm_contact'))
+        self.assertFalse(slowlog.full_scan('sqlite', None))
+
+    def test_redact(self):
+        self.assertEqual(slowlog.redact([1, 2L, 0.5, True, None, u'a', 'b']),
+                         [1, 2L, 0.5, True, None, '<unicode>', '<str>'])
+        self.assertEqual(slowlog.redact({'a': 1, 'b': u'x'}),
+                         {'a': 1, 'b': '<unicode>'})
+        self.assertIsNone(slowlog.redact(None))
+
+    def test_log_rotated(self):
+        with self.log_settings(FM_SLOW_QUERY_LOG_MAX_BYTES=2000,
+                               FM_SLOW_QUERY_LOG_BACKUPS=1):
+            for _ in range(20):
+                Contact.objects.filter(contact_phone='1').count()
+            self.assertTrue(os.path.exists(self.log + '.1'))
+            self.assertFalse(os.path.exists(self.log + '.2'))
+            entries = self.entries()
+        self.assertLess(len(entries), 20)
+        self.assertGreater(len(entries), 0)
+
+    def test_summary_and_command(self):
+        with self.log_settings():
+            list(Contact.objects.filter(pk__in=[1, 2]))
+            list(Contact.objects.filter(pk__in=[1, 2, 3]))
+            Contact.objects.filter(contact_phone='1').count()
+            groups = slowlog.summary(self.entries())
+            self.assertEqual(
+                [g['count'] for g in groups if 'IN (%s, ...)' in g['sql']],
+                [2])
+            out = StringIO()
+            call_command('slow_queries', full_scans=True, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertIn('FULL SCAN', lines[0])
+        self.assertIn('"contact_phone" = %s', lines[1])
+        self.assertIn('(test_summary_and_command)', lines[2])
+        self.assertIn('fm_contact', lines[3])
@@ -0,0 +1,75 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from fm import benchmark, metrics, synthetic
+from fm.models import Area, Contact, Facility, FacilityCount, Role
+
+
+class GenerateTest(TestCase):
+    def test_same_seed_same_data(self):
+        first = synthetic.generate(7, scale=0.1)
+        second = synthetic.generate(7, scale=0.1)
+        self.assertEqual(first.records, second.records)
+        self.assertEqual(first.contacts, second.contacts)
+        self.assertEqual(first.roles, second.roles)
+        self.assertNotEqual(synthetic.generate(8, scale=0.1).records,
+                            first.records)
+
+    def test_national_scale_by_default(self):
+        data = synthetic.generate()
+        types = {}
+        for record in data.records:
+            if record['model'] == 'area':
+                types[record['area_type']] = types.get(
+                    record['area_type'], 0) + 1
+        self.assertEqual(types['State'], 36)
+        self.assertEqual(types['State Zone'], 108)
+        self.assertTrue(650 <= types['LGA'] <= 900, types)
+        self.assertTrue(8000 <= types['Ward'] <= 11000, types)
+        self.assertTrue(25000 <= data.counts()['facilities'] <= 35000)
+        documents = [r['json'] for r in data.records
+                     if r['model'] == 'facility' and r['json']]
+        self.assertEqual(len(set(d['facility_id'] for d in documents)),
+                         len(documents))
+        self.assertEqual(documents[0]['sector'], 'health')
+
+
+class LoadTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.data = synthetic.generate(3, states=['Kano'])
+
+    def test_loaded_once_and_counted(self):
+        results, contacts, roles = synthetic.load(self.data)
+        counts = self.data.counts()
+        self.assertEqual(Area.objects.count(), counts['areas'])
+        self.assertEqual(Facility.objects.count(), counts['facilities'])
+        self.assertEqual((contacts, roles),
+                         (counts['contacts'], counts['roles']))
+        self.assertEqual(Role.objects.filter(role_name='SCCO').get(
+            ).role_facility.facility_type, 'State Store')
+        kano = Area.objects.get(area_name='Kano')
+        self.assertEqual(
+            sum(n for _, _, n in FacilityCount.objects.counts_for(kano)),
+            counts['facilities'])
+        self.assertEqual(synthetic.load(self.data)[1:], (0, 0))
+        self.assertEqual(Contact.objects.count(), counts['contacts'])
+
+    def test_benchmark_covers_every_url_and_leaves_no_trace(self):
+        synthetic.load(self.data)
+        rows = [model.objects.count() for model in (Area, Facility, Role)]
+        with self.settings(FM_METRICS_FLUSH_INTERVAL=0):
+            result = benchmark.run(repeat=1)
+        self.assertEqual(metrics.totals(), {})
+        self.assertEqual(result['uncovered'], [])
+        self.assertEqual([v['label'] for v in result['views']
+                          if v['status'] != 200], [])
+        self.assertEqual([s['stage'] for s in result['importer']],
+                         ['transform', 'parse', 'import new',
+                          'import existing'])
+        self.assertLess(result['importer'][3]['queries'][0], 30)
+        self.assertEqual(rows, [model.objects.count()
+                                for model in (Area, Facility, Role)])
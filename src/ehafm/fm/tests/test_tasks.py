@@ -0,0 +1,206 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+
+from fm import mdg, synthetic
+from fm.forms import ImportJobForm
+from fm.models import Area, Facility, ImportJob, ImportJobPart
+from fm.tasks import download_path, start_import
+from fm.tests.test_mdg import MDGStandIn
+
+
+class ImportTasksTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.documents = tempfile.mkdtemp()
+        self.downloads = tempfile.mkdtemp()
+        data = synthetic.generate(states=['Testland'])
+        self.paths = synthetic.write_mdg_documents(data, self.documents)[:3]
+        self.lga_names = [name for name, _ in self.paths]
+        self.source_url = 'file:' + urllib.pathname2url(self.documents) + '/'
+        # the documents are read from the disk, not downloaded
+        self.eager = self.settings(CELERY_ALWAYS_EAGER=True,
+                                   FM_IMPORT_DOWNLOAD_DIR=self.downloads,
+                                   FM_IMPORT_RETRY_DELAY=0,
+                                   FM_IMPORT_URL_SCHEMES=('file',))
+        self.eager.enable()
+
+    def tearDown(self):
+        self.eager.disable()
+        shutil.rmtree(self.documents)
+        shutil.rmtree(self.downloads)
+
+    def expected_records(self, path):
+        wards, facilities = mdg.transform_lga_document(
+            ('Testland', 'unused', path, ('health',), 'Health Facility'))
+        return len(wards) + len(facilities)
+
+    def start(self, lga_names=None):
+        job = start_import('Testland', lga_names or self.lga_names,
+                           source_url=self.source_url)
+        return ImportJob.objects.get(pk=job.pk)
+
+    def test_lgas_imported_in_parts(self):
+        job = self.start()
+        self.assertEqual(job.status, ImportJob.FINISHED)
+        self.assertIsNotNone(job.finished)
+        parts = list(job.parts.order_by('pk'))
+        self.assertEqual([p.lga_name for p in parts], self.lga_names)
+        for part, (_, path) in zip(parts, self.paths):
+            expected = self.expected_records(path)
+            self.assertEqual(part.status, ImportJobPart.FINISHED)
+            self.assertEqual(part.attempts, 1)
+            self.assertEqual((part.parsed, part.inserted, part.updated,
+                              part.skipped, part.failed),
+                             (expected, expected, 0, 0, 0))
+        self.assertEqual(
+            Area.objects.filter(area_type='LGA',
+                                area_parent__area_name='Testland').count(), 3)
+        progress = job.progress()
+        self.assertEqual(progress['inserted'], progress['parsed'])
+        self.assertEqual(progress['lgas'], {ImportJobPart.FINISHED: 3})
+        self.assertEqual(Facility.objects.count() + Area.objects.filter(
+            area_type='Ward').count(), progress['inserted'])
+
+    def test_records_imported_already_skipped(self):
+        self.start()
+        progress = self.start().progress()
+        self.assertEqual(progress['skipped'], progress['parsed'])
+        self.assertEqual(progress['inserted'], 0)
+
+    def test_result_independent_of_chunk_size(self):
+        with self.settings(FM_IMPORT_CHUNK_SIZE=7):
+            progress = self.start().progress()
+        self.assertGreater(progress['parsed'], 7)
+        self.assertEqual(progress['inserted'], progress['parsed'])
+
+    def test_failing_lga_retried_then_failed(self):
+        with self.settings(FM_IMPORT_MAX_RETRIES=2):
+            job = self.start(self.lga_names[:1] + ['Nowhere'])
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertIn('1 LGA', job.error)
+        imported, missing = job.parts.order_by('pk')
+        self.assertEqual(imported.status, ImportJobPart.FINISHED)
+        self.assertEqual(missing.status, ImportJobPart.FAILED)
+        self.assertEqual(missing.attempts, 3)
+        self.assertIn('IOError', missing.error)
+        self.assertEqual(missing.parsed, 0)
+
+    def test_only_urls_with_the_allowed_schemes_downloaded(self):
+        with self.settings(FM_IMPORT_URL_SCHEMES=('http', 'https')):
+            with self.assertRaisesMessage(ValueError, 'file URLs'):
+                self.start()
+        self.assertEqual(ImportJob.objects.count(), 0)
+
+    def test_documents_only_downloaded_into_the_download_dir(self):
+        self.assertEqual(download_path('kano_dala'),
+                         os.path.join(os.path.realpath(self.downloads),
+                                      'kano_dala'))
+        for name in ('../kano', 'a/b', '..', ''):
+            with self.assertRaises(ValueError):
+                download_path(name)
+
+
+class ImportViewsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@b.cc', 'adminpasswd')
+        User.objects.create_user('user1', 'user@b.cc', 'userpasswd')
+        self.client.login(username='admin', password='adminpasswd')
+        self.documents = tempfile.mkdtemp()
+        self.downloads = tempfile.mkdtemp()
+        data = synthetic.generate(states=['Testland'])
+        self.lga_name, path = synthetic.write_mdg_documents(
+            data, self.documents)[0]
+        with open(path, 'rb') as f:
+            self.server = MDGStandIn({os.path.basename(path): f.read()})
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.source_url = self.server.url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.documents)
+        shutil.rmtree(self.downloads)
+
+    def test_import_started_and_progress_shown(self):
+        with self.settings(CELERY_ALWAYS_EAGER=True,
+                           FM_IMPORT_DOWNLOAD_DIR=self.downloads):
+            response = self.client.post('/fm/imports/', {
+                'state_name': 'Testland',
+                'lga_names': u'%s\n\n%s\n' % (self.lga_name, self.lga_name),
+                'sectors': 'health',
+                'source_url': self.source_url})
+        job = ImportJob.objects.get()
+        self.assertRedirects(response, '/fm/imports/%d/' % job.pk)
+        self.assertEqual(job.parts.count(), 1)
+        self.assertEqual(job.created_by.username, 'admin')
+        response = self.client.get('/fm/imports/%d/' % job.pk)
+        self.assertContains(response, self.lga_name)
+        self.assertNotContains(response, 'window.location.reload')
+        document = json.loads(self.client.get(
+            '/fm/imports/%d/json' % job.pk).content)
+        self.assertEqual(document['status'], ImportJob.FINISHED)
+        self.assertEqual(document['parts'][0]['lga_name'], self.lga_name)
+        inserted = document['progress']['inserted']
+        self.assertGreater(inserted, 0)
+        self.assertEqual(document['progress'], {
+            'parsed': inserted, 'inserted': inserted, 'updated': 0,
+            'skipped': 0, 'failed': 0, 'lgas': {'finished': 1}})
+        response = self.client.get('/fm/imports/')
+        self.assertContains(response, '<td>%d</td>' % inserted, count=2)
+
+    def test_invalid_form_redisplayed(self):
+        response = self.client.post('/fm/imports/', {
+            'state_name': 'Testland', 'lga_names': ' \n',
+            'sectors': 'health', 'source_url': self.source_url})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Enter at least one LGA name.')
+        self.assertEqual(ImportJob.objects.count(), 0)
+
+    def test_file_urls_and_paths_in_names_rejected(self):
+        form = ImportJobForm(data={
+            'state_name': '../Testland', 'lga_names': 'Dala\n../../etc',
+            'sectors': 'health', 'source_url': 'file:///etc/'})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(sorted(form.errors),
+                         ['lga_names', 'source_url', 'state_name'])
+        self.assertIn('../../etc', form.errors['lga_names'][0])
+        form = ImportJobForm(data={
+            'state_name': 'Testland', 'lga_names': 'Dala',
+            'sectors': 'health', 'source_url': self.source_url})
+        self.assertTrue(form.is_valid())
+        with self.settings(FM_IMPORT_URL_SCHEMES=('https',)):
+            form = ImportJobForm(data=form.data)
+            self.assertIn('http URLs', form.errors['source_url'][0])
+
+    def test_pending_job_page_refreshes(self):
+        job = ImportJob.objects.create(state_name='Testland')
+        response = self.client.get('/fm/imports/%d/' % job.pk)
+        self.assertContains(response, 'window.location.reload')
+
+    def test_unknown_job_not_found(self):
+        self.assertEqual(self.client.get('/fm/imports/99/json').status_code,
+                         404)
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.client.login(username='user1', password='userpasswd')
+        job = ImportJob.objects.create(state_name='Testland')
+        for url in ('/fm/imports/', '/fm/imports/%d/' % job.pk,
+                    '/fm/imports/%d/json' % job.pk):
+            response = self.client.get(url, follow=True)
+            self.assertContains(response, 'Log in')
+            self.assertNotContains(response, 'Testland')
@@ -0,0 +1,153 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.test import TestCase
+
+from fm import versions
+from fm.importer import import_records
+from fm.models import Area, Contact, Facility
+
+
+class VersionsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.kano = Area.objects.create(area_name='Kano', area_type='State')
+        self.dala = Area.objects.create(area_name='Dala', area_type='LGA',
+                                        area_parent=self.kano)
+        self.ward = Area.objects.create(area_name='Ward 1', area_type='Ward',
+                                        area_parent=self.dala)
+        self.fagge = Area.objects.create(area_name='Fagge', area_type='LGA',
+                                         area_parent=self.kano)
+
+    def subtrees(self):
+        return versions.versions(versions.subtree_scope(a.pk) for a in
+                                 (self.kano, self.dala, self.ward, self.fagge))
+
+    def changed(self, before, after):
+        return set(scope for scope in before if before[scope] != after[scope])
+
+    def test_versions_stable_until_bumped(self):
+        key = versions.versioned_key('x', ['area', 'facility'])
+        self.assertEqual(versions.versioned_key('x', ['facility', 'area']),
+                         key)
+        versions.bump_models(Facility)
+        self.assertNotEqual(versions.versioned_key('x', ['area', 'facility']),
+                            key)
+
+    def test_evicted_version_replaced_by_a_new_one(self):
+        key = versions.versioned_key('x', ['area'])
+        cache.clear()
+        self.assertNotEqual(versions.versioned_key('x', ['area']), key)
+
+    def test_fresh_versions_used_in_the_block_only(self):
+        cache.set('other', 1)
+        key = versions.versioned_key('x', ['area'])
+        with versions.fresh():
+            fresh = versions.versioned_key('x', ['area'])
+            self.assertNotEqual(fresh, key)
+            self.assertEqual(versions.versioned_key('x', ['area']), fresh)
+        self.assertEqual(versions.versioned_key('x', ['area']), key)
+        self.assertEqual(cache.get('other'), 1)
+
+    def test_bumps_in_fresh_block_bump_the_versions_outside(self):
+        key = versions.versioned_key('x', ['area'])
+        with versions.fresh():
+            versions.bump_models(Area)
+        self.assertNotEqual(versions.versioned_key('x', ['area']), key)
+
+    def test_bumped_scopes_recorded(self):
+        with versions.recording() as bumped:
+            versions.bump_models(Facility)
+            versions.bump_subtrees([self.kano.pk])
+        versions.bump_models(Area)
+        self.assertEqual(bumped,
+                         set(['facility', 'subtree:%d' % self.kano.pk]))
+
+    def test_save_and_delete_bump_the_model_and_the_row(self):
+        contact = Contact.objects.create(contact_name='A')
+        scopes = ['contact', versions.row_scope(Contact, contact.pk),
+                  'facility']
+        before = versions.versions(scopes)
+        contact.save()
+        after = versions.versions(scopes)
+        self.assertEqual(self.changed(before, after),
+                         set(['contact', 'contact:%d' % contact.pk]))
+        contact.delete()
+        self.assertNotEqual(versions.versions(scopes)['contact'],
+                            after['contact'])
+
+    def test_facility_versions_bumped_once_the_save_is_committed(self):
+        facility = Facility.objects.create(facility_name='Clinic',
+                                           facility_area=self.ward)
+        scopes = ['facility', versions.row_scope(Facility, facility.pk),
+                  versions.subtree_scope(self.ward.pk)]
+        before = versions.versions(scopes)
+        during = []
+
+        def record(sender, instance, **kwargs):
+            # runs inside the transaction of Facility.save
+            during.append(versions.versions(scopes))
+
+        post_save.connect(record, sender=Facility)
+        try:
+            facility.save()
+        finally:
+            post_save.disconnect(record, sender=Facility)
+        self.assertEqual(during, [before])
+        self.assertEqual(self.changed(before, versions.versions(scopes)),
+                         set(scopes))
+
+    def test_facility_changes_bump_the_subtrees_containing_it(self):
+        before = self.subtrees()
+        facility = Facility.objects.create(facility_name='Clinic',
+                                           facility_area=self.ward)
+        moved = self.subtrees()
+        self.assertEqual(self.changed(before, moved),
+                         set('subtree:%d' % a.pk
+                             for a in (self.kano, self.dala, self.ward)))
+        facility.facility_area = self.fagge
+        facility.save()
+        deleted = self.subtrees()
+        self.assertEqual(len(self.changed(moved, deleted)), 4)
+        facility.delete()
+        self.assertEqual(self.changed(deleted, self.subtrees()),
+                         set('subtree:%d' % a.pk
+                             for a in (self.kano, self.fagge)))
+
+    def test_area_changes_bump_the_subtrees_containing_it(self):
+        before = self.subtrees()
+        self.ward.area_parent = self.fagge
+        self.ward.save()
+        deleted = self.subtrees()
+        self.assertEqual(len(self.changed(before, deleted)), 4)
+        fagge_id = self.fagge.pk
+        Area.objects.filter(pk=fagge_id).delete()
+        self.assertEqual(self.changed(deleted, self.subtrees()),
+                         set(['subtree:%d' % self.kano.pk,
+                              'subtree:%d' % fagge_id]))
+
+    def test_import_bumps_what_it_changes(self):
+        Facility.objects.create(facility_name='Clinic', facility_status='ok',
+                                facility_type='Health Facility',
+                                facility_area=self.ward)
+        clinic = Facility.objects.get()
+        scopes = ['area', 'facility', versions.row_scope(Facility, clinic.pk)]
+        before = versions.versions(scopes)
+        subtrees = self.subtrees()
+        import_records([{'model': 'facility', 'facility_name': 'Clinic',
+                         'facility_type': 'Health Facility',
+                         'facility_status': 'closed',
+                         'facility_area': unicode(self.ward)}])
+        self.assertEqual(self.changed(before, versions.versions(scopes)),
+                         set(scopes[1:]))
+        self.assertEqual(self.changed(subtrees, self.subtrees()),
+                         set('subtree:%d' % a.pk
+                             for a in (self.kano, self.dala, self.ward)))
+        before = versions.versions(scopes)
+        import_records([{'model': 'area', 'area_name': 'Ward 2',
+                         'area_type': 'Ward',
+                         'area_parent': unicode(self.fagge)}])
+        self.assertEqual(self.changed(before, versions.versions(scopes)),
+                         set(['area']))
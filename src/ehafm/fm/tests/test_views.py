@@ -1,11 +1,16 @@
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
 
+import json
 import re
+from urlparse import parse_qsl
 
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.core.urlresolvers import resolve, reverse
-from django.http import HttpRequest
+from django.http import HttpRequest, Http404
 from django.template.loader import render_to_string
 from django.contrib.auth.models import User
 
@@ -19,7 +24,7 @@ from fm.models import Area
 from fm.views import facilities_view
 from fm.views import add_new_facility_view
 from fm.views import facility_view
-from fm.forms import FacilityForm
+from fm.forms import FacilityForm, FacilityFilterForm
 from fm.models import Facility
 
 from fm.views import contacts_view
@@ -32,11 +37,15 @@ from fm.views import add_new_role_view
 from fm.forms import RoleForm
 from fm.models import Role
 
+from fm.importer import import_records
 from fm.views import json_view
+from fm.views import json_batch_view
+from fm.views import choices_view
 
 
 class FMPageBaseTest(TestCase):
     def setUp(self):
+        cache.clear()
         self.superuser = User.objects.create_superuser(
             'admin', 'admin@b.cc', 'adminpasswd')
         self.regular_user = User.objects.create_user(
@@ -74,6 +83,18 @@ class FMPageBaseTest(TestCase):
         request.user = self.superuser
         return view(request, *args, **kwargs)
 
+    def count_superuser_response_queries(self, view, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            self.get_superuser_response(view, *args, **kwargs)
+        return len(queries)
+
+    def add_area_tree(self, depth=4):
+        area = None
+        for level in range(depth):
+            area = Area.objects.create(area_name='Area %d' % level,
+                                       area_type='Ward', area_parent=area)
+        return area
+
     def url_resolves_to_correct_view(self, url, view):
         found = resolve(url)
         self.assertIs(found.func, view)
@@ -180,6 +201,33 @@ class AreasPageTest(FMPageBaseTest):
         self.assertContains(response, 'Area 2')
         self.assertContains(response, 'Ward')
 
+    def test_page_is_paginated_on_the_primary_key(self):
+        areas = [Area.objects.create(area_name='Area %d' % i, area_type='LGA')
+                 for i in range(5)]
+        self.log_admin_in()
+        response = self.client.get('/fm/areas/', {'page_size': 2})
+        self.assertContains(response, 'Area 0 (LGA)')
+        self.assertContains(response, 'Area 1 (LGA)')
+        self.assertNotContains(response, 'Area 2 (LGA)')
+        self.assertContains(response, '?after=%d&amp;page_size=2' %
+                                      areas[1].id)
+        response = self.client.get('/fm/areas/', {'page_size': 2,
+                                                  'after': areas[3].id})
+        self.assertNotContains(response, 'Area 3 (LGA)')
+        self.assertContains(response, 'Area 4 (LGA)')
+        self.assertNotContains(response, 'id_next_page_link')
+
+    def test_csv_export_streams_all_areas(self):
+        area = Area.objects.create(area_name='Area 1', area_type='LGA')
+        Area.objects.create(area_name='Area 2', area_type='Ward',
+                            area_parent=area)
+        self.log_admin_in()
+        response = self.client.get('/fm/areas/', {'format': 'csv'})
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('Area 2 (Ward in Area 1),Area 2,Ward,%d' % area.id,
+                      content)
+
     def test_page_displays_fully_qualified_area_names(self):
         area = Area.objects.create(area_name='Area 1', area_type='LGA')
         subarea = Area.objects.create(area_name='Area 2', area_type='Ward',
@@ -249,8 +297,9 @@ class FacilitiesPageTest(FMPageBaseTest):
         self.url_resolves_to_correct_view('/fm/facilities/', facilities_view)
 
     def test_facilities_page_returns_correct_html_for_superusers(self):
-        self.view_returns_correct_html_for_superusers(facilities_view,
-                                                      'facilities.html')
+        self.view_returns_correct_html_for_superusers(
+            facilities_view, 'facilities.html',
+            {'form': FacilityFilterForm()})
 
     def test_page_accessed_by_superusers_uses_correct_template(self):
         # superuser logged in
@@ -305,6 +354,48 @@ class FacilitiesPageTest(FMPageBaseTest):
         self.assertContains(response, 'Area 1')
         self.assertContains(response, 'State Zone')
 
+    def test_page_query_count_does_not_grow_with_facilities(self):
+        area = self.add_area_tree()
+        Facility.objects.create(facility_name='Facility 0', facility_area=area)
+        queries_for_one = self.count_superuser_response_queries(
+            facilities_view)
+        for i in range(1, 10):
+            Facility.objects.create(facility_name='Facility %d' % i,
+                                    facility_area=self.add_area_tree())
+        self.assertEqual(
+            queries_for_one,
+            self.count_superuser_response_queries(facilities_view))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_superuser_response(facilities_view)
+        self.assertContains(response, 'Area 3 (Ward in Area 2 in Area 1')
+        # the labels come from the stored ancestry, not from the parents
+        for query in queries:
+            self.assertNotIn('"fm_area"."id" IN (', query['sql'])
+
+    def test_page_is_paginated_on_the_primary_key(self):
+        for i in range(3):
+            Facility.objects.create(facility_name='Facility %d' % i)
+        with self.settings(FM_PAGE_SIZE=2):
+            response = self.get_superuser_response(facilities_view)
+        self.assertContains(response, 'Facility 1')
+        self.assertNotContains(response, 'Facility 2')
+        self.assertContains(response, 'id_next_page_link')
+
+    def test_csv_export_streams_all_facilities(self):
+        area = Area.objects.create(area_name='Area 1', area_type='LGA')
+        for i in range(5):
+            Facility.objects.create(facility_name='Facility %d' % i,
+                                    facility_type='Health Facility',
+                                    facility_status='ok', facility_area=area)
+        self.log_admin_in()
+        with self.settings(FM_MAX_PAGE_SIZE=2):
+            response = self.client.get('/fm/facilities/', {'format': 'csv'})
+            content = b''.join(response.streaming_content).decode('utf-8')
+        lines = content.splitlines()
+        self.assertEqual(lines[0], 'id,name,type,status,area')
+        self.assertEqual(len(lines), 6)
+        self.assertIn('Facility 4,Health Facility,ok,Area 1 (LGA)', lines[5])
+
     def test_page_displays_links_to_json(self):
         facility = FacilityForm(data={'facility_name': 'Facility 1',
                                       'facility_type': 'Zonal Store',
@@ -337,6 +428,16 @@ class FacilitiesPageTest(FMPageBaseTest):
         path_to_json = str(facility.id) + '/json'
         self.assertNotContains(response, path_to_json)
 
+    def test_page_does_not_load_json_documents(self):
+        Facility.objects.create(facility_name='Facility 1',
+                                json={'padding': 'x' * 1000})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_superuser_response(facilities_view)
+        self.assertContains(response, 'Facility 1')
+        self.assertContains(response, '/json')
+        for query in queries:
+            self.assertNotIn('"fm_facility"."json"', query['sql'])
+
     def test_page_displays_links_to_facility_views(self):
         facility_name = 'Facility 1'
         facility_form = FacilityForm(data={'facility_name': facility_name,
@@ -354,6 +455,106 @@ class FacilitiesPageTest(FMPageBaseTest):
             'No hyperlink to the just added facility found in the response!')
 
 
+class FacilityFilterTest(FMPageBaseTest):
+    def setUp(self):
+        super(FacilityFilterTest, self).setUp()
+        kano = Area.objects.create(area_name='Kano', area_type='State')
+        self.zone = Area.objects.create(area_name='Zone 3', area_type='Zone',
+                                        area_parent=kano)
+        lga = Area.objects.create(area_name='Dala', area_type='LGA',
+                                  area_parent=self.zone)
+        for name, facility_type, status, area, document in [
+                ('Store A', 'LGA Store', 'non-functional', lga, None),
+                ('Store B', 'LGA Store', 'ok', lga, None),
+                ('Store C', 'LGA Store', 'non-functional', kano, None),
+                ('Clinic D', 'Health Facility', 'non-functional', lga, {}),
+                ('Clinic E', 'Health Facility', 'ok', None, {'id': 1})]:
+            Facility.objects.create(
+                facility_name=name, facility_type=facility_type,
+                facility_status=status, facility_area=area, json=document)
+
+    def get_names(self, **params):
+        request = HttpRequest()
+        request.user = self.superuser
+        request.GET = params
+        content = facilities_view(request).content.decode()
+        return re.findall(r'/view">([^<]+)</a>', content), content
+
+    def test_filters_combined(self):
+        names, _ = self.get_names(facility_type='LGA Store',
+                                  facility_status='non-functional',
+                                  area=str(self.zone.id))
+        self.assertEqual(names, ['Store A'])
+        self.assertEqual(self.get_names(has_json='yes')[0],
+                         ['Clinic D', 'Clinic E'])
+        self.assertEqual(
+            self.get_names(has_json='no', facility_status='ok')[0],
+            ['Store B'])
+
+    def test_invalid_filters_reported_and_nothing_listed(self):
+        names, content = self.get_names(area='999999')
+        self.assertEqual(names, [])
+        self.assertIn('errorlist', content)
+
+    def test_sorted_on_every_column_in_both_directions(self):
+        self.assertEqual(self.get_names(sort='-name')[0],
+                         ['Store C', 'Store B', 'Store A', 'Clinic E',
+                          'Clinic D'])
+        self.assertEqual(self.get_names(sort='status')[0][:3],
+                         ['Store A', 'Store C', 'Clinic D'])
+        names, content = self.get_names(sort='type')
+        self.assertEqual(names[:2], ['Clinic D', 'Clinic E'])
+        self.assertIn('?sort=-type', content)
+        self.assertEqual(self.get_names(sort='json')[0][-2:],
+                         ['Clinic D', 'Clinic E'])
+        self.assertEqual(self.get_names(sort='-area')[0][:3],
+                         ['Store C', 'Clinic D', 'Store B'])
+
+    def test_pages_of_a_sorted_and_filtered_list_cover_it_once(self):
+        for i in range(7):
+            Facility.objects.create(
+                facility_name='Store %d' % (i % 3), facility_type='LGA Store',
+                facility_status='ok',
+                facility_area=self.zone if i % 2 else None)
+        for sort in ('name', '-name', 'area', '-area', 'json', '-status'):
+            expected = self.get_names(sort=sort, page_size='100',
+                                      facility_type='LGA Store')[0]
+            names, params = [], {'sort': sort, 'page_size': '2',
+                                 'facility_type': 'LGA Store'}
+            while True:
+                page, content = self.get_names(**params)
+                names += page
+                link = re.search(r'id="id_first_page_link"', content)
+                self.assertEqual(link is not None, 'after' in params)
+                match = re.search(r'href="\?([^"]+)" id="id_next_page_link"',
+                                  content)
+                if match is None:
+                    break
+                params = dict(parse_qsl(match.group(1).replace('&amp;', '&')))
+                self.assertLess(len(names), 10)
+            self.assertEqual(names, expected, sort)
+            self.assertEqual(len(names), 10)
+
+    def test_csv_export_filtered(self):
+        self.log_admin_in()
+        response = self.client.get('/fm/facilities/',
+                                   {'facility_type': 'Health Facility',
+                                    'format': 'csv'})
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(len(content.splitlines()), 3)
+
+    def test_csv_export_sorted_as_the_list(self):
+        self.log_admin_in()
+        for sort in ('-name', 'area', '-json'):
+            expected = self.get_names(sort=sort)[0]
+            with self.settings(FM_MAX_PAGE_SIZE=2):
+                response = self.client.get('/fm/facilities/',
+                                           {'sort': sort, 'format': 'csv'})
+                content = b''.join(response.streaming_content).decode('utf-8')
+            names = [line.split(',')[1] for line in content.splitlines()[1:]]
+            self.assertEqual(names, expected, sort)
+
+
 class AddNewFacilityPageTest(FMPageBaseTest):
     def test_page_url_resolves_to_correct_view(self):
         self.url_resolves_to_correct_view('/fm/facilities/new',
@@ -565,6 +766,14 @@ class ContactsPageTest(FMPageBaseTest):
         self.assertContains(response, '055555')
         self.assertContains(response, 'e@d.cc')
 
+    def test_csv_export_streams_all_contacts(self):
+        Contact.objects.create(contact_name='Contact 1',
+                               contact_phone='04444', contact_email='a@b.cc')
+        self.log_admin_in()
+        response = self.client.get('/fm/contacts/', {'format': 'csv'})
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('Contact 1,04444,a@b.cc', content)
+
     def test_page_displays_links_to_json(self):
         Contact.objects.create(contact_name='Contact 1',
                                contact_phone='04444',
@@ -693,6 +902,184 @@ class ContactJSONTest(FMPageBaseTest):
             self.assertContains(response, s)
 
 
+
+class JSONDocumentCacheTest(FMPageBaseTest):
+    def setUp(self):
+        super(JSONDocumentCacheTest, self).setUp()
+        self.facility = Facility.objects.create(
+            facility_name='Facility 1', facility_type='Zonal Store',
+            facility_status='ok', json={'beds': 10})
+
+    def get_json(self, model_choice='facilities', container_id=None,
+                 **headers):
+        request = HttpRequest()
+        request.user = self.superuser
+        request.META.update(headers)
+        if container_id is None:
+            container_id = self.facility.id
+        return json_view(request, model_choice, container_id)
+
+    def test_response_has_validators(self):
+        response = self.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertRegexpMatches(response['ETag'], r'^"[0-9a-f]{32}"$')
+        self.assertNotIn('Last-Modified', response)
+
+    def test_repeated_fetches_do_not_touch_the_database(self):
+        first = self.get_json()
+        with CaptureQueriesContext(connection) as queries:
+            second = self.get_json()
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_not_modified_when_etag_matches(self):
+        etag = self.get_json()['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_json(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(
+            self.get_json(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_if_modified_since_ignored(self):
+        self.assertEqual(self.get_json(
+            HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT'
+        ).status_code, 200)
+
+    def test_saving_invalidates_the_cached_document(self):
+        etag = self.get_json()['ETag']
+        self.facility.json = {'beds': 20}
+        self.facility.save()
+        response = self.get_json(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('20', response.content)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_import_updates_invalidate_the_cached_document(self):
+        self.facility.json = {'facility_id': 'F1', 'beds': 10}
+        self.facility.save()
+        self.get_json()
+        import_records([{'model': 'facility', 'facility_name': 'Facility 1',
+                         'facility_type': 'Zonal Store',
+                         'facility_status': 'ok',
+                         'json': {'facility_id': 'F1', 'beds': 30}}])
+        self.assertIn('30', self.get_json().content)
+
+    def test_contact_documents_cached_separately(self):
+        contact = Contact.objects.create(
+            contact_name='Contact 1', contact_phone='04444',
+            contact_email='a@b.cc', json={'role': 'nurse'})
+        contact_response = self.get_json('contacts', contact.id)
+        self.assertIn('nurse', contact_response.content)
+        self.assertNotEqual(contact_response['ETag'], self.get_json()['ETag'])
+        contact.json = {'role': 'doctor'}
+        contact.save()
+        self.assertIn('doctor', self.get_json('contacts', contact.id).content)
+
+    def test_missing_documents_not_found(self):
+        with self.assertRaises(Http404):
+            self.get_json(container_id=self.facility.id + 1)
+
+
+class JSONBatchTest(FMPageBaseTest):
+    def setUp(self):
+        super(JSONBatchTest, self).setUp()
+        self.lga = Area.objects.create(area_name='Dala', area_type='LGA')
+        self.ward = Area.objects.create(area_name='Gwammaja', area_type='Ward',
+                                        area_parent=self.lga)
+        other = Area.objects.create(area_name='Fagge', area_type='LGA')
+        self.facilities = [
+            Facility.objects.create(
+                facility_name='Facility %d' % i, facility_type='Zonal Store',
+                facility_status='ok', facility_area=area,
+                json={'number': i, 'notes': 'line\nbreak'})
+            for i, area in enumerate([self.lga, self.ward, other, None])]
+
+    def get_batch(self, model_choice='facilities', **params):
+        request = HttpRequest()
+        request.user = self.superuser
+        request.GET.update(params)
+        return json_batch_view(request, model_choice)
+
+    def ids(self, *indices):
+        return ','.join(str(self.facilities[i].id) for i in indices)
+
+    def test_batch_urls_resolve_to_json_batch_view(self):
+        self.url_resolves_to_correct_view('/fm/facilities/json',
+                                          json_batch_view)
+        self.url_resolves_to_correct_view('/fm/contacts/json',
+                                          json_batch_view)
+
+    def test_page_redirects_and_asks_anonymous_users_to_log_in(self):
+        response = self.client.get('/fm/facilities/json?ids=1', follow=True)
+        self.assertContains(response, 'Log in')
+
+    def test_documents_keyed_by_id(self):
+        response = self.get_batch(ids=self.ids(2, 0))
+        documents = json.loads(''.join(response.streaming_content))
+        self.assertEqual(documents, {
+            str(self.facilities[2].id): {'number': 2, 'notes': 'line\nbreak'},
+            str(self.facilities[0].id): {'number': 0, 'notes': 'line\nbreak'},
+        })
+
+    def test_documents_as_ndjson(self):
+        response = self.get_batch(ids=self.ids(1, 3), format='ndjson')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'id': self.facilities[1].id,
+             'json': {'number': 1, 'notes': 'line\nbreak'}},
+            {'id': self.facilities[3].id,
+             'json': {'number': 3, 'notes': 'line\nbreak'}}])
+
+    def test_ranges_and_missing_ids(self):
+        first, last = self.facilities[0].id, self.facilities[3].id
+        response = self.get_batch(ids='%d-%d,%d' % (first, last, last + 5))
+        documents = json.loads(''.join(response.streaming_content))
+        self.assertEqual(sorted(int(pk) for pk in documents),
+                         [f.id for f in self.facilities])
+        response = self.get_batch(ids='%d' % (last + 5))
+        self.assertEqual(json.loads(''.join(response.streaming_content)), {})
+
+    def test_area_filter_covers_the_subareas(self):
+        response = self.get_batch(area=str(self.lga.id), format='ndjson')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         [self.facilities[0].id, self.facilities[1].id])
+
+    def test_one_query_for_uncached_documents_and_none_for_cached(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(self.get_batch(ids=self.ids(0, 1, 2, 3)).streaming_content)
+        self.assertEqual(len(queries), 1)
+        with CaptureQueriesContext(connection) as queries:
+            list(self.get_batch(ids=self.ids(0, 1, 2, 3)).streaming_content)
+        self.assertEqual(len(queries), 0)
+
+    def test_batch_reflects_saved_changes(self):
+        list(self.get_batch(ids=self.ids(0)).streaming_content)
+        self.facilities[0].json = {'number': 100}
+        self.facilities[0].save()
+        response = self.get_batch(ids=self.ids(0))
+        self.assertEqual(json.loads(''.join(response.streaming_content)),
+                         {str(self.facilities[0].id): {'number': 100}})
+
+    def test_contact_documents(self):
+        contact = Contact.objects.create(
+            contact_name='Contact 1', contact_phone='04444',
+            contact_email='a@b.cc', json={'role': 'nurse'})
+        response = self.get_batch('contacts', ids=str(contact.id))
+        self.assertEqual(json.loads(''.join(response.streaming_content)),
+                         {str(contact.id): {'role': 'nurse'}})
+
+    def test_invalid_requests_rejected(self):
+        self.assertEqual(self.get_batch(ids='a,b').status_code, 400)
+        self.assertEqual(self.get_batch(ids='5-2').status_code, 400)
+        self.assertEqual(self.get_batch(area='12345').status_code, 400)
+        with self.settings(FM_JSON_BATCH_LIMIT=10):
+            self.assertEqual(self.get_batch(ids='1-11').status_code, 400)
+            self.assertEqual(self.get_batch(ids='1-10').status_code, 200)
+
 class RolesPageTest(FMPageBaseTest):
     def test_roles_url_resolves_to_roles_view(self):
         self.url_resolves_to_correct_view('/fm/roles/', roles_view)
@@ -756,6 +1143,38 @@ class RolesPageTest(FMPageBaseTest):
         self.assertContains(response, 'contact2')
 
 
+    def test_csv_export_streams_all_roles(self):
+        Role.objects.create(
+            role_name='SCCO',
+            role_contact=Contact.objects.create(contact_name='contact1'),
+            role_facility=Facility.objects.create(facility_name='facility1'))
+        self.log_admin_in()
+        response = self.client.get('/fm/roles/', {'format': 'csv'})
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('SCCO,contact1,facility1', content)
+
+    def test_page_query_count_does_not_grow_with_roles(self):
+        def add_role(i):
+            Role.objects.create(
+                role_name='SCCO',
+                role_contact=Contact.objects.create(
+                    contact_name='contact%d' % i, contact_email='c@b.cc'),
+                role_facility=Facility.objects.create(
+                    facility_name='facility%d' % i,
+                    facility_area=self.add_area_tree()))
+
+        add_role(0)
+        queries_for_one = self.count_superuser_response_queries(roles_view)
+        for i in range(1, 10):
+            add_role(i)
+        self.assertEqual(queries_for_one,
+                         self.count_superuser_response_queries(roles_view))
+        response = self.get_superuser_response(roles_view)
+        self.assertContains(response, 'contact9 &lt;c@b.cc&gt;')
+        self.assertContains(response,
+                            'facility9 in Area 3 (Ward in Area 2 in Area 1')
+
+
 class AddNewRolePageTest(FMPageBaseTest):
     def test_page_url_resolves_to_correct_view(self):
         self.url_resolves_to_correct_view('/fm/roles/new',
@@ -820,3 +1239,24 @@ class AddNewRolePageTest(FMPageBaseTest):
         self.assertContains(response, 'contact22')
         self.assertContains(response, 'facility11')
 
+
+
+class ChoicesSearchTest(FMPageBaseTest):
+    def test_choices_url_resolves_to_choices_view(self):
+        self.url_resolves_to_correct_view('/fm/choices/areas', choices_view)
+
+    def test_page_redirects_and_asks_non_staff_users_to_log_in(self):
+        self.client.login(username='user1', password='userpasswd')
+        response = self.client.get('/fm/choices/areas', follow=True)
+        self.assertContains(response, 'Log in')
+
+    def test_returns_matching_labels_as_json(self):
+        state = Area.objects.create(area_name='Kano', area_type='State')
+        dala = Area.objects.create(area_name='Dala', area_type='LGA',
+                                   area_parent=state)
+        Area.objects.create(area_name='Gwale', area_type='LGA',
+                            area_parent=state)
+        self.log_admin_in()
+        response = self.client.get('/fm/choices/areas', {'q': 'dala kano'})
+        self.assertEqual(json.loads(response.content.decode()),
+                         [{'id': dala.id, 'label': 'Dala (LGA in Kano)'}])
@@ -13,6 +13,8 @@ urlpatterns = patterns('',
         name='fm_add_new_facility'),
     url(r'^(facilities)/([0-9]+)/json$',
         'fm.views.json_view', name='fm_facility_json'),
+    url(r'^(facilities)/json$',
+        'fm.views.json_batch_view', name='fm_facilities_json'),
     url(r'^facilities/([0-9]+)/view$',
         'fm.views.facility_view', name='fm_facility_view'),
     url(r'^contacts/$', 'fm.views.contacts_view', name='fm_contacts'),
@@ -20,7 +22,19 @@ urlpatterns = patterns('',
         name='fm_add_new_contact'),
     url(r'^(contacts)/([0-9]+)/json$',
         'fm.views.json_view', name='fm_contact_json'),
+    url(r'^(contacts)/json$',
+        'fm.views.json_batch_view', name='fm_contacts_json'),
     url(r'^roles/$', 'fm.views.roles_view', name='fm_roles'),
     url(r'^roles/new$', 'fm.views.add_new_role_view',
         name='fm_add_new_role'),
+    url(r'^import$', 'fm.views.import_view', name='fm_import'),
+    url(r'^choices/(areas|facilities|contacts)$',
+        'fm.views.choices_view', name='fm_choices'),
+    url(r'^search$', 'fm.views.search_view', name='fm_search'),
+    url(r'^metrics$', 'fm.views.metrics_view', name='fm_metrics'),
+    url(r'^imports/$', 'fm.views.imports_view', name='fm_imports'),
+    url(r'^imports/([0-9]+)/$', 'fm.views.import_job_view',
+        name='fm_import_job'),
+    url(r'^imports/([0-9]+)/json$', 'fm.views.import_job_json_view',
+        name='fm_import_job_json'),
 )
@@ -0,0 +1,152 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Versions of the data, kept in the Django cache so that they are shared by all
+# the worker processes.  Anything derived from the database can be cached
+# under a key including the versions of the data it has been built from (see
+# versioned_key); a change replaces the versions it affects and so makes every
+# cached copy built from the old data unreachable.  No TTLs and no deleting of
+# the derived keys are needed.
+#
+# There are three kinds of scopes:
+#   - a model ('area', 'facility', ...): any row of the table has changed,
+#   - a row ('facility:12'): the row has changed,
+#   - an area subtree ('subtree:5'): a facility in the area or in one of its
+#     subareas has been added, changed, moved or deleted, or an area of the
+#     subtree has (the names and labels of areas are covered by the 'area'
+#     model scope).
+#
+# The versions are bumped by the signal receivers in fm.models, by
+# Facility.save once its transaction is committed and by bulk operations
+# which send no signals (the importer).  A version is a random
+# token rather than an incremented counter: a batch of versions is replaced
+# with a single set_many, concurrent bumps cannot lose an update and a version
+# evicted from the cache simply starts a new one.
+
+import hashlib
+import uuid
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+# Maximum number of area ids per query looking up their ancestors.
+LOOKUP_CHUNK_SIZE = 400
+
+# Sets collecting the scopes bumped (see recording)
+_recorders = []
+# Prefixes of the scopes of the versions, the last one in use (see fresh)
+_namespaces = ['']
+
+
+def _key(scope, namespace=None):
+    if namespace is None:
+        namespace = _namespaces[-1]
+    return 'fm:version:%s%s' % (namespace, scope)
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def model_scope(model):
+    return model._meta.model_name
+
+
+def row_scope(model, pk):
+    return '%s:%s' % (model._meta.model_name, pk)
+
+
+def subtree_scope(area_id):
+    return 'subtree:%s' % area_id
+
+
+def versions(scopes):
+    """Return a dict mapping the scopes to their current versions (one
+    get_many, plus one set_many if any of them has no version yet)."""
+    keys = dict((scope, _key(scope)) for scope in scopes)
+    found = cache.get_many(keys.values())
+    new = dict((key, _new_version()) for key in keys.values()
+               if key not in found)
+    if new:
+        cache.set_many(new, None)
+        found.update(new)
+    return dict((scope, found[key]) for scope, key in keys.items())
+
+
+def version(scope):
+    return versions([scope])[scope]
+
+
+def versioned_key(prefix, scopes):
+    """Return a cache key for data built from the given scopes, valid until
+    any of them changes."""
+    current = versions(scopes)
+    digest = hashlib.md5(u':'.join(current[s] for s in sorted(scopes)).encode(
+        'ascii')).hexdigest()
+    return '%s:%s' % (prefix, digest)
+
+
+def bump(scopes):
+    """Start new versions of the scopes (in every set of versions, see
+    fresh)."""
+    scopes = set(scopes)
+    if scopes:
+        cache.set_many(dict((_key(s, namespace), _new_version())
+                            for s in scopes for namespace in _namespaces),
+                       None)
+        for recorded in _recorders:
+            recorded.update(scopes)
+
+
+@contextmanager
+def fresh():
+    """Use a new set of versions in the block, so that nothing cached under
+    the versions in use outside of it is found (cold caches without clearing
+    the cache, which may be shared with other processes and applications).
+    Changes made in the block bump the versions in use outside of it as well.
+    The versions of the block are left to the cache to evict."""
+    _namespaces.append('%s:' % uuid.uuid4().hex)
+    try:
+        yield
+    finally:
+        _namespaces.pop()
+
+
+@contextmanager
+def recording():
+    """Collect the scopes bumped in the block into the set it yields (so
+    that they can be bumped again once the changes are rolled back)."""
+    recorded = set()
+    _recorders.append(recorded)
+    try:
+        yield recorded
+    finally:
+        _recorders.remove(recorded)
+
+
+def bump_models(*models):
+    bump(model_scope(model) for model in models)
+
+
+def bump_rows(model, pks):
+    bump(row_scope(model, pk) for pk in pks)
+
+
+def bump_subtrees(area_ids):
+    """Start new versions of the subtrees rooted at the given areas (which
+    have to include all the ancestors of the changed area, see bump_areas)."""
+    bump(subtree_scope(area_id) for area_id in area_ids)
+
+
+def bump_areas(area_ids):
+    """Start new versions of the subtrees of the given areas and of all their
+    ancestors (one query per chunk of areas).  None stands for no area."""
+    from fm.models import Area
+    area_ids = list(set(area_ids).difference([None]))
+    subtrees = set(area_ids)
+    for start in range(0, len(area_ids), LOOKUP_CHUNK_SIZE):
+        for path in Area.objects.filter(
+                pk__in=area_ids[start:start + LOOKUP_CHUNK_SIZE]).values_list(
+                'area_path', flat=True):
+            subtrees.update(Area.path_ids(path))
+    bump_subtrees(subtrees)
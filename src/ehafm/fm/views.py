@@ -1,17 +1,32 @@
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 __copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
 
-from django.shortcuts import render, redirect, HttpResponse
+from django.http import HttpResponseBadRequest, HttpResponseNotAllowed, \
+    HttpResponseNotModified, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render, redirect, \
+    HttpResponse
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
+from django.db.models import Sum
+from django.utils.http import parse_etags, quote_etag
 
-import jsonfield
+import json
+
+from fm.choices import search_choice_labels
+from fm.documents import batch_limit, json_document, json_documents, \
+    json_object_chunks, ndjson_lines, parse_ids
+from fm.importer import import_records, parse_records, summarise, RecordError
+
+from fm.export import stream_csv
+from fm.metrics import prometheus_text
+from fm.pagination import request_page
+from fm.search import search
 
 from fm.forms import AreaForm
 from fm.models import Area
 
-from fm.forms import FacilityForm
+from fm.forms import FacilityForm, FacilityFilterForm
 from fm.models import Facility
 
 from fm.forms import ContactForm
@@ -20,6 +35,9 @@ from fm.models import Contact
 from fm.forms import RoleForm
 from fm.models import Role
 
+from fm.forms import ImportJobForm
+from fm.models import ImportJob
+
 
 @login_required(login_url='/login')
 @staff_member_required
@@ -30,7 +48,15 @@ def home_view(request):
 @login_required(login_url='/login')
 @staff_member_required
 def areas_view(request):
-    return render(request, 'areas.html', {'areas': Area.objects.all()})
+    areas = Area.objects.all()
+    if request.GET.get('format') == 'csv':
+        return stream_csv(
+            areas, 'areas.csv',
+            ('id', 'label', 'name', 'type', 'parent id'),
+            lambda a: (a.id, a.area_label, a.area_name, a.area_type,
+                       a.area_parent_id))
+    page = request_page(request, areas)
+    return render(request, 'areas.html', {'areas': page, 'page': page})
 
 
 @login_required(login_url='/login')
@@ -48,8 +74,20 @@ def add_new_area_view(request):
 @login_required(login_url='/login')
 @staff_member_required
 def facilities_view(request):
+    form = FacilityFilterForm(request.GET or None)
+    # the JSON documents are not displayed (has_json is enough for the links)
+    facilities = form.filter(
+        Facility.objects.select_related('facility_area').defer('json'))
+    if request.GET.get('format') == 'csv':
+        return stream_csv(
+            facilities, 'facilities.csv',
+            ('id', 'name', 'type', 'status', 'area'),
+            lambda f: (f.id, f.facility_name, f.facility_type,
+                       f.facility_status, f.facility_area),
+            order_by=form.order_by())
+    page = request_page(request, facilities, form.order_by(), form.params())
     return render(request, 'facilities.html',
-                  {'facilities': Facility.objects.all()})
+                  {'facilities': page, 'page': page, 'form': form})
 
 
 @login_required(login_url='/login')
@@ -81,8 +119,14 @@ def facility_view(request, facility_id):
 @login_required(login_url='/login')
 @staff_member_required
 def contacts_view(request):
-    return render(request, 'contacts.html',
-                  {'contacts': Contact.objects.all()})
+    contacts = Contact.objects.defer('json')
+    if request.GET.get('format') == 'csv':
+        return stream_csv(
+            contacts, 'contacts.csv', ('id', 'name', 'phone', 'e-mail'),
+            lambda c: (c.id, c.contact_name, c.contact_phone,
+                       c.contact_email))
+    page = request_page(request, contacts)
+    return render(request, 'contacts.html', {'contacts': page, 'page': page})
 
 
 @login_required(login_url='/login')
@@ -100,8 +144,15 @@ def add_new_contact_view(request):
 @login_required(login_url='/login')
 @staff_member_required
 def roles_view(request):
-    return render(request, 'roles.html',
-                  {'roles': Role.objects.all()})
+    roles = Role.objects.select_related(
+        'role_contact', 'role_facility__facility_area').defer(
+        'role_contact__json', 'role_facility__json')
+    if request.GET.get('format') == 'csv':
+        return stream_csv(
+            roles, 'roles.csv', ('id', 'role', 'contact', 'facility'),
+            lambda r: (r.id, r.role_name, r.role_contact, r.role_facility))
+    page = request_page(request, roles)
+    return render(request, 'roles.html', {'roles': page, 'page': page})
 
 
 @login_required(login_url='/login')
@@ -124,8 +175,136 @@ def json_view(request, model_choice, container_id):
         model = Contact
     elif model_choice == 'facilities':
         model = Facility
-    container = model.objects.get(pk=container_id)
-    json_document = jsonfield.JSONField().dumps_for_display(container.json)
-    return HttpResponse(content=json_document,
-                        content_type='application/json;charset=utf-8')
+    document = json_document(model, int(container_id))
+    if not_modified(request, document):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content=document.content,
+                                content_type='application/json;charset=utf-8')
+    response['ETag'] = document.etag
+    return response
+
+
+def not_modified(request, document):
+    """Check the If-None-Match header of the request against the ETag of the
+    cached document (If-Modified-Since is ignored, see Document)."""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is None:
+        return False
+    etags = parse_etags(if_none_match)
+    return '*' in etags or document.etag in (quote_etag(e) for e in etags)
+
+
+@login_required(login_url='/login')
+@staff_member_required
+def json_batch_view(request, model_choice):
+    """The JSON documents of many facilities or contacts in one response:
+    ?ids=1,2,10-20 (or, for facilities, ?area=<id> for all the facilities in
+    the area and its subareas), as one JSON object keyed by id or, with
+    ?format=ndjson, as one {"id": ..., "json": ...} line per document."""
+    model = None
+    if model_choice == 'contacts':
+        model = Contact
+    elif model_choice == 'facilities':
+        model = Facility
+    try:
+        if model is Facility and 'area' in request.GET:
+            area = Area.objects.only('area_path').get(
+                pk=int(request.GET['area']))
+            ids = list(Facility.objects.within(area).order_by(
+                'pk').values_list('pk', flat=True)[:batch_limit() + 1])
+            if len(ids) > batch_limit():
+                raise ValueError('More than %d facilities in the area.' %
+                                 batch_limit())
+        else:
+            ids = parse_ids(request.GET.get('ids', ''))
+    except (ValueError, Area.DoesNotExist) as e:
+        return HttpResponseBadRequest(unicode(e))
+    documents = json_documents(model, ids)
+    if request.GET.get('format') == 'ndjson':
+        return StreamingHttpResponse(
+            (line.encode('utf-8') for line in ndjson_lines(documents)),
+            content_type='application/x-ndjson;charset=utf-8')
+    return StreamingHttpResponse(
+        (chunk.encode('utf-8') for chunk in json_object_chunks(documents)),
+        content_type='application/json;charset=utf-8')
+
+
+@login_required(login_url='/login')
+@staff_member_required
+def choices_view(request, source):
+    labels = search_choice_labels(source, request.GET.get('q', ''))
+    return HttpResponse(
+        content=json.dumps([{'id': pk, 'label': label}
+                            for pk, label in labels]),
+        content_type='application/json;charset=utf-8')
+
+
+@login_required(login_url='/login')
+@staff_member_required
+def import_view(request):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        records = parse_records(request.body)
+    except RecordError as e:
+        return HttpResponseBadRequest(unicode(e))
+    results = import_records(records)
+    return HttpResponse(
+        content=json.dumps({'summary': summarise(results),
+                            'results': results}),
+        content_type='application/json;charset=utf-8')
 
+
+@login_required(login_url='/login')
+@staff_member_required
+def search_view(request):
+    query = request.GET.get('q', '')
+    results = search(query) if query.strip() else []
+    if request.GET.get('format') == 'json':
+        return HttpResponse(content=json.dumps(results),
+                            content_type='application/json;charset=utf-8')
+    return render(request, 'search.html',
+                  {'query': query, 'results': results})
+
+
+@login_required(login_url='/login')
+@staff_member_required
+def metrics_view(request):
+    return HttpResponse(content=prometheus_text(),
+                        content_type='text/plain; version=0.0.4')
+
+
+@login_required(login_url='/login')
+@staff_member_required
+def imports_view(request):
+    form = ImportJobForm()
+    if request.method == 'POST':
+        form = ImportJobForm(data=request.POST)
+        if form.is_valid():
+            job = form.start(request.user)
+            return redirect(reverse('fm_import_job', args=[job.pk]))
+    jobs = ImportJob.objects.annotate(
+        **dict((name, Sum('parts__' + name)) for name in ImportJob.COUNTS))
+    page = request_page(request, jobs, '-created')
+    return render(request, 'imports.html',
+                  {'form': form, 'jobs': page, 'page': page})
+
+
+@login_required(login_url='/login')
+@staff_member_required
+def import_job_view(request, job_id):
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return render(request, 'import_job.html',
+                  {'job': job, 'progress': job.progress(),
+                   'parts': job.parts.order_by('pk'),
+                   'running': job.status in (ImportJob.PENDING,
+                                             ImportJob.RUNNING)})
+
+
+@login_required(login_url='/login')
+@staff_member_required
+def import_job_json_view(request, job_id):
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return HttpResponse(content=json.dumps(job.as_dict()),
+                        content_type='application/json;charset=utf-8')
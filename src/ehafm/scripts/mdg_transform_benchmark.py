@@ -0,0 +1,91 @@
+__author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
+__copyright__ = 'Copyright (c) 2014, Tomasz J. Kotarba. All rights reserved.'
+
+# Measures how the transformation of MDG LGA documents into import records
+# scales with the number of worker processes.  Synthetic documents shaped like
+# the MDG ones are generated in a temporary directory, e.g.:
+#   python scripts/mdg_transform_benchmark.py --lgas 44 --facilities 2000
+
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# make the fm package importable when run as a script from scripts/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fm import mdg
+
+SECTORS = ('health', 'education', 'water')
+
+
+def write_documents(directory, lgas, facilities, seed=0):
+    generator = random.Random(seed)
+    documents = []
+    for lga_name in (mdg.KANO_LGA_NAMES * (lgas // 44 + 1))[:lgas]:
+        name = '%d_%s' % (len(documents), mdg.lga_document_name('Kano',
+                                                                 lga_name))
+        document = {
+            'lga': {'name': lga_name, 'state': 'Kano'},
+            'facilities': [{
+                'facility_id': '%s-%d' % (name, i),
+                'sector': generator.choice(SECTORS),
+                'facility_name': 'facility.  %d of %s' % (i, lga_name),
+                'ward': 'ward %d' % generator.randint(1, 15),
+                'num_doctors_fulltime': generator.randint(0, 20),
+                'latitude': generator.uniform(10, 13),
+                'longitude': generator.uniform(7, 10),
+                'notes': 'x' * generator.randint(0, 400),
+            } for i in range(facilities)],
+        }
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            json.dump(document, f)
+        documents.append((lga_name, path))
+    return documents
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lgas', type='int', default=44)
+    parser.add_option('--facilities', type='int', default=1000,
+                      help='facilities per LGA document (all sectors)')
+    parser.add_option('--max-processes', type='int',
+                      default=multiprocessing.cpu_count())
+    parser.add_option('--repeat', type='int', default=3)
+    options, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        documents = write_documents(directory, options.lgas,
+                                    options.facilities)
+        expected = None
+        baseline = None
+        print 'processes   seconds   speedup'
+        for processes in range(1, options.max_processes + 1):
+            timings = []
+            for _ in range(options.repeat):
+                start = time.time()
+                records = mdg.transform_documents('Kano', documents,
+                                                  processes=processes)
+                timings.append(time.time() - start)
+            if expected is None:
+                expected = records
+            elif records != expected:
+                exit('Output of %d processes differs from the sequential'
+                     ' output.' % processes)
+            best = min(timings)
+            baseline = baseline or best
+            print '%9d %9.3f %9.2f' % (processes, best, baseline / best)
+        print '%d records from %d documents' % (len(expected), len(documents))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()